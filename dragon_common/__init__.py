@@ -0,0 +1,6 @@
+"""
+Dragon Cafe Common Package | Org: Alta3 Research Inc.
+
+Code shared between the Dragon Cafe monoliths and the microservices that
+were broken out of them.
+"""
@@ -0,0 +1,89 @@
+"""
+Dragon Cafe API Responses | Org: Alta3 Research Inc.
+
+The /api/... routes answer with the same data as the html pages, minus the
+markup. JSON is the default and is sent without whitespace; clients that list
+application/msgpack in Accept get msgpack instead when the msgpack package
+is installed. The services' requirements install it; without it every client
+gets JSON. A client whose Accept rules out every type on offer gets a 406.
+"""
+
+import json
+
+from aiohttp import hdrs, web
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_ALIASES = frozenset([MSGPACK, "application/x-msgpack", "application/vnd.msgpack"])
+
+# Media types this process can produce, best first
+MEDIA_TYPES = ([MSGPACK] if msgpack is not None else []) + [JSON]
+
+
+def accepted(accept) -> dict:
+    """ Parse an Accept header into {media type: q}, folding the msgpack aliases together """
+    types = {}
+    for part in filter(None, (p.strip() for p in (accept or "").split(","))):
+        media_type, *params = (p.strip() for p in part.split(";"))
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        media_type = media_type.lower()
+        if media_type in MSGPACK_ALIASES:
+            media_type = MSGPACK
+        types[media_type] = max(q, types.get(media_type, 0.0))
+    return types
+
+
+def negotiate(accept, available=None) -> str:
+    """
+    msgpack if the client names it and likes it at least as much as JSON, otherwise JSON.
+    Wildcards only ever select JSON, so browsers and curl get something readable.
+    Raises HTTPNotAcceptable if the client sent an Accept that allows neither.
+    :param available: media types to choose from, MEDIA_TYPES if None
+    """
+    available = MEDIA_TYPES if available is None else available
+    types = accepted(accept)
+    if MSGPACK in available and types.get(MSGPACK, 0.0) > 0:
+        if types[MSGPACK] >= types.get(JSON, types.get("application/*", 0.0)):
+            return MSGPACK
+    if types and max(types.get(JSON, 0.0), types.get("application/*", 0.0), types.get("*/*", 0.0)) <= 0:
+        raise web.HTTPNotAcceptable(text=f"This API answers with {' or '.join(available)}")
+    return JSON
+
+
+def encode(payload, media_type=JSON) -> bytes:
+    if media_type == MSGPACK:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+async def decode(request) -> dict:
+    """ The body of an API request: JSON, msgpack or a form, by its Content-Type """
+    if request.content_type == JSON:
+        return await request.json()
+    if request.content_type in MSGPACK_ALIASES and msgpack is not None:
+        return msgpack.unpackb(await request.read(), raw=False)
+    return dict(await request.post())
+
+
+def api_response(request, payload, status=200, headers=None) -> web.Response:
+    """ Encode the payload in the media type the client negotiated """
+    media_type = negotiate(request.headers.get(hdrs.ACCEPT))
+    response = web.Response(status=status, body=encode(payload, media_type), headers=headers)
+    response.content_type = media_type
+    response.headers[hdrs.VARY] = hdrs.ACCEPT
+    return response
+
+
+def api_error(request, status, message) -> web.Response:
+    return api_response(request, {"error": message}, status=status)
@@ -0,0 +1,130 @@
+"""
+Dragon Cafe Load Balancing | Org: Alta3 Research Inc.
+
+Endpoint selection strategies shared by the Service Registry's /get_one and the
+gateway's discovery cache. A strategy picks one candidate out of a list; each
+candidate only needs two attributes:
+
+    load      requests the instance currently has outstanding
+    latency   exponentially weighted moving average of its response time, in seconds
+
+    random              uniform random pick
+    round_robin         each candidate in turn
+    least_outstanding   the candidate with the lowest load
+    p2c                 power of two choices: the less loaded of two random candidates
+    ewma                power of two choices on latency * (load + 1)
+"""
+
+import itertools
+import os
+import random
+
+EWMA_ALPHA = float(os.getenv("EWMA_ALPHA", 0.3))
+
+
+def ewma(average, sample, alpha=EWMA_ALPHA) -> float:
+    """ Fold a new sample into an exponentially weighted moving average """
+    if not average:
+        return sample
+    return alpha * sample + (1 - alpha) * average
+
+
+class Strategy:
+    name = None
+
+    def choose(self, candidates):
+        """ Pick one of a non-empty list of candidates """
+        raise NotImplementedError
+
+
+class RandomChoice(Strategy):
+    name = "random"
+
+    def choose(self, candidates):
+        return candidates[random.randrange(len(candidates))]
+
+
+class RoundRobin(Strategy):
+    name = "round_robin"
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def choose(self, candidates):
+        return candidates[next(self._counter) % len(candidates)]
+
+
+class LeastOutstanding(Strategy):
+    name = "least_outstanding"
+
+    def choose(self, candidates):
+        # Random tie break, so idle candidates share the traffic
+        return min(candidates, key=lambda c: (c.load, random.random()))
+
+
+class PowerOfTwo(Strategy):
+    name = "p2c"
+
+    def cost(self, candidate) -> float:
+        return candidate.load
+
+    def choose(self, candidates):
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if self.cost(first) <= self.cost(second) else second
+
+
+class EWMALatency(PowerOfTwo):
+    name = "ewma"
+
+    def cost(self, candidate) -> float:
+        return candidate.latency * (candidate.load + 1)
+
+
+STRATEGIES = {cls.name: cls for cls in (RandomChoice, RoundRobin, LeastOutstanding, PowerOfTwo, EWMALatency)}
+
+
+def get_strategy(name) -> Strategy:
+    """ Create a new strategy by name, e.g. get_strategy("p2c") """
+    try:
+        return STRATEGIES[name]()
+    except KeyError:
+        raise ValueError(f"Unknown balancing strategy {name}, expected one of {sorted(STRATEGIES)}")
+
+
+def parse_strategies(spec) -> dict:
+    """ Parse a per service setting such as "menu=p2c,login=round_robin" into {service: name} """
+    strategies = {}
+    for pair in filter(None, (p.strip() for p in (spec or "").split(","))):
+        service, _, name = pair.partition("=")
+        name = name.strip()
+        if name not in STRATEGIES:
+            raise ValueError(f"Unknown balancing strategy {name} for {service}")
+        strategies[service.strip()] = name
+    return strategies
+
+
+class Balancer:
+    def __init__(self, default="random", per_service=None):
+        """
+        Keep one strategy per service, since some strategies (round_robin) carry state
+        :param default: strategy used by services without their own setting
+        :param per_service: {service: strategy name}
+        """
+        get_strategy(default)
+        self.default = default
+        self.per_service = per_service or {}
+        self._strategies = {}
+
+    def strategy(self, service, name=None) -> Strategy:
+        name = name or self.per_service.get(service, self.default)
+        strategy = self._strategies.get((service, name))
+        if strategy is None:
+            strategy = self._strategies[(service, name)] = get_strategy(name)
+        return strategy
+
+    def choose(self, service, candidates, name=None):
+        if not candidates:
+            return None
+        return self.strategy(service, name).choose(candidates)
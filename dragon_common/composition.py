@@ -0,0 +1,97 @@
+"""
+Dragon Cafe Page Composition | Org: Alta3 Research Inc.
+
+index.html embeds the login, fortune cookie and menu pages as iframes, so every
+home page view costs the browser four round trips. With COMPOSE_HOME=true the
+server fetches the three pages itself, concurrently, and inlines their bodies
+into index_composed.html instead:
+
+    - each fragment gets COMPOSE_TIMEOUT seconds, or its own from
+      COMPOSE_TIMEOUTS, e.g. "menu=1,login=0.25"
+    - a fragment that fails or times out is replaced by the last copy that
+      rendered fine, so one slow service doesn't hold up or break the page
+"""
+
+import asyncio
+import logging
+import os
+import re
+
+from aiohttp import hdrs
+from multidict import CIMultiDict
+
+log = logging.getLogger(__name__)
+
+COMPOSE = os.getenv("COMPOSE_HOME", "false").lower() == "true"
+COMPOSE_TIMEOUT = float(os.getenv("COMPOSE_TIMEOUT", 0.5))
+COMPOSE_TIMEOUTS = os.getenv("COMPOSE_TIMEOUTS", "")
+
+BODY = re.compile(r"<body[^>]*>(.*)</body>", re.IGNORECASE | re.DOTALL)
+UNAVAILABLE = "<p>The {name} service is unavailable right now, please try again shortly.</p>"
+
+
+def parse_timeouts(spec) -> dict:
+    """ Parse a per fragment setting such as "menu=1,login=0.25" into {fragment: seconds} """
+    timeouts = {}
+    for pair in filter(None, (p.strip() for p in (spec or "").split(","))):
+        name, _, seconds = pair.partition("=")
+        timeouts[name.strip()] = float(seconds)
+    return timeouts
+
+
+def fragment_of(html) -> str:
+    """ The inside of a page's <body>, or the whole text if it has none """
+    match = BODY.search(html)
+    return match.group(1).strip() if match else html
+
+
+def handler_fragment(handler, request):
+    """
+    Wrap one of the app's own handlers as a fragment fetch, for the monoliths,
+    which compose by calling their handlers instead of going over the network
+    """
+    # Ask for the plain page, never a compressed variant or a 304
+    headers = CIMultiDict(request.headers)
+    headers.pop(hdrs.IF_NONE_MATCH, None)
+    headers[hdrs.ACCEPT_ENCODING] = "identity"
+    fragment_request = request.clone(headers=headers)
+
+    async def fetch() -> str:
+        response = await handler(fragment_request)
+        if response.status != 200:
+            raise ValueError(f"{handler.__name__} answered {response.status}")
+        return response.text
+
+    return fetch
+
+
+class Composer:
+    def __init__(self, timeout=COMPOSE_TIMEOUT, timeouts=None):
+        """
+        :param timeout: seconds each fragment may take
+        :param timeouts: {fragment: seconds} for fragments that need a different timeout
+        """
+        self.timeout = timeout
+        self.timeouts = parse_timeouts(COMPOSE_TIMEOUTS) if timeouts is None else timeouts
+        self.fallbacks = {}
+
+    async def compose(self, fetches, remember=True) -> dict:
+        """
+        Fetch every fragment at once and return {name: html body}
+        :param fetches: {name: coroutine function returning the fragment's page as a string}
+        :param remember: keep the fragments as fallbacks; False when they may be personal to the visitor
+        """
+        names = list(fetches)
+        bodies = await asyncio.gather(*(self.fragment(name, fetches[name], remember) for name in names))
+        return dict(zip(names, bodies))
+
+    async def fragment(self, name, fetch, remember=True) -> str:
+        try:
+            body = fragment_of(await asyncio.wait_for(fetch(), self.timeouts.get(name, self.timeout)))
+        except Exception as err:
+            # Any failure of one fragment must not fail the whole page
+            log.warning("Composing %s failed, using its fallback: %r", name, err)
+            return self.fallbacks.get(name, UNAVAILABLE.format(name=name))
+        if remember:
+            self.fallbacks[name] = body
+        return body
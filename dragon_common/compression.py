@@ -0,0 +1,165 @@
+"""
+Dragon Cafe Compression | Org: Alta3 Research Inc.
+
+Content-coding negotiation and compression shared by every service. gzip is
+always available; brotli and zstd are used when the brotli and zstandard
+packages are installed, as the services' requirements do.
+
+setup_compression() adds a middleware that compresses every response worth it:
+
+    - bodies of at least COMPRESS_MIN_SIZE bytes and a textual content type,
+      that the handler didn't compress or stream itself
+    - a response with an ETag is compressed once per coding: the variant is
+      kept in an LRU of COMPRESS_CACHE_BYTES and reused while the ETag holds.
+      The ETag is made weak, so If-None-Match still matches it.
+    - bodies of COMPRESS_THREAD_SIZE bytes or more are compressed in the
+      default thread pool, so a large page doesn't hold up the event loop
+"""
+
+import asyncio
+import collections
+import gzip
+import os
+
+from aiohttp import hdrs, web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", 5))
+ZSTD_LEVEL = int(os.getenv("COMPRESS_ZSTD_LEVEL", 3))
+MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 512))
+THREAD_SIZE = int(os.getenv("COMPRESS_THREAD_SIZE", 64 * 1024))
+CACHE_BYTES = int(os.getenv("COMPRESS_CACHE_BYTES", 16 * 1024 * 1024))
+
+# Codings this process can produce, best first
+CODINGS = (["br"] if brotli is not None else []) + (["zstd"] if zstandard is not None else []) + ["gzip"]
+COMPRESSIBLE = frozenset([
+    "text/html", "text/css", "text/plain", "text/xml", "text/javascript",
+    "application/json", "application/javascript", "application/xml", "image/svg+xml",
+])
+
+
+def compress(data: bytes, coding, level=None) -> bytes:
+    """
+    Compress data with one content-coding
+    :param level: gzip level or brotli quality, the module default if None
+    """
+    if coding == "gzip":
+        return gzip.compress(data, compresslevel=GZIP_LEVEL if level is None else level, mtime=0)
+    if coding == "br" and brotli is not None:
+        return brotli.compress(data, quality=BROTLI_QUALITY if level is None else level)
+    if coding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL if level is None else level).compress(data)
+    raise ValueError(f"Unsupported content-coding {coding}")
+
+
+def accepted(accept_encoding) -> dict:
+    """ Parse an Accept-Encoding header into {coding: q} """
+    codings = {}
+    for part in filter(None, (p.strip() for p in (accept_encoding or "").split(","))):
+        coding, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        codings[coding.strip().lower()] = q
+    return codings
+
+
+def negotiate(accept_encoding, available=CODINGS) -> str:
+    """ The first of the available codings the client accepts, or "identity" """
+    codings = accepted(accept_encoding)
+    wildcard = codings.get("*", 0.0)
+    for coding in available:
+        if codings.get(coding, wildcard) > 0:
+            return coding
+    return "identity"
+
+
+def weak(etag) -> str:
+    return etag if etag.startswith("W/") else f"W/{etag}"
+
+
+class Compressor:
+    def __init__(self, codings=CODINGS, min_size=MIN_SIZE, thread_size=THREAD_SIZE, cache_bytes=CACHE_BYTES):
+        """
+        :param codings: codings to offer, best first
+        :param min_size: smaller bodies are sent as they are
+        :param thread_size: larger bodies are compressed off the event loop
+        :param cache_bytes: total size of the compressed variants kept for responses with an ETag
+        """
+        self.codings = codings
+        self.min_size = min_size
+        self.thread_size = thread_size
+        self.cache_bytes = cache_bytes
+        self.size = 0
+        self._variants = collections.OrderedDict()
+
+    def compressible(self, request, response) -> bool:
+        return (type(response) is web.Response and not response.prepared and response.status == 200
+                and request.method != "HEAD" and hdrs.CONTENT_ENCODING not in response.headers
+                and response.content_type in COMPRESSIBLE and isinstance(response.body, (bytes, bytearray))
+                and len(response.body) >= self.min_size)
+
+    async def compress(self, body, coding) -> bytes:
+        if len(body) >= self.thread_size:
+            return await asyncio.get_event_loop().run_in_executor(None, compress, bytes(body), coding)
+        return compress(body, coding)
+
+    async def variant(self, body, coding, etag) -> bytes:
+        """ The compressed body, from the variant cache when the response has an ETag """
+        if not etag:
+            return await self.compress(body, coding)
+        key = (etag, coding, len(body))
+        data = self._variants.get(key)
+        if data is not None:
+            self._variants.move_to_end(key)
+            return data
+        data = await self.compress(body, coding)
+        if len(data) <= self.cache_bytes:
+            self._variants[key] = data
+            self.size += len(data)
+            while self.size > self.cache_bytes:
+                _, evicted = self._variants.popitem(last=False)
+                self.size -= len(evicted)
+        return data
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """ Compress the handler's response in the best coding the client accepts """
+        response = await handler(request)
+        if not self.compressible(request, response):
+            return response
+        vary = response.headers.get(hdrs.VARY, "")
+        if "accept-encoding" not in vary.lower():
+            response.headers[hdrs.VARY] = f"{vary}, {hdrs.ACCEPT_ENCODING}" if vary else hdrs.ACCEPT_ENCODING
+        coding = negotiate(request.headers.get(hdrs.ACCEPT_ENCODING), self.codings)
+        if coding == "identity":
+            return response
+        etag = response.headers.get(hdrs.ETAG)
+        data = await self.variant(response.body, coding, etag)
+        if len(data) >= len(response.body):
+            return response
+        response.body = data
+        response.headers[hdrs.CONTENT_ENCODING] = coding
+        if etag:
+            response.headers[hdrs.ETAG] = weak(etag)
+        return response
+
+
+def setup_compression(app: web.Application, key="compressor", **kwargs) -> None:
+    """ Compress the app's responses; the Compressor is available as app[key] """
+    app[key] = Compressor(**kwargs)
+    app.middlewares.append(app[key].middleware)
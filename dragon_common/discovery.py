@@ -0,0 +1,261 @@
+"""
+Dragon Cafe Service Discovery Cache | Org: Alta3 Research Inc.
+
+Asking the Service Registry /get_one/{service} before every proxied request
+doubles the latency of a page view. The DiscoveryCache keeps each service's
+endpoint list locally instead:
+
+    - entries expire after a TTL and are refreshed in the background, in one
+      bulk lookup per batch, so callers are served the last known list while
+      the refresh runs
+    - services with live endpoints are watched by long-polling the
+      registry's /watch/{service}, so changes are pushed within one round trip
+    - endpoints are picked locally, without touching the network, by the
+      service's balancing strategy (see dragon_common.balancing) using the
+      load and latency this process has observed for each endpoint
+    - a service the registry has no instances of gets no entry or watcher, only
+      a bounded note of the miss, so requests for made-up names cost no memory
+"""
+
+import asyncio
+import collections
+import logging
+import os
+import time
+
+import aiohttp
+from aiohttp import web
+
+from dragon_common.balancing import Balancer, ewma, parse_strategies
+
+log = logging.getLogger(__name__)
+
+DISCOVERY_TTL = float(os.getenv("DISCOVERY_TTL", 30))
+DISCOVERY_WATCH = os.getenv("DISCOVERY_WATCH", "true").lower() != "false"
+WATCH_TIMEOUT = float(os.getenv("DISCOVERY_WATCH_TIMEOUT", 25))
+WATCH_RETRY = float(os.getenv("DISCOVERY_WATCH_RETRY", 2))
+# An empty list isn't watched, so it is looked up again this often while callers ask for it
+EMPTY_RETRY = float(os.getenv("DISCOVERY_EMPTY_RETRY", 1))
+# Names the registry has no instances of, e.g. from scans of random paths, are remembered
+# only that long, and only this many of them
+MISSING_MAX = int(os.getenv("DISCOVERY_MISSING_MAX", 1024))
+DISCOVERY_STRATEGY = os.getenv("DISCOVERY_STRATEGY", "random")
+DISCOVERY_STRATEGIES = os.getenv("DISCOVERY_STRATEGIES", "")
+
+
+class NoEndpoints(LookupError):
+    """ Raised when the registry knows of no live instance of a service """
+
+
+class Endpoint:
+    """ One instance of a service, with the load and latency this process has seen from it """
+    __slots__ = ("ip", "port", "load", "latency")
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.load = 0
+        self.latency = 0.0
+
+    def __iter__(self):
+        # Unpacks like the (ip, port) pairs the registry hands out
+        return iter((self.ip, self.port))
+
+    def __repr__(self):
+        return f"{self.ip}:{self.port}"
+
+    def started(self) -> float:
+        """ Count a request to this endpoint as outstanding; pass the result to finished() """
+        self.load += 1
+        return time.monotonic()
+
+    def finished(self, started, elapsed=None) -> None:
+        """
+        :param elapsed: the latency to record, if not the time since started, e.g. until the response headers
+        """
+        self.load -= 1
+        self.latency = ewma(self.latency, time.monotonic() - started if elapsed is None else elapsed)
+
+
+class _Entry:
+    __slots__ = ("endpoints", "version", "fetched")
+
+    def __init__(self, endpoints, version):
+        self.endpoints = endpoints
+        self.version = version
+        self.fetched = time.monotonic()
+
+
+class DiscoveryCache:
+    def __init__(self, session: aiohttp.ClientSession, registry_url, ttl=DISCOVERY_TTL, watch=DISCOVERY_WATCH,
+                 balancer=None):
+        """
+        :param session: client session used to talk to the registry
+        :param registry_url: base url of the Service Registry, e.g. http://127.0.0.1:55555
+        :param ttl: seconds an endpoint list is served before it is refreshed
+        :param watch: long-poll the registry for changes to every service in use
+        :param balancer: picks an endpoint per service, DISCOVERY_STRATEGY by default
+        """
+        self.session = session
+        self.registry_url = registry_url.rstrip("/")
+        self.ttl = ttl
+        self.watch = watch
+        self.balancer = balancer or Balancer(DISCOVERY_STRATEGY, parse_strategies(DISCOVERY_STRATEGIES))
+        self._entries = {}
+        self._known = {}
+        self._missing = collections.OrderedDict()
+        self._refreshing = {}
+        self._watchers = {}
+        self._stale = set()
+        self._batch = None
+
+    async def endpoints(self, service) -> list:
+        """ Return the cached Endpoints of a service, fetching them on first use """
+        entry = self._entries.get(service)
+        if entry is None:
+            missed = self._missing.get(service)
+            if missed is not None and time.monotonic() - missed <= EMPTY_RETRY:
+                return []
+            entry = await self.refresh(service)
+        elif not entry.endpoints and time.monotonic() - entry.fetched > EMPTY_RETRY:
+            entry = await self.refresh(service)
+        elif time.monotonic() - entry.fetched > self.ttl:
+            self._stale.add(service)
+            if self._batch is None:
+                self._batch = asyncio.ensure_future(self._refresh_stale())
+        return entry.endpoints
+
+    async def choose(self, service, exclude=(), available=None) -> Endpoint:
+        """
+        Pick one live endpoint of a service; it unpacks as (ip, port)
+        :param exclude: endpoints not to pick, e.g. the ones a retry already tried
+        :param available: predicate that rules endpoints out, e.g. ones a circuit breaker ejected.
+                          Ignored if it would rule out every endpoint, since a suspect endpoint beats none.
+        """
+        candidates = await self.endpoints(service)
+        if exclude:
+            candidates = [e for e in candidates if e not in exclude]
+        if available is not None:
+            candidates = [e for e in candidates if available(e)] or candidates
+        if not candidates:
+            raise NoEndpoints(service)
+        return self.balancer.choose(service, candidates)
+
+    async def refresh(self, service) -> _Entry:
+        """ Fetch the endpoint list now, sharing a fetch that is already in flight """
+        task = self._refreshing.get(service)
+        if task is None:
+            task = self._refreshing[service] = asyncio.ensure_future(self._fetch(service))
+        return await asyncio.shield(task)
+
+    async def refresh_many(self, services) -> None:
+        """ Fetch the endpoint lists of many services in one registry round trip """
+        async with self.session.post(f"{self.registry_url}/bulk/get", json={"services": list(services)}) as r:
+            r.raise_for_status()
+            data = await r.json()
+        for service, resolved in data["services"].items():
+            self._store(service, resolved)
+
+    def invalidate(self, service=None) -> None:
+        """ Forget one service, or every service, so the next lookup goes to the registry """
+        if service is None:
+            self._entries.clear()
+            self._missing.clear()
+        else:
+            self._entries.pop(service, None)
+            self._missing.pop(service, None)
+
+    async def close(self) -> None:
+        tasks = list(self._watchers.values()) + list(self._refreshing.values())
+        if self._batch is not None:
+            tasks.append(self._batch)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _refresh_stale(self) -> None:
+        """ Refresh every entry that expired during this turn of the loop in a single bulk lookup """
+        try:
+            await asyncio.sleep(0)
+            services, self._stale = self._stale, set()
+            await self.refresh_many(services)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as err:
+            # Keep serving what we had until the registry answers again
+            log.warning("Refreshing %s failed: %r", sorted(services), err)
+        finally:
+            self._batch = None
+
+    async def _fetch(self, service) -> _Entry:
+        try:
+            async with self.session.get(f"{self.registry_url}/get/{service}") as r:
+                r.raise_for_status()
+                data = await r.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+            # Keep serving what we had; only a first lookup surfaces the failure
+            log.warning("Discovery of %s failed: %r", service, err)
+            if service not in self._entries:
+                raise
+            return self._entries[service]
+        finally:
+            self._refreshing.pop(service, None)
+        return self._store(service, data)
+
+    def _store(self, service, data) -> _Entry:
+        if not data["endpoints"] and service not in self._entries:
+            # Only services that have had instances get an entry and a watcher, so looking up
+            # arbitrary names can't grow the cache without bound
+            self._missing[service] = time.monotonic()
+            self._missing.move_to_end(service)
+            while len(self._missing) > MISSING_MAX:
+                self._missing.popitem(last=False)
+            return _Entry([], data.get("version"))
+        self._missing.pop(service, None)
+        # Reuse the Endpoint of an instance we already know, so its load and latency carry over
+        known = self._known.setdefault(service, {})
+        endpoints = []
+        for ip, port in data["endpoints"]:
+            endpoint = known.get((ip, port))
+            if endpoint is None:
+                endpoint = known[(ip, port)] = Endpoint(ip, port)
+            endpoints.append(endpoint)
+        for key in set(known) - {(e.ip, e.port) for e in endpoints}:
+            del known[key]
+        entry = self._entries[service] = _Entry(endpoints, data.get("version"))
+        if self.watch and entry.endpoints and service not in self._watchers:
+            self._watchers[service] = asyncio.ensure_future(self._watch(service))
+        return entry
+
+    async def _watch(self, service) -> None:
+        """ Long-poll the registry and store every new version of the service as it is pushed """
+        timeout = aiohttp.ClientTimeout(total=WATCH_TIMEOUT + 5, sock_read=WATCH_TIMEOUT + 5)
+        while True:
+            entry = self._entries.get(service)
+            params = {"timeout": str(WATCH_TIMEOUT)}
+            if entry is not None and entry.version is not None:
+                params["version"] = entry.version
+            try:
+                async with self.session.get(f"{self.registry_url}/watch/{service}", params=params,
+                                            timeout=timeout) as r:
+                    r.raise_for_status()
+                    data = await r.json()
+                self._store(service, data)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+                log.warning("Watching %s failed, retrying in %ss: %r", service, WATCH_RETRY, err)
+                await asyncio.sleep(WATCH_RETRY)
+            except Exception:
+                # e.g. a malformed reply; the watch must outlive it or the service's endpoints go stale
+                log.exception("Watching %s failed, retrying in %ss", service, WATCH_RETRY)
+                await asyncio.sleep(WATCH_RETRY)
+
+
+def setup_discovery(app: web.Application, registry_url, key="discovery", session_key="client_session", **kwargs) -> None:
+    """
+    Create a DiscoveryCache when the app starts and stop its watchers on cleanup.
+    Must be set up after setup_client_session(), whose session it shares.
+    """
+    async def discovery_ctx(app):
+        app[key] = DiscoveryCache(app[session_key], registry_url, **kwargs)
+        yield
+        await app[key].close()
+
+    app.cleanup_ctx.append(discovery_ctx)
@@ -0,0 +1,282 @@
+"""
+Dragon Cafe Fortune Pool | Org: Alta3 Research Inc.
+
+The fortune service loads its corpus once and hands out ready-made pages:
+
+    - the corpus is the built-in FORTUNES, a text file with one fortune per
+      line, or a SQLite table, chosen by FORTUNE_SOURCE:
+          ""                         the built-in list
+          /path/fortunes.txt         a text file, which may hold millions of lines
+          sqlite:/path/fortunes.db   the "text" column of the fortunes table
+          sqlite:/path/db:my_table   ... or of another table
+    - corpora of up to FORTUNE_PRERENDER_MAX fortunes are rendered to bytes at
+      startup; larger ones are rendered on demand and kept in an LRU cache of
+      FORTUNE_CACHE_SIZE pages
+    - a random pick is one randrange() and a list index
+    - ?seed= always picks the same fortune for the same seed, and FORTUNE_SEED
+      makes the random sequence reproducible
+    - with FORTUNE_SELECTION=session each visitor walks a permutation of the
+      whole corpus, so no fortune repeats until they have seen them all. The
+      permutation is a full period LCG, so its whole state fits in a cookie.
+    - api_response() picks the same way and answers with JSON or msgpack
+"""
+
+import array
+import functools
+import logging
+import mmap
+import os
+import random
+import sqlite3
+import zlib
+
+from aiohttp import hdrs, web
+from markupsafe import escape
+
+from dragon_common.api import api_response
+from dragon_common.templating import TEMPLATES_DIR, get_engine
+
+log = logging.getLogger(__name__)
+
+FORTUNE_SOURCE = os.getenv("FORTUNE_SOURCE", "")
+FORTUNE_PRERENDER_MAX = int(os.getenv("FORTUNE_PRERENDER_MAX", 10000))
+FORTUNE_CACHE_SIZE = int(os.getenv("FORTUNE_CACHE_SIZE", 4096))
+FORTUNE_SEED = os.getenv("FORTUNE_SEED")
+FORTUNE_SELECTION = os.getenv("FORTUNE_SELECTION", "random")
+DECK_COOKIE = "fortune_deck"
+# Knuth's MMIX multiplier; it is 1 mod 4, which a full period LCG modulo a power of two needs
+LCG_MULTIPLIER = 6364136223846793005
+
+FORTUNES = (
+    "People are naturally attracted to you.",
+    "You learn from your mistakes... You will learn a lot today.",
+    "If you have something good in your life, don't let it go!",
+    "What ever you're goal is in life, embrace it visualize it, and for it will be yours.",
+    "Your shoes will make you happy today.",
+    "You cannot love life until you live the life you love.",
+    "Be on the lookout for coming events; They cast their shadows beforehand.",
+    "Land is always on the mind of a flying bird.",
+    "The man or woman you desire feels the same about you.",
+    "Meeting adversity well is the source of your strength.",
+    "A dream you have will come true.",
+    "Our deeds determine us, as much as we determine our deeds.",
+    "Never give up. You're not a failure if you don't give up.",
+    "You will become great if you believe in yourself.",
+    "There is no greater pleasure than seeing your loved ones prosper.",
+    "You will marry your lover.",
+    "A very attractive person has a message for you.",
+    "You already know the answer to the questions lingering inside your head.",
+    "It is now, and in this world, that we must live.",
+    "You must try, or hate yourself for not trying.",
+    "You can make your own happiness.",
+    "The greatest risk is not taking one.",
+    "The love of your life is stepping into your planet this summer.",
+    "Love can last a lifetime, if you want it to.",
+    "Adversity is the parent of virtue.",
+    "Serious trouble will bypass you.",
+    "A short stranger will soon enter your life with blessings to share.",
+    "Now is the time to try something new.",
+    "Wealth awaits you very soon.",
+    "If you feel you are right, stand firmly by your convictions.",
+    "If winter comes, can spring be far behind?",
+    "Keep your eye out for someone special.",
+    "You are very talented in many ways.",
+    "A stranger, is a friend you have not spoken to yet.",
+    "A new voyage will fill your life with untold memories.",
+    "You will travel to many exotic places in your lifetime.",
+    "Your ability for accomplishment will follow with success.",
+    "Nothing astonishes men so much as common sense and plain dealing.",
+    "Its amazing how much good you can do if you do not care who gets the credit.",
+    "Everyone agrees. You are the best.",
+    "Life consist not in holding good cards, but in playing those you hold well.",
+    "Jealousy doesn't open doors, it closes them!",
+    "It's better to be alone sometimes.",
+    "When fear hurts you, conquer it and defeat it!",
+    "Let the deeds speak.",
+    "You will be called in to fulfill a position of high honor and responsibility.",
+    "The man on the top of the mountain did not fall there.",
+    "You will conquer obstacles to achieve success.",
+    "Joys are often the shadows, cast by sorrows.",
+    "Fortune favors the brave.",
+)
+
+
+class FileCorpus:
+    """ A text file with one fortune per line, read through mmap so only an index of line offsets is in memory """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+        self._starts = array.array("q")
+        self._ends = array.array("q")
+        start, size = 0, len(self._map)
+        while start < size:
+            end = self._map.find(b"\n", start)
+            end = size if end < 0 else end
+            if self._map[start:end].strip():
+                self._starts.append(start)
+                self._ends.append(end)
+            start = end + 1
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, index) -> str:
+        return self._map[self._starts[index]:self._ends[index]].decode("utf-8").strip()
+
+
+class SQLiteCorpus:
+    """
+    The text column of a SQLite table; only the rowids are held in memory.
+    Lookups use the standard library driver on the event loop: a rowid lookup
+    takes microseconds, less than handing it to a thread would.
+    """
+
+    def __init__(self, path, table="fortunes"):
+        if not table.isidentifier():
+            raise ValueError(f"{table} is not a valid table name")
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._query = f"SELECT text FROM {table} WHERE rowid = ?"
+        self._rowids = array.array("q", (row[0] for row in self._db.execute(f"SELECT rowid FROM {table}")))
+
+    def __len__(self):
+        return len(self._rowids)
+
+    def __getitem__(self, index) -> str:
+        return self._db.execute(self._query, (self._rowids[index],)).fetchone()[0]
+
+
+def open_corpus(source=FORTUNE_SOURCE):
+    """ Open the corpus FORTUNE_SOURCE describes; see the module docstring """
+    if not source:
+        return FORTUNES
+    if source.startswith("sqlite:"):
+        path, _, table = source[len("sqlite:"):].partition(":")
+        return SQLiteCorpus(path, table or "fortunes")
+    return FileCorpus(source)
+
+
+def mix(seed) -> int:
+    """ splitmix64, so nearby seeds pick unrelated fortunes """
+    z = (seed + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return z ^ (z >> 31)
+
+
+class FortunePool:
+    def __init__(self, source=FORTUNE_SOURCE, filename="fortune.html", templates_dir=TEMPLATES_DIR,
+                 prerender_max=FORTUNE_PRERENDER_MAX, cache_size=FORTUNE_CACHE_SIZE, seed=FORTUNE_SEED,
+                 selection=FORTUNE_SELECTION):
+        """
+        :param source: where the corpus comes from, see open_corpus()
+        :param filename: template each fortune is rendered with
+        :param prerender_max: render every page up front if the corpus is no larger than this
+        :param cache_size: rendered pages kept when the corpus is too large to render up front
+        :param seed: seed of the random sequence, for reproducible runs
+        :param selection: "random", or "session" for a non-repeating walk per visitor
+        """
+        self.source = source
+        self.filename = filename
+        self.templates_dir = templates_dir
+        self.prerender_max = prerender_max
+        self.cache_size = cache_size
+        self.selection = selection
+        self.rng = random.Random(seed)
+        self.corpus = ()
+        self._pages = None
+        self._cached_page = None
+        self._modulus = 1
+        self._headers = {hdrs.CONTENT_TYPE: "text/html; charset=utf-8"}
+
+    def load(self) -> None:
+        """ Open the corpus and render its pages, or set up the page cache for a large corpus """
+        self.corpus = open_corpus(self.source)
+        if not len(self.corpus):
+            raise ValueError(f"The fortune corpus {self.source or 'FORTUNES'} is empty")
+        self._modulus = 1 << max(2, (len(self.corpus) - 1).bit_length())
+        if len(self.corpus) <= self.prerender_max:
+            self._pages = [self.render(i) for i in range(len(self.corpus))]
+        else:
+            self._cached_page = functools.lru_cache(maxsize=self.cache_size)(self.render)
+        log.info("Loaded %d fortunes from %s", len(self.corpus), self.source or "FORTUNES")
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def page(self, index) -> bytes:
+        """ The rendered page of one fortune """
+        if self._pages is not None:
+            return self._pages[index]
+        return self._cached_page(index)
+
+    def render(self, index) -> bytes:
+        template = get_engine(self.templates_dir).get(self.filename)
+        return template.render({"fortune": escape(self.corpus[index])}).encode("utf-8")
+
+    def random_index(self) -> int:
+        return self.rng.randrange(len(self.corpus))
+
+    def seeded_index(self, seed) -> int:
+        """ The same fortune for the same seed, as long as the corpus doesn't change """
+        # isdigit() alone also accepts digits int() rejects, such as "²"
+        number = int(seed) if seed.isascii() and seed.isdigit() else zlib.crc32(seed.encode("utf-8"))
+        return mix(number) % len(self.corpus)
+
+    def next_in_deck(self, deck):
+        """
+        The next fortune of a visitor's permutation of the corpus
+        :param deck: the visitor's cookie, or None to deal a new permutation
+        :return: (index, new cookie value)
+        """
+        size, modulus = len(self.corpus), self._modulus
+        try:
+            dealt, increment, state = (int(part, 16) for part in deck.split("."))
+            if dealt != size or not increment & 1 or not 0 <= state < modulus:
+                raise ValueError(deck)
+        except (AttributeError, ValueError):
+            increment = self.rng.randrange(modulus) | 1
+            state = self.rng.randrange(modulus)
+        # Walk the full period sequence, skipping the values past the end of the corpus
+        multiplier = LCG_MULTIPLIER % modulus
+        state = (multiplier * state + increment) % modulus
+        while state >= size:
+            state = (multiplier * state + increment) % modulus
+        return state, f"{size:x}.{increment:x}.{state:x}"
+
+    def pick(self, request):
+        """
+        The fortune for a request, by ?seed=, the visitor's deck, or at random
+        :return: (index, new deck cookie value or None)
+        """
+        seed = request.query.get("seed")
+        if seed is not None:
+            return self.seeded_index(seed), None
+        if self.selection == "session":
+            return self.next_in_deck(request.cookies.get(DECK_COOKIE))
+        return self.random_index(), None
+
+    def response(self, request) -> web.Response:
+        """ A pre-rendered fortune page """
+        index, deck = self.pick(request)
+        response = web.Response(body=self.page(index), headers=self._headers)
+        if deck is not None:
+            response.set_cookie(DECK_COOKIE, deck, httponly=True, samesite="Lax")
+        return response
+
+    def api_response(self, request) -> web.Response:
+        """ The same fortune as JSON, or msgpack if asked for """
+        index, deck = self.pick(request)
+        response = api_response(request, {"index": index, "fortune": self.corpus[index]})
+        if deck is not None:
+            response.set_cookie(DECK_COOKIE, deck, httponly=True, samesite="Lax")
+        return response
+
+
+def setup_fortunes(app: web.Application, key="fortunes", **kwargs) -> None:
+    """ Load the fortune pool when the app starts; handlers use request.app[key].response(request) """
+    async def load_fortunes(app):
+        app[key] = FortunePool(**kwargs)
+        app[key].load()
+
+    app.on_startup.append(load_fortunes)
@@ -0,0 +1,55 @@
+"""
+Dragon Cafe HTTP Client | Org: Alta3 Research Inc.
+
+A blocking requests.get() inside an aiohttp handler stalls the whole event loop,
+so services talk to each other through one keep-alive aiohttp.ClientSession that
+lives as long as the application does.
+"""
+
+import os
+
+import aiohttp
+from aiohttp import web
+
+CONN_LIMIT = int(os.getenv("HTTP_CONN_LIMIT", 100))
+CONN_LIMIT_PER_HOST = int(os.getenv("HTTP_CONN_LIMIT_PER_HOST", 20))
+DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 2))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 10))
+TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", 30))
+
+
+def client_session(limit=CONN_LIMIT, limit_per_host=CONN_LIMIT_PER_HOST, dns_cache_ttl=DNS_CACHE_TTL,
+                   keepalive_timeout=KEEPALIVE_TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+                   read_timeout=READ_TIMEOUT, total_timeout=TOTAL_TIMEOUT, auto_decompress=True) -> aiohttp.ClientSession:
+    """
+    Create a pooled, keep-alive client session. Must be called from inside the running loop.
+    :param limit: total number of open connections across all hosts
+    :param limit_per_host: open connections to any one ip:port
+    :param dns_cache_ttl: seconds a resolved host name is reused
+    :param keepalive_timeout: seconds an idle connection is kept in the pool
+    :param auto_decompress: turn off to pass compressed bodies through untouched, e.g. in a proxy
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=dns_cache_ttl,
+        keepalive_timeout=keepalive_timeout,
+    )
+    timeout = aiohttp.ClientTimeout(total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=auto_decompress)
+
+
+def setup_client_session(app: web.Application, key="client_session", **kwargs) -> None:
+    """
+    Open a client session when the app starts and close it on cleanup.
+    The session is available to handlers as request.app[key].
+    """
+    async def session_ctx(app):
+        app[key] = client_session(**kwargs)
+        yield
+        await app[key].close()
+
+    app.cleanup_ctx.append(session_ctx)
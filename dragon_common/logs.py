@@ -0,0 +1,135 @@
+"""
+Dragon Cafe Logging | Org: Alta3 Research Inc.
+
+Handlers used to print() every request, which is a blocking write to stdout, or
+to syslog under systemd, on the event loop. setup_logging() routes every log
+record through a queue instead, and a background thread does the writing:
+
+    - LOG_LEVEL sets the level; records below it cost one integer comparison
+    - LOG_FORMAT=json writes one JSON object per line, text is the default
+    - the queue holds LOG_QUEUE_SIZE records; past that, records are dropped
+      and counted rather than letting a slow log sink stall requests
+    - SampledAccessLogger logs one line per request, a LOG_ACCESS_SAMPLE share
+      of them, or per route from LOG_ACCESS_SAMPLES, e.g. "menu=0.01,login=1".
+      Failed requests are always logged.
+    - names and other personal data go through redact() before they are logged;
+      the loggers in LOG_QUIET, which log query parameters at debug level, are
+      held at WARNING whatever LOG_LEVEL is
+"""
+
+import atexit
+import datetime
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+from aiohttp.abc import AbstractAccessLogger
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_ACCESS = os.getenv("LOG_ACCESS", "true").lower() != "false"
+LOG_ACCESS_SAMPLE = float(os.getenv("LOG_ACCESS_SAMPLE", 1))
+LOG_ACCESS_SAMPLES = os.getenv("LOG_ACCESS_SAMPLES", "")
+LOG_QUIET = os.getenv("LOG_QUIET", "aiosqlite").split(",")
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+# Attributes every LogRecord has; anything else was passed in extra= and goes into the JSON
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_samples(spec) -> dict:
+    """ Parse a per route setting such as "menu=0.01,login=1" into {route: share of requests logged} """
+    samples = {}
+    for pair in filter(None, (p.strip() for p in (spec or "").split(","))):
+        route, _, share = pair.partition("=")
+        samples[route.strip().strip("/")] = float(share)
+    return samples
+
+
+def redact(value) -> str:
+    """ A stable stand-in for personal data such as a name: the same value always redacts the same way """
+    if not value:
+        return "-"
+    return "user#" + hashlib.blake2b(str(value).encode("utf-8"), digest_size=4).hexdigest()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, separators=(",", ":"))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ A QueueHandler that drops records when the queue is full instead of raising """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Format the message now, while its args are still the objects they were when logged
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+
+_listener = None
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, queue_size=LOG_QUEUE_SIZE) -> None:
+    """ Send every log record through a queue to a thread that writes them to stdout; safe to call twice """
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.Queue(queue_size)
+    root = logging.getLogger()
+    root.handlers[:] = [DroppingQueueHandler(log_queue)]
+    root.setLevel(level)
+    for name in filter(None, LOG_QUIET):
+        logging.getLogger(name.strip()).setLevel(logging.WARNING)
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+class SampledAccessLogger(AbstractAccessLogger):
+    """ One structured line per request, sampled per route; pass as web.run_app(access_log_class=...) """
+
+    samples = parse_samples(LOG_ACCESS_SAMPLES)
+
+    def log(self, request, response, time) -> None:
+        if not LOG_ACCESS or not self.logger.isEnabledFor(logging.INFO):
+            return
+        if response.status < 500:
+            share = self.samples.get(request.path.strip("/").split("/", 1)[0], LOG_ACCESS_SAMPLE)
+            if share < 1 and random.random() >= share:
+                return
+        # The path only: query strings and headers may carry personal data
+        self.logger.info("%s %s %s %s %.1fms", request.remote, request.method, request.path, response.status,
+                         time * 1000, extra={"remote": request.remote, "method": request.method,
+                                             "path": request.path, "status": response.status,
+                                             "bytes": response.body_length, "ms": round(time * 1000, 3)})
@@ -0,0 +1,163 @@
+"""
+Dragon Cafe Service Registry Client | Org: Alta3 Research Inc.
+
+Registers a service with the Service Registry and keeps it registered:
+
+    - registration runs in the background with exponential backoff, so a
+      registry that is down or slow never holds up the service's startup
+    - a heartbeat is sent every HEARTBEAT_INTERVAL seconds over one persistent
+      session, so the registry's reaper doesn't expire the instance
+    - a heartbeat answered with 404 means the registry no longer knows the
+      instance (it restarted, or reaped us), so the instance registers again
+    - every heartbeat reports the instance's load (requests in flight) and its
+      average response time, which the registry's balancing strategies use
+    - the instance is removed from the registry when the app shuts down
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+
+from dragon_common.balancing import ewma
+from dragon_common.http_client import client_session
+
+log = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = float(os.getenv("SR_HEARTBEAT_INTERVAL", 10))
+RETRY_BASE = float(os.getenv("SR_RETRY_BASE", 0.5))
+RETRY_MAX = float(os.getenv("SR_RETRY_MAX", 30))
+DEREGISTER_TIMEOUT = float(os.getenv("SR_DEREGISTER_TIMEOUT", 2))
+
+
+class RegistryClient:
+    def __init__(self, service, ip, port, registry_url, interval=HEARTBEAT_INTERVAL):
+        """
+        :param service: name the instance is registered under
+        :param ip: address other services should use to reach this instance
+        :param port: port this instance listens on
+        :param registry_url: base url of the Service Registry, e.g. http://127.0.0.1:55555
+        :param interval: seconds between heartbeats
+        """
+        self.service = service
+        self.ip = ip
+        self.port = port
+        self.registry_url = registry_url.rstrip("/")
+        self.interval = interval
+        self.registered = False
+        self.outstanding = 0
+        self.latency = 0.0
+        self._session = None
+        self._task = None
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """ Track the requests in flight and their average response time, to report with heartbeats """
+        self.outstanding += 1
+        started = time.monotonic()
+        try:
+            return await handler(request)
+        finally:
+            self.outstanding -= 1
+            self.latency = ewma(self.latency, time.monotonic() - started)
+
+    @property
+    def _path(self) -> str:
+        return f"{self.service}/{self.ip}/{self.port}"
+
+    async def start(self) -> None:
+        """ Start registering and heartbeating in the background; returns immediately """
+        log.info("Adding %s at %s:%s to the Service Registry %s", self.service, self.ip, self.port, self.registry_url)
+        self._session = client_session()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """ Stop heartbeating and remove this instance from the registry """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._session is None:
+            return
+        if self.registered:
+            try:
+                async with self._session.get(f"{self.registry_url}/remove/{self._path}",
+                                             timeout=aiohttp.ClientTimeout(total=DEREGISTER_TIMEOUT)) as r:
+                    log.info("Removed from the Service Registry: %s", r.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                log.warning("Could not remove %s from the Service Registry: %r", self._path, err)
+            self.registered = False
+        await self._session.close()
+
+    async def _run(self) -> None:
+        await self._register()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                status = await self._heartbeat()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                log.warning("Heartbeat to the Service Registry failed: %r", err)
+                continue
+            except Exception:
+                # The registry evicts an instance that stops sending heartbeats, so never let the loop end
+                log.exception("Heartbeat to the Service Registry failed")
+                continue
+            if status == 404:
+                log.warning("The Service Registry no longer knows this instance, registering again")
+                self.registered = False
+                await self._register()
+
+    async def _register(self) -> None:
+        """ Keep trying to register, backing off exponentially (with jitter) between attempts """
+        delay = RETRY_BASE
+        while True:
+            try:
+                async with self._session.get(f"{self.registry_url}/add/{self._path}") as r:
+                    r.raise_for_status()
+                    log.info("Registered with the Service Registry: %s", r.status)
+                    self.registered = True
+                    return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                wait = random.uniform(delay / 2, delay)
+                log.warning("Registering with the Service Registry failed, retrying in %.1fs: %r", wait, err)
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, RETRY_MAX)
+
+    async def _heartbeat(self) -> int:
+        params = {"load": str(self.outstanding), "latency": f"{self.latency:.6f}"}
+        async with self._session.get(f"{self.registry_url}/heartbeat/{self._path}", params=params) as r:
+            return r.status
+
+
+async def bulk(session: aiohttp.ClientSession, registry_url, action, instances) -> dict:
+    """
+    Apply one batch to the registry in a single round trip and a single transaction,
+    e.g. to register a whole fleet at deploy time.
+    :param action: "add", "heartbeat" or "remove"
+    :param instances: [{"service": ..., "ip": ..., "port": ...}, ...]; heartbeats may add "load" and "latency"
+    """
+    async with session.post(f"{registry_url.rstrip('/')}/bulk/{action}", json={"instances": instances}) as r:
+        r.raise_for_status()
+        return await r.json()
+
+
+def setup_registration(app: web.Application, service, ip, port, registry_url, key="registry_client") -> None:
+    """
+    Register the app with the Service Registry on startup and remove it on shutdown,
+    and measure the load it reports. Must be called before the app starts.
+    The client is available to handlers as request.app[key].
+    """
+    app[key] = RegistryClient(service, ip, port, registry_url)
+    app.middlewares.append(app[key].middleware)
+
+    async def start_registration(app):
+        await app[key].start()
+
+    async def stop_registration(app):
+        await app[key].stop()
+
+    app.on_startup.append(start_registration)
+    app.on_shutdown.append(stop_registration)
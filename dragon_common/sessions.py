@@ -0,0 +1,206 @@
+"""
+Dragon Cafe Sessions | Org: Alta3 Research Inc.
+
+The login service signs a session cookie when a visitor logs in. The cookie
+carries the session id, the visitor's name and an expiry, and is signed with
+HMAC-SHA256 under DRAGON_SESSION_SECRET, so any service that shares the secret
+can tell who a request is from with one HMAC and no call back to login. The
+secret is required: login and the gateway refuse to start without it.
+
+The login service also keeps each session in a store, so it can end sessions:
+
+    SESSION_STORE=""                   an in-memory LRU of SESSION_MAX sessions
+    SESSION_STORE=sqlite:/path/db      a SQLite table, shared by every instance
+                                       and kept across restarts
+"""
+
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+import aiosqlite
+from aiohttp import web
+
+SESSION_COOKIE = os.getenv("SESSION_COOKIE", "dragon_session")
+SESSION_TTL = int(os.getenv("SESSION_TTL", 8 * 60 * 60))
+SESSION_STORE = os.getenv("SESSION_STORE", "")
+SESSION_MAX = int(os.getenv("SESSION_MAX", 100000))
+SESSION_SECRET = os.getenv("DRAGON_SESSION_SECRET", "")
+# The SHA-256 block holds 64 bytes; fewer than 32 random ones is guessable
+MIN_SECRET_BYTES = 32
+
+
+class Session:
+    __slots__ = ("id", "name", "expires")
+
+    def __init__(self, id, name, expires):
+        self.id = id
+        self.name = name
+        self.expires = expires
+
+    @classmethod
+    def new(cls, name, ttl=SESSION_TTL) -> "Session":
+        return cls(secrets.token_urlsafe(16), name, int(time.time()) + ttl)
+
+    def expired(self, now=None) -> bool:
+        return (now or time.time()) >= self.expires
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class SessionSigner:
+    def __init__(self, secret=SESSION_SECRET):
+        """
+        :param secret: key the cookies are signed with; every service checking them needs the same one
+        """
+        if not secret:
+            # A random key per process would break every cookie at the next instance, and all of them on restart
+            raise ValueError("DRAGON_SESSION_SECRET must be set, to the same value for login and the gateway")
+        key = secret.encode("utf-8")
+        if secret.startswith("<") or len(key) < MIN_SECRET_BYTES:
+            # e.g. jenkins.env's <SESSION_SECRET> left unsubstituted, a key anyone can read
+            raise ValueError(f"DRAGON_SESSION_SECRET must be a generated secret of at least {MIN_SECRET_BYTES} bytes")
+        self.key = key
+
+    def _signature(self, payload: bytes) -> bytes:
+        return hmac.new(self.key, payload, hashlib.sha256).digest()
+
+    def sign(self, session) -> str:
+        """ The cookie value for a session """
+        payload = json.dumps([session.id, session.name, session.expires], separators=(",", ":")).encode("utf-8")
+        return f"{_b64encode(payload)}.{_b64encode(self._signature(payload))}"
+
+    def verify(self, cookie):
+        """ The session a cookie carries, or None if it is malformed, forged or expired """
+        try:
+            payload_text, _, signature_text = cookie.partition(".")
+            payload = _b64decode(payload_text)
+            if not hmac.compare_digest(self._signature(payload), _b64decode(signature_text)):
+                return None
+            session = Session(*json.loads(payload))
+        except (AttributeError, TypeError, ValueError):
+            return None
+        return None if session.expired() else session
+
+
+class MemorySessionStore:
+    """ Sessions of this process, the least recently used dropped beyond max_sessions """
+
+    def __init__(self, max_sessions=SESSION_MAX):
+        self.max_sessions = max_sessions
+        self._sessions = collections.OrderedDict()
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def get(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if session.expired():
+            del self._sessions[session_id]
+            return None
+        self._sessions.move_to_end(session_id)
+        return session
+
+    async def put(self, session) -> None:
+        self._sessions[session.id] = session
+        self._sessions.move_to_end(session.id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    async def delete(self, session_id) -> None:
+        self._sessions.pop(session_id, None)
+
+
+class SQLiteSessionStore:
+    """ Sessions in a SQLite table, so every login instance on the host sees the same ones """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self._puts = 0
+
+    async def open(self) -> None:
+        self.db = await aiosqlite.connect(self.path)
+        await self.db.execute("PRAGMA journal_mode=WAL;")
+        await self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, name TEXT NOT NULL, expires INTEGER NOT NULL);")
+        await self.db.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);")
+        await self.db.commit()
+
+    async def close(self) -> None:
+        if self.db is not None:
+            await self.db.close()
+
+    async def get(self, session_id):
+        async with self.db.execute("SELECT id, name, expires FROM sessions WHERE id = ? AND expires > ?;",
+                                   (session_id, int(time.time()))) as cursor:
+            row = await cursor.fetchone()
+        return Session(*row) if row else None
+
+    async def put(self, session) -> None:
+        await self.db.execute("INSERT OR REPLACE INTO sessions (id, name, expires) VALUES (?, ?, ?);",
+                              (session.id, session.name, session.expires))
+        self._puts += 1
+        if self._puts % 1000 == 0:
+            await self.db.execute("DELETE FROM sessions WHERE expires <= ?;", (int(time.time()),))
+        await self.db.commit()
+
+    async def delete(self, session_id) -> None:
+        await self.db.execute("DELETE FROM sessions WHERE id = ?;", (session_id,))
+        await self.db.commit()
+
+
+def open_session_store(spec=SESSION_STORE):
+    """ The store SESSION_STORE names: "" for memory, or "sqlite:/path/to.db" """
+    if spec.startswith("sqlite:"):
+        return SQLiteSessionStore(spec[len("sqlite:"):])
+    if spec in ("", "memory"):
+        return MemorySessionStore()
+    raise ValueError(f"Unknown session store {spec}")
+
+
+def current_session(request):
+    """ The signed-in session of a request, or None; checks the cookie once per request """
+    if "session" not in request:
+        cookie = request.cookies.get(SESSION_COOKIE)
+        request["session"] = request.app["session_signer"].verify(cookie) if cookie else None
+    return request["session"]
+
+
+def set_session_cookie(response, signer, session) -> None:
+    response.set_cookie(SESSION_COOKIE, signer.sign(session), max_age=max(0, session.expires - int(time.time())),
+                        httponly=True, samesite="Lax")
+
+
+def setup_sessions(app: web.Application, store=False, key="sessions") -> None:
+    """
+    Let handlers check session cookies with current_session()
+    :param store: also open the SESSION_STORE as app[key], for the service that creates and ends sessions
+    """
+    app["session_signer"] = SessionSigner()
+    if not store:
+        return
+
+    async def sessions_ctx(app):
+        app[key] = open_session_store()
+        await app[key].open()
+        yield
+        await app[key].close()
+
+    app.cleanup_ctx.append(sessions_ctx)
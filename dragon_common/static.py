@@ -0,0 +1,130 @@
+"""
+Dragon Cafe Static Pages | Org: Alta3 Research Inc.
+
+Pages like fortune_cookie.html, login.html and index.html render to the same
+bytes on every request. A StaticPage renders its template once, compresses the
+result with every coding this process supports, and then answers each request
+with the ready-made buffer that matches its Accept-Encoding:
+
+    - each variant has its own strong ETag, so a matching If-None-Match gets a 304
+    - the buffers are handed to aiohttp as they are, with no templating or
+      compression left to do per request
+    - at most every STATIC_CHECK_INTERVAL seconds the template is checked, and
+      the page is rendered again if its file changed on disk
+"""
+
+import functools
+import hashlib
+import logging
+import os
+import time
+
+from aiohttp import hdrs, web
+
+from dragon_common.compression import CODINGS, compress, negotiate
+from dragon_common.templating import TEMPLATES_DIR, get_engine
+
+log = logging.getLogger(__name__)
+
+CHECK_INTERVAL = float(os.getenv("STATIC_CHECK_INTERVAL", 2))
+MAX_AGE = int(os.getenv("STATIC_MAX_AGE", 0))
+# The best compression levels are affordable, since each page is compressed once
+LEVELS = {"gzip": 9, "br": 11}
+
+
+class Variant:
+    __slots__ = ("body", "etag", "headers")
+
+    def __init__(self, body, etag, headers):
+        self.body = body
+        self.etag = etag
+        self.headers = headers
+
+
+def etag_matches(if_none_match, etag) -> bool:
+    """ Weak comparison of an If-None-Match header against an ETag """
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tag = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith("W/") else candidate) == tag:
+            return True
+    return False
+
+
+class StaticPage:
+    def __init__(self, filename, templates_dir=TEMPLATES_DIR, args=None, content_type="text/html"):
+        """
+        A page whose template and args don't change between requests
+        :param filename: name of file found in the templates_dir
+        :param args: constant args to render the template with
+        """
+        self.filename = filename
+        self.templates_dir = templates_dir
+        self.args = args or {}
+        self.content_type = content_type
+        self.template = None
+        self.variants = {}
+        self.checked = 0.0
+
+    def render(self) -> None:
+        """ Render the template and build every variant's body, ETag and headers """
+        self.template = get_engine(self.templates_dir).get(self.filename)
+        body = self.template.render(self.args).encode("utf-8")
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        variants = {"identity": body}
+        for coding in CODINGS:
+            variants[coding] = compress(body, coding, LEVELS.get(coding))
+        self.variants = {}
+        for coding, data in variants.items():
+            etag = f'"{digest}"' if coding == "identity" else f'"{digest}-{coding}"'
+            headers = {
+                hdrs.CONTENT_TYPE: f"{self.content_type}; charset=utf-8",
+                hdrs.ETAG: etag,
+                hdrs.VARY: hdrs.ACCEPT_ENCODING,
+            }
+            if coding != "identity":
+                headers[hdrs.CONTENT_ENCODING] = coding
+            if MAX_AGE:
+                headers[hdrs.CACHE_CONTROL] = f"public, max-age={MAX_AGE}"
+            self.variants[coding] = Variant(data, etag, headers)
+        self.checked = time.monotonic()
+        log.info("Rendered static page %s: %d bytes, variants %s", self.filename, len(body), sorted(self.variants))
+
+    def refresh(self) -> None:
+        """ Render again if the template changed on disk since the last check """
+        now = time.monotonic()
+        if now - self.checked < CHECK_INTERVAL:
+            return
+        self.checked = now
+        if get_engine(self.templates_dir).get(self.filename) is not self.template:
+            self.render()
+
+    def response(self, request) -> web.Response:
+        """ The ready-made variant for this request, or a 304 if the client already has it """
+        if self.template is None:
+            self.render()
+        else:
+            self.refresh()
+        variant = self.variants[negotiate(request.headers.get(hdrs.ACCEPT_ENCODING), CODINGS)]
+        if etag_matches(request.headers.get(hdrs.IF_NONE_MATCH), variant.etag):
+            return web.Response(status=304, headers={hdrs.ETAG: variant.etag, hdrs.VARY: hdrs.ACCEPT_ENCODING})
+        return web.Response(body=variant.body, headers=variant.headers)
+
+
+@functools.lru_cache(maxsize=None)
+def static_page(filename, templates_dir=TEMPLATES_DIR) -> StaticPage:
+    """ Return the process wide StaticPage for a template rendered without args """
+    return StaticPage(filename, templates_dir)
+
+
+def prerender(*filenames, templates_dir=TEMPLATES_DIR):
+    """ Build an on_startup hook that renders static pages before the first request """
+    async def prerender_pages(app: web.Application) -> None:
+        for filename in filenames:
+            static_page(filename, templates_dir).render()
+
+    return prerender_pages
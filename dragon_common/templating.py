@@ -0,0 +1,91 @@
+"""
+Dragon Cafe Template Engine | Org: Alta3 Research Inc.
+
+Every service used to open and re-parse its Jinja2 template on each request.
+The engine here compiles each template once per process, keeps it in the
+jinja2.Environment LRU cache, and only recompiles it when the file's mtime
+changes on disk.
+"""
+
+import functools
+import logging
+import os
+from pathlib import Path
+
+from aiohttp import web
+import jinja2
+
+log = logging.getLogger(__name__)
+
+TEMPLATES_DIR = Path("templates")
+CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", 64))
+AUTO_RELOAD = os.getenv("TEMPLATE_AUTO_RELOAD", "true").lower() != "false"
+
+
+class TemplateEngine:
+    def __init__(self, templates_dir=TEMPLATES_DIR, cache_size=CACHE_SIZE, auto_reload=AUTO_RELOAD):
+        """
+        Create a jinja2 environment that loads templates from templates_dir
+        :param templates_dir: directory the html templates live in
+        :param cache_size: number of compiled templates kept in the LRU cache
+        :param auto_reload: recompile a template when its file's mtime changes
+        """
+        self.path = Path(templates_dir)
+        self.env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(str(self.path)),
+            cache_size=cache_size,
+            auto_reload=auto_reload,
+        )
+
+    def get(self, filename) -> jinja2.Template:
+        """ Return the compiled template, compiling it only on a cache miss or mtime change """
+        return self.env.get_template(filename)
+
+    def render(self, filename, args=None) -> str:
+        return self.get(filename).render(args or {})
+
+    def precompile(self) -> list:
+        """ Compile every template in templates_dir so no request pays for it """
+        names = self.env.list_templates(extensions=["html"])
+        for name in names:
+            self.get(name)
+        return names
+
+
+@functools.lru_cache(maxsize=None)
+def _engine(templates_dir: str) -> TemplateEngine:
+    # Resolved once, when the engine is made, so a later chdir doesn't move it
+    return TemplateEngine(Path(templates_dir).resolve())
+
+
+def get_engine(templates_dir=TEMPLATES_DIR) -> TemplateEngine:
+    """ Return the process wide engine for templates_dir; keyed by the path as given, so no syscall per render """
+    return _engine(os.fspath(templates_dir))
+
+
+async def precompile_templates(app: web.Application) -> None:
+    """ on_startup hook that compiles everything in the templates directory """
+    names = get_engine().precompile()
+    log.info("Precompiled %d templates: %s", len(names), names)
+
+
+class Page:
+    def __init__(self, filename, templates_dir=TEMPLATES_DIR, args={}, cookies={}):
+        """
+        Create a new instance of an html page to be returned
+        :param filename: name of file found in the templates_dir
+        """
+        self.path = templates_dir
+        self.file = templates_dir / filename
+        self.filename = filename
+        self.args = args
+        self.cookies = cookies
+
+    def render(self):
+        """ Template in a Jinja2 formatted HTML file and return a web.Response """
+        log.debug("Rendering %s", self.filename)
+        j2 = get_engine(self.path).render(self.filename, self.args)
+        resp = web.Response(text=j2, content_type='text/html')
+        for c, j in self.cookies.items():
+            resp.set_cookie(c, j)
+        return resp
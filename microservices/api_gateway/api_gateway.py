@@ -9,14 +9,35 @@ This is the primary microservice that users from the "outside" will connect to
 in order to access the microservices within.
 """
 
-from aiohttp import web
-import jinja2
-from pathlib import Path
-import random
-import requests
+from aiohttp import hdrs, web
+from contextlib import asynccontextmanager
+from multidict import CIMultiDict
+from yarl import URL
+import aiohttp
+import asyncio
+import functools
+import json
 import socket
 import os
-import json
+import logging
+import time
+
+from dragon_common.api import JSON, MSGPACK, negotiate as negotiate_media_type
+from dragon_common.composition import COMPOSE, Composer
+from dragon_common.compression import setup_compression
+from dragon_common.discovery import NoEndpoints, setup_discovery
+from dragon_common.http_client import setup_client_session
+from dragon_common.logs import SampledAccessLogger, setup_logging
+from dragon_common.registry_client import setup_registration
+from dragon_common.sessions import SESSION_COOKIE, setup_sessions
+from dragon_common.static import prerender, static_page
+from dragon_common.templating import Page, precompile_templates
+from circuit_breaker import setup_circuit_breakers
+from hedging import HEDGE, Hedger
+from rate_limit import setup_rate_limits
+from response_cache import CachedResponse, ResponseCache, parse_ttls
+
+log = logging.getLogger("api_gateway")
 
 HOST = os.getenv("API_HOST", "0.0.0.0")
 LOCAL_IP = socket.gethostbyname(socket.gethostname())
@@ -24,84 +45,359 @@ PORT = os.getenv("API_PORT", 2225)
 REG_ADDR = os.getenv("SR_ADDRESS", "127.0.0.1")
 REG_PORT = os.getenv("SR_PORT", 55555)
 SERVICE = os.path.basename(__file__).rstrip(".py")
+HOME_SERVICES = os.getenv("API_HOME_SERVICES", "login,fortune_cookie,menu").split(",")
+CHUNK_SIZE = int(os.getenv("API_CHUNK_SIZE", 64 * 1024))
+CACHE_TTLS = parse_ttls(os.getenv("GW_CACHE_TTLS", "menu=5,fortune_cookie=60,login=60,menu/api/menu=5"))
+# /api/{name} is served by /api/{name} of the service it maps to
+API_ROUTES = dict(pair.strip().split("=", 1) for pair in
+                  os.getenv("GW_API_ROUTES", "menu=menu,fortune=fortune_cookie,login=login").split(",") if pair.strip())
+
+# Headers that only apply to a single connection, which a proxy must not forward
+HOP_BY_HOP = frozenset([
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "trailers", "transfer-encoding", "upgrade",
+])
+IDEMPOTENT = frozenset(["GET", "HEAD", "OPTIONS"])
+RETRY_STATUS = frozenset([502, 503, 504])
+
+
+class UpstreamBroken(ConnectionResetError):
+    """ The upstream failed after its response had started streaming to the client """
+
 
-class Page:
-    def __init__(self, filename, templates_dir=Path("templates"), args={}, cookies={}):
-        """
-        Create a new instance of an html page to be returned
-        :param filename: name of file found in the templates_dir
-        """
-        self.path = templates_dir
-        self.file = templates_dir / filename
-        self.args = args
-        self.cookies = cookies
-
-    def render(self):
-        with open(self.file) as f:
-            txt = f.read()
-            print(f"Templating in {self.args}")
-            j2 = jinja2.Template(txt).render(self.args)
-            resp = web.Response(text=j2, content_type='text/html')
-            for c, j in self.cookies:
-                resp.set_cookie(c, j)
-            return resp
+class UpstreamError(Exception):
+    """ The upstream answered, but not with a response the gateway can use """
+
+
+# Failures reading an upstream body that are the upstream's doing; a client hanging up mid-response
+# raises ConnectionResetError, which says nothing about the upstream
+UPSTREAM_BODY_ERRORS = (UpstreamBroken, aiohttp.ClientPayloadError, aiohttp.ServerDisconnectedError,
+                        asyncio.TimeoutError)
 
 
 def routes(app: web.Application) -> None:
     app.add_routes(
         [
             web.get("/", home),
-            web.get("/{service_name}", service),
-            web.get("/{service_name}/{ex_path}", service),
-            web.post("/{service_name}/{ex_path}", service),
+            web.route("*", "/api/{api_name}", api),
+            web.route("*", "/api/{api_name}/{ex_path:.*}", api),
+            web.route("*", "/{service_name}", service),
+            web.route("*", "/{service_name}/{ex_path:.*}", service),
         ]
     )
 
 
-async def service(request) -> web.Response:
-    print(request)
-    svc_name = request.match_info.get('service_name', '')
+def forwarded_headers(request) -> CIMultiDict:
+    """ Copy the client's headers for the upstream request, minus hop-by-hop headers """
+    headers = CIMultiDict((k, v) for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP)
+    headers.pop(hdrs.HOST, None)
+    # Otherwise the client session adds its own Accept-Encoding, and a client that sent none gets gzip
+    headers.setdefault(hdrs.ACCEPT_ENCODING, "identity")
+    peer = request.remote or ""
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    headers["X-Forwarded-For"] = f"{forwarded_for}, {peer}" if forwarded_for else peer
+    headers["X-Forwarded-Host"] = request.host
+    headers["X-Forwarded-Proto"] = request.scheme
+    return headers
+
+
+async def service(request) -> web.StreamResponse:
+    """
+    Proxy a request to one instance of the service, from the response cache when the route has a TTL
+    """
+    return await forward(request, *route_of(request))
+
+
+async def api(request) -> web.StreamResponse:
+    """
+    Proxy an API request to the service that serves it. Cached API responses are kept per media type.
+    """
+    svc_name, ex_path = route_of(request)
+    if svc_name is None:
+        raise web.HTTPNotFound(text=f"There is no {request.match_info['api_name']} API")
+    # A fixed Accept per media type, so every client that negotiates msgpack shares one cache entry
+    media_type = negotiate_media_type(request.headers.get(hdrs.ACCEPT), (MSGPACK, JSON))
+    return await forward(request, svc_name, ex_path, media_type)
+
+
+def route_of(request):
+    """ The (service, path on the service) a proxied request is for; service is None for unknown APIs """
     ex_path = request.match_info.get('ex_path', '')
-    svc_host = requests.get(f"http://{REG_ADDR}:{REG_PORT}/get_one/{svc_name}").text
-    svc_host = json.loads(svc_host)
-    svc_ip = svc_host["endpoints"][0]
-    svc_port = svc_host["endpoints"][1]
-    if request.method == "POST":
-        data = await request.post()
-        r = requests.post(f"http://{svc_ip}:{svc_port}/{ex_path}", data=data)
-    else:
-        r = requests.get(f"http://{svc_ip}:{svc_port}/{ex_path}")
-    return web.Response(text=r.text, content_type='text/html')
+    if "api_name" in request.match_info:
+        api_name = request.match_info["api_name"]
+        return API_ROUTES.get(api_name), "/".join(filter(None, ("api", api_name, ex_path)))
+    return request.match_info.get('service_name', ''), ex_path
 
 
-async def home(request) -> web.Response:
+def limit_target(request):
+    """ The (service, route) the rate limits apply to; the home page counts against no service """
+    if "api_name" not in request.match_info and "service_name" not in request.match_info:
+        return None, ""
+    svc_name, ex_path = route_of(request)
+    return svc_name, f"{svc_name}/{ex_path}".strip("/")
+
+
+async def forward(request, svc_name, ex_path, accept="") -> web.StreamResponse:
     """
-    This is the home page for the website
+    Proxy a request to one instance of the service, from the response cache when the route has a TTL
+    :param accept: the Accept cached responses are fetched with, if they vary on it
+    """
+    try:
+        ttl = cache_ttl(request, svc_name, ex_path)
+        if ttl:
+            return await cached(request, svc_name, ex_path, ttl, accept)
+        return await proxy(request, svc_name, ex_path)
+    except NoEndpoints:
+        raise web.HTTPServiceUnavailable(text=f"No {svc_name} service is available")
+    except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamError) as err:
+        log.warning("Upstream %s failed: %r", svc_name, err)
+        raise web.HTTPBadGateway()
+
+
+def upstream_url(endpoint, ex_path, query_string="") -> URL:
+    svc_ip, svc_port = endpoint
+    return URL.build(scheme="http", host=svc_ip, port=int(svc_port), path=f"/{ex_path}", query_string=query_string)
+
+
+@asynccontextmanager
+async def upstream_request(request, svc_name, ex_path, headers, data=None, method=None, query_string=None):
     """
-    print(request)
-    page = Page(filename="index.html")
-    return page.render()
+    Send a request to one instance of the service, skipping instances their circuit breaker ejected.
+    Idempotent requests that can't connect or get a 502, 503 or 504 are retried once on another instance.
+    Yields the upstream response. Its outcome and latency are recorded as soon as the headers arrive, so the
+    time a client takes to read the body never counts against the upstream; a body the upstream breaks off
+    afterwards counts as one more failure.
+    :param query_string: defaults to the client request's
+    """
+    method = method or request.method
+    target = (ex_path, request.query_string if query_string is None else query_string)
+    breakers = request.app["breakers"]
+    hedger = request.app["hedger"]
+    idempotent = method in IDEMPOTENT and data is None
+    retries = 1 if idempotent else 0
+    tried = []
+    endpoint = await request.app["discovery"].choose(svc_name, available=breakers.available)
+    while True:
+        tried.append(endpoint)
+        try:
+            if idempotent and hedger is not None:
+                endpoint, started, upstream = await hedged(request, svc_name, endpoint, target, method, headers, tried)
+            else:
+                endpoint, started, upstream = await send(request, svc_name, endpoint, target, method, headers, data)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            endpoint = await other_endpoint(request, svc_name, tried) if retries else None
+            if endpoint is None:
+                raise
+            retries -= 1
+            continue
+        if upstream.status in RETRY_STATUS and retries:
+            retry = await other_endpoint(request, svc_name, tried)
+            if retry is not None:
+                upstream.release()
+                breakers.record(svc_name, endpoint, False, time.monotonic() - started)
+                endpoint.finished(started)
+                endpoint = retry
+                retries -= 1
+                continue
+        break
+    elapsed = time.monotonic() - started
+    breakers.record(svc_name, endpoint, upstream.status < 500, elapsed)
+    try:
+        yield upstream
+    except UPSTREAM_BODY_ERRORS:
+        breakers.record(svc_name, endpoint, False, elapsed)
+        raise
+    finally:
+        upstream.release()
+        endpoint.finished(started, elapsed)
+
+
+async def send(request, svc_name, endpoint, target, method, headers, data=None) -> tuple:
+    """
+    Send one request to one endpoint and wait for its response headers.
+    :param target: (path, query string) on the endpoint
+    :return: (endpoint, started, upstream response); the caller must release the response and finish the endpoint
+    """
+    breakers = request.app["breakers"]
+    breakers.started(endpoint)
+    started = endpoint.started()
+    try:
+        upstream = await request.app["proxy_session"].request(
+            method, upstream_url(endpoint, *target),
+            headers=headers, data=data, allow_redirects=False)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        breakers.record(svc_name, endpoint, False, time.monotonic() - started)
+        endpoint.finished(started)
+        raise
+    except asyncio.CancelledError:
+        # Lost a hedge race, or the client went away
+        breakers.cancelled(endpoint)
+        endpoint.finished(started)
+        raise
+    return endpoint, started, upstream
+
+
+async def hedged(request, svc_name, endpoint, target, method, headers, tried) -> tuple:
+    """
+    Send an idempotent request like send(), and if it hasn't answered within the service's hedge delay,
+    send it to a second instance as well. The first response wins and the other request is cancelled.
+    """
+    hedger = request.app["hedger"]
+    tasks = [asyncio.ensure_future(send(request, svc_name, endpoint, target, method, headers))]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedger.delay(svc_name))
+        if not done and hedger.allow(svc_name):
+            second = await other_endpoint(request, svc_name, tried)
+            if second is not None:
+                tried.append(second)
+                tasks.append(asyncio.ensure_future(send(request, svc_name, second, target, method, headers)))
+        failure = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    _, started, _ = task.result()
+                    hedger.observe(svc_name, time.monotonic() - started, hedge_won=task is not tasks[0])
+                    return task.result()
+                failure = failure or task.exception()
+        raise failure
+    finally:
+        for task in tasks:
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                # Answered at the same moment as the winner
+                loser, started, upstream = task.result()
+                upstream.release()
+                request.app["breakers"].record(svc_name, loser, upstream.status < 500, time.monotonic() - started)
+                loser.finished(started)
+
+
+async def other_endpoint(request, svc_name, tried):
+    """ Another available instance of the service for a retry, or None if there is none """
+    try:
+        return await request.app["discovery"].choose(svc_name, exclude=tried,
+                                                     available=request.app["breakers"].available)
+    except NoEndpoints:
+        return None
+
+
+async def proxy(request, svc_name, ex_path) -> web.StreamResponse:
+    """
+    Stream the request to one instance of the service and its response back to the client.
+
+    Bodies are piped chunk by chunk in both directions, so the gateway's memory per request
+    stays constant however large the payload is. The upstream status, headers, cookies and
+    content encoding are passed through untouched.
+    """
+    data = request.content if request.body_exists else None
+    async with upstream_request(request, svc_name, ex_path, forwarded_headers(request), data) as upstream:
+        response = web.StreamResponse(status=upstream.status, reason=upstream.reason)
+        for name, value in upstream.headers.items():
+            if name.lower() not in HOP_BY_HOP:
+                response.headers.add(name, value)
+        await response.prepare(request)
+        try:
+            async for chunk in upstream.content.iter_chunked(CHUNK_SIZE):
+                await response.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            # The status line is already on the wire; all we can do is drop the connection
+            raise UpstreamBroken(f"Upstream {svc_name} failed mid-response: {err!r}")
+        await response.write_eof()
+        return response
+
+
+def cache_ttl(request, svc_name, ex_path) -> float:
+    """ The configured TTL of the route, or 0 if this request must not be answered from the cache """
+    if request.method not in ("GET", "HEAD") or hdrs.AUTHORIZATION in request.headers:
+        return 0
+    # Logged in visitors may get personal pages, which the shared cache must neither serve nor keep
+    if SESSION_COOKIE in request.cookies:
+        return 0
+    # A streamed listing must reach the client as it renders, not be read whole into the cache first
+    if request.query.get("stream", "").lower() == "true":
+        return 0
+    return CACHE_TTLS.get(f"{svc_name}/{ex_path}".strip("/"), 0)
+
+
+def accepted_encodings(request) -> str:
+    """ Normalise Accept-Encoding, so browsers that accept the same codings share cache entries """
+    codings = {c.split(";")[0].strip().lower() for c in request.headers.get(hdrs.ACCEPT_ENCODING, "").split(",")}
+    return ",".join(sorted(codings & {"gzip", "deflate", "br", "zstd"}))
+
+
+async def cached(request, svc_name, ex_path, ttl, accept="") -> web.Response:
+    """ Answer from the response cache, sharing one upstream fetch between concurrent misses """
+    entry, state = await cache_entry(request, svc_name, ex_path, request.query_string, ttl,
+                                     accepted_encodings(request), accept)
+    return entry.respond(request, state)
+
 
+async def cache_entry(request, svc_name, ex_path, query_string, ttl, encodings="", accept=""):
+    """ Return (entry, state) for a page from the response cache, fetching it from upstream if needed """
+    async def fetch(previous):
+        headers = {hdrs.ACCEPT_ENCODING: encodings or "identity"}
+        if accept:
+            headers[hdrs.ACCEPT] = accept
+        if previous is not None and previous.etag:
+            headers[hdrs.IF_NONE_MATCH] = previous.etag
+        async with upstream_request(request, svc_name, ex_path, headers, method="GET",
+                                    query_string=query_string) as upstream:
+            body = await upstream.read()
+        upstream_headers = CIMultiDict((k, v) for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP)
+        if upstream.status == 304 and previous is not None:
+            return previous.revalidated(upstream_headers, ttl)
+        return CachedResponse.from_upstream(upstream.status, upstream_headers, body, ttl)
 
-async def register(add_to_registry=True):
-    print(f"""
-    Service Registry {REG_ADDR}:{REG_PORT}
+    return await request.app["response_cache"].get((svc_name, ex_path, query_string, encodings, accept), fetch)
 
-    Adding to the Service Registry:
 
-    service name     {SERVICE}
-    service IP       {LOCAL_IP}
-    service port     {PORT}
-    """)
-    if add_to_registry:
-        r = requests.get(f"http://{REG_ADDR}:{REG_PORT}/add/{SERVICE}/{LOCAL_IP}/{PORT}")
-        print(r.status_code, r.text)
+async def home(request) -> web.Response:
+    """
+    This is the home page for the website
+    """
+    if COMPOSE:
+        personal = SESSION_COOKIE in request.cookies
+        fragments = await request.app["composer"].compose(
+            {svc_name: functools.partial(fetch_fragment, request, svc_name) for svc_name in HOME_SERVICES},
+            remember=not personal)
+        response = Page(filename="index_composed.html", args=fragments).render()
+        if personal:
+            response.headers[hdrs.CACHE_CONTROL] = "private, no-cache"
+        return response
+    return static_page("index.html").response(request)
+
+
+async def fetch_fragment(request, svc_name) -> str:
+    """ The landing page of a service for the composed home page, through the response cache if it has a TTL """
+    ttl = CACHE_TTLS.get(svc_name, 0) if SESSION_COOKIE not in request.cookies else 0
+    if ttl:
+        entry, _ = await cache_entry(request, svc_name, "", "", ttl)
+        status, body, charset = entry.status, entry.body, "utf-8"
+    else:
+        headers = forwarded_headers(request)
+        for name in (hdrs.IF_NONE_MATCH, hdrs.IF_MODIFIED_SINCE, hdrs.RANGE):
+            headers.pop(name, None)
+        headers[hdrs.ACCEPT_ENCODING] = "identity"
+        async with upstream_request(request, svc_name, "", headers, method="GET", query_string="") as upstream:
+            status, body, charset = upstream.status, await upstream.read(), upstream.charset or "utf-8"
+    if status != 200:
+        raise UpstreamError(f"{svc_name} answered {status}")
+    return body.decode(charset, errors="replace")
 
 
-async def unregister(remove_from_registry=True):
-    if remove_from_registry:
-        r = requests.get(f"http://{REG_ADDR}:{REG_PORT}/remove/{SERVICE}/{LOCAL_IP}/{PORT}")
-        print(r.status_code)
+async def prefetch_services(app: web.Application) -> None:
+    """ Resolve every service the home page fans out to in one registry round trip """
+    try:
+        await app["discovery"].refresh_many(HOME_SERVICES)
+    except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError, KeyError) as err:
+        # A registry that is down or answers garbage only costs the first home page its lookups
+        log.warning("Prefetching %s failed: %r", HOME_SERVICES, err)
 
 
 def main():
@@ -114,12 +410,25 @@ def main():
     event loop with web.run_app().
     """
 
-    print("This aiohttp web server is starting up!")
+    setup_logging()
+    log.info("This aiohttp web server is starting up!")
     app = web.Application()
     routes(app)
-    app.on_startup.append(register)
-    app.on_shutdown.append(unregister)
-    web.run_app(app, host=HOST, port=PORT)
+    setup_sessions(app)
+    setup_rate_limits(app, limit_target)
+    setup_compression(app)
+    setup_client_session(app)
+    setup_client_session(app, key="proxy_session", auto_decompress=False)
+    setup_discovery(app, f"http://{REG_ADDR}:{REG_PORT}")
+    setup_circuit_breakers(app, f"http://{REG_ADDR}:{REG_PORT}")
+    app["response_cache"] = ResponseCache()
+    app["hedger"] = Hedger() if HEDGE else None
+    app["composer"] = Composer()
+    app.on_startup.append(prefetch_services)
+    app.on_startup.append(precompile_templates)
+    app.on_startup.append(prerender("index.html"))
+    setup_registration(app, SERVICE, LOCAL_IP, PORT, f"http://{REG_ADDR}:{REG_PORT}")
+    web.run_app(app, host=HOST, port=PORT, access_log_class=SampledAccessLogger)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,204 @@
+"""
+Dragon Cafe Gateway Circuit Breakers | Org: Alta3 Research Inc.
+
+One breaker per upstream endpoint keeps a single sick instance from dragging
+the gateway down with it:
+
+    closed      requests flow; the last GW_CB_WINDOW outcomes are kept. A request
+                fails if it can't connect, times out, answers with a 5xx or takes
+                longer than GW_CB_SLOW_CALL seconds.
+    open        once GW_CB_CONSECUTIVE requests fail in a row, or GW_CB_ERROR_RATE
+                of a full enough window fail, the endpoint is ejected for a
+                cool-down that doubles with every ejection in a row, up to
+                GW_CB_MAX_COOLDOWN
+    half open   after the cool-down one probe request is let through; it closes
+                the breaker if it succeeds and ejects the endpoint again if not
+
+Ejections are reported to the Service Registry's /eject, so other gateways stop
+routing to the endpoint too.
+"""
+
+import asyncio
+import collections
+import logging
+import os
+import time
+
+import aiohttp
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+CB_WINDOW = int(os.getenv("GW_CB_WINDOW", 20))
+CB_MIN_REQUESTS = int(os.getenv("GW_CB_MIN_REQUESTS", 5))
+CB_ERROR_RATE = float(os.getenv("GW_CB_ERROR_RATE", 0.5))
+CB_CONSECUTIVE = int(os.getenv("GW_CB_CONSECUTIVE", 5))
+CB_SLOW_CALL = float(os.getenv("GW_CB_SLOW_CALL", 2))
+CB_COOLDOWN = float(os.getenv("GW_CB_COOLDOWN", 10))
+CB_MAX_COOLDOWN = float(os.getenv("GW_CB_MAX_COOLDOWN", 120))
+CB_REPORT = os.getenv("GW_CB_REPORT", "true").lower() != "false"
+CB_IDLE = float(os.getenv("GW_CB_IDLE", 300))
+
+
+class Breaker:
+    """ The recent outcomes of one endpoint and whether it is ejected """
+    __slots__ = ("outcomes", "consecutive", "ejected_until", "ejections", "probing", "touched")
+
+    def __init__(self, window=CB_WINDOW):
+        self.outcomes = collections.deque(maxlen=window)
+        self.consecutive = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.probing = False
+        self.touched = time.monotonic()
+
+    def state(self, now=None) -> str:
+        if not self.ejected_until:
+            return "closed"
+        if (now or time.monotonic()) < self.ejected_until:
+            return "open"
+        return "half_open"
+
+    def available(self, now=None) -> bool:
+        """ Closed, or half open with no probe in flight yet """
+        state = self.state(now)
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def eject(self, now, cooldown=CB_COOLDOWN, max_cooldown=CB_MAX_COOLDOWN) -> float:
+        seconds = min(cooldown * 2 ** self.ejections, max_cooldown)
+        self.ejections += 1
+        self.ejected_until = now + seconds
+        self.probing = False
+        self.outcomes.clear()
+        self.consecutive = 0
+        return seconds
+
+    def close(self) -> None:
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.probing = False
+        self.outcomes.clear()
+        self.consecutive = 0
+
+
+class CircuitBreakers:
+    def __init__(self, session=None, registry_url=None, window=CB_WINDOW, min_requests=CB_MIN_REQUESTS,
+                 error_rate=CB_ERROR_RATE, consecutive=CB_CONSECUTIVE, slow_call=CB_SLOW_CALL):
+        """
+        :param session: client session used to report ejections
+        :param registry_url: base url of the Service Registry; ejections aren't reported without it
+        :param window: outcomes kept per endpoint to work out its error rate
+        :param min_requests: outcomes needed in the window before the error rate counts
+        :param error_rate: share of failures in the window that ejects the endpoint
+        :param consecutive: failures in a row that eject the endpoint
+        :param slow_call: seconds after which a response counts as a failure
+        """
+        self.session = session
+        self.registry_url = registry_url.rstrip("/") if registry_url else None
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.consecutive = consecutive
+        self.slow_call = slow_call
+        self._breakers = {}
+        self._reports = set()
+        self._records = 0
+
+    def breaker(self, endpoint) -> Breaker:
+        key = (endpoint.ip, endpoint.port)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = Breaker(self.window)
+        return breaker
+
+    def available(self, endpoint) -> bool:
+        """ Predicate for DiscoveryCache.choose(): False while the endpoint is ejected """
+        breaker = self._breakers.get((endpoint.ip, endpoint.port))
+        return breaker is None or breaker.available()
+
+    def started(self, endpoint) -> None:
+        """ Call when a request is sent to the chosen endpoint, so a half open breaker lets only one probe through """
+        breaker = self._breakers.get((endpoint.ip, endpoint.port))
+        if breaker is not None and breaker.state() == "half_open":
+            breaker.probing = True
+
+    def cancelled(self, endpoint) -> None:
+        """ Call when a request is abandoned before it was answered, so it doesn't hold the probe slot """
+        breaker = self._breakers.get((endpoint.ip, endpoint.port))
+        if breaker is not None:
+            breaker.probing = False
+
+    def record(self, service, endpoint, ok, elapsed) -> None:
+        """
+        Record the outcome of one request, ejecting the endpoint if it has become an outlier
+        :param ok: False if the request failed to connect, timed out or got a 5xx
+        :param elapsed: seconds the request took
+        """
+        now = time.monotonic()
+        breaker = self.breaker(endpoint)
+        breaker.touched = now
+        ok = ok and elapsed <= self.slow_call
+        state = breaker.state(now)
+        if state == "open":
+            # A straggler sent before the ejection; it says nothing new
+            return
+        if state == "half_open":
+            if ok:
+                log.info("Circuit closed for %s %s", service, endpoint)
+                breaker.close()
+            else:
+                self._eject(service, endpoint, breaker, now)
+            return
+        breaker.outcomes.append(ok)
+        breaker.consecutive = 0 if ok else breaker.consecutive + 1
+        failures = len(breaker.outcomes) - sum(breaker.outcomes)
+        if breaker.consecutive >= self.consecutive or (
+                len(breaker.outcomes) >= self.min_requests and failures / len(breaker.outcomes) >= self.error_rate):
+            self._eject(service, endpoint, breaker, now)
+        self._records += 1
+        if self._records % 1000 == 0:
+            self._prune(now)
+
+    async def close(self) -> None:
+        tasks = list(self._reports)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _eject(self, service, endpoint, breaker, now) -> None:
+        seconds = breaker.eject(now)
+        log.warning("Circuit open for %s %s, ejected for %.0fs", service, endpoint, seconds)
+        if self.registry_url and self.session is not None:
+            task = asyncio.ensure_future(self._report(service, endpoint, seconds))
+            self._reports.add(task)
+            task.add_done_callback(self._reports.discard)
+
+    async def _report(self, service, endpoint, seconds) -> None:
+        url = f"{self.registry_url}/eject/{service}/{endpoint.ip}/{endpoint.port}"
+        try:
+            async with self.session.get(url, params={"seconds": f"{seconds:.0f}"}) as r:
+                if r.status >= 400:
+                    log.warning("The Service Registry declined to eject %s %s: %s", service, endpoint, r.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            log.warning("Reporting the ejection of %s %s failed: %r", service, endpoint, err)
+
+    def _prune(self, now) -> None:
+        """ Forget closed breakers of endpoints that haven't been used in a while """
+        idle = [key for key, breaker in self._breakers.items()
+                if not breaker.ejected_until and now - breaker.touched > CB_IDLE]
+        for key in idle:
+            del self._breakers[key]
+
+
+def setup_circuit_breakers(app: web.Application, registry_url=None, key="breakers", session_key="client_session",
+                           **kwargs) -> None:
+    """
+    Create the gateway's CircuitBreakers when the app starts. Ejections are reported to
+    the registry over app[session_key] unless GW_CB_REPORT is false.
+    """
+    async def breakers_ctx(app):
+        app[key] = CircuitBreakers(app[session_key], registry_url if CB_REPORT else None, **kwargs)
+        yield
+        await app[key].close()
+
+    app.cleanup_ctx.append(breakers_ctx)
@@ -0,0 +1,94 @@
+"""
+Dragon Cafe Gateway Request Hedging | Org: Alta3 Research Inc.
+
+The home page shows three services at once, so it is as slow as the slowest of
+them. With GW_HEDGE=true an idempotent request that hasn't answered within the
+service's usual time (its GW_HEDGE_PERCENTILE latency, kept between
+GW_HEDGE_MIN_DELAY and GW_HEDGE_MAX_DELAY) is sent to a second instance as
+well, and whichever answers first wins.
+
+Hedges are paid for out of a budget: every request earns GW_HEDGE_BUDGET of a
+token, up to GW_HEDGE_BURST tokens, and a hedge costs a whole one. When a
+service slows down across the board the budget runs dry after a few hedges,
+instead of doubling the load on a service that is already struggling.
+"""
+
+import collections
+import os
+
+HEDGE = os.getenv("GW_HEDGE", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("GW_HEDGE_PERCENTILE", 95))
+HEDGE_MIN_DELAY = float(os.getenv("GW_HEDGE_MIN_DELAY", 0.005))
+HEDGE_MAX_DELAY = float(os.getenv("GW_HEDGE_MAX_DELAY", 0.5))
+HEDGE_BUDGET = float(os.getenv("GW_HEDGE_BUDGET", 0.1))
+HEDGE_BURST = float(os.getenv("GW_HEDGE_BURST", 10))
+HEDGE_SAMPLES = int(os.getenv("GW_HEDGE_SAMPLES", 200))
+HEDGE_MIN_SAMPLES = int(os.getenv("GW_HEDGE_MIN_SAMPLES", 20))
+
+
+class _Service:
+    __slots__ = ("samples", "delay", "observed", "tokens")
+
+    def __init__(self, samples, delay, tokens):
+        self.samples = collections.deque(maxlen=samples)
+        self.delay = delay
+        self.observed = 0
+        self.tokens = tokens
+
+
+class Hedger:
+    def __init__(self, percentile=HEDGE_PERCENTILE, min_delay=HEDGE_MIN_DELAY, max_delay=HEDGE_MAX_DELAY,
+                 budget=HEDGE_BUDGET, burst=HEDGE_BURST, samples=HEDGE_SAMPLES, min_samples=HEDGE_MIN_SAMPLES):
+        """
+        :param percentile: a request slower than this percentile of the service's recent latencies is hedged
+        :param min_delay: never hedge sooner than this many seconds
+        :param max_delay: never wait longer than this many seconds to hedge; also used until enough samples are in
+        :param budget: share of requests that may be hedged in the long run
+        :param burst: hedges that may be sent back to back
+        :param samples: recent latencies kept per service
+        :param min_samples: latencies needed before the percentile is trusted
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.burst = burst
+        self.samples = samples
+        self.min_samples = min_samples
+        self.hedges = 0
+        self.wins = 0
+        self._services = {}
+
+    def _service(self, service) -> _Service:
+        state = self._services.get(service)
+        if state is None:
+            state = self._services[service] = _Service(self.samples, self.max_delay, self.burst)
+        return state
+
+    def delay(self, service) -> float:
+        """ Seconds to wait for an answer before hedging a request; each call earns budget """
+        state = self._service(service)
+        state.tokens = min(self.burst, state.tokens + self.budget)
+        return state.delay
+
+    def allow(self, service) -> bool:
+        """ Spend a token on a hedge, if the service has one left """
+        state = self._service(service)
+        # Ten requests at 0.1 add up to 0.999..., which has to buy a hedge too
+        if state.tokens < 1 - 1e-9:
+            return False
+        state.tokens = max(0.0, state.tokens - 1)
+        self.hedges += 1
+        return True
+
+    def observe(self, service, seconds, hedge_won=False) -> None:
+        """ Record the time a request took to answer. The percentile is recomputed every few samples. """
+        state = self._service(service)
+        state.samples.append(seconds)
+        state.observed += 1
+        if hedge_won:
+            self.wins += 1
+        if len(state.samples) >= self.min_samples and state.observed % 10 == 0:
+            ordered = sorted(state.samples)
+            index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+            state.delay = min(self.max_delay, max(self.min_delay, ordered[index]))
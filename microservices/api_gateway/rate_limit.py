@@ -0,0 +1,228 @@
+"""
+Dragon Cafe Gateway Rate Limits | Org: Alta3 Research Inc.
+
+Token buckets keep one client from using up the services behind the gateway.
+Every request takes a token from up to three buckets, and is answered 429 with
+Retry-After when one of them is empty:
+
+    client    per client IP, GW_RL_CLIENT_RATE requests a second
+    session   per logged in session, GW_RL_SESSION_RATE requests a second
+    service   per service for all clients together, from GW_RL_SERVICE_RATES,
+              e.g. "menu=500,login=50"
+
+Each bucket holds GW_RL_BURST seconds worth of tokens, and a rate of 0 turns its
+limit off. Buckets live in memory and idle ones are evicted as the limiter goes.
+With GW_RL_SHARED=/path/to.db they live in SQLite instead, so the gateway
+replicas on one host share their limits, at the cost of a write per bucket per
+request.
+
+Expensive routes also get concurrency caps, from GW_RL_CONCURRENCY, e.g.
+"login/logging_in=16": at most that many requests to the route at once through
+this gateway (503 past it), and at most GW_RL_CLIENT_CONCURRENCY of them from
+any one client (429 past that).
+"""
+
+import asyncio
+import math
+import os
+import time
+
+import aiosqlite
+from aiohttp import hdrs, web
+
+from dragon_common.sessions import current_session
+
+RL_CLIENT_RATE = float(os.getenv("GW_RL_CLIENT_RATE", 50))
+RL_SESSION_RATE = float(os.getenv("GW_RL_SESSION_RATE", 20))
+RL_SERVICE_RATES = os.getenv("GW_RL_SERVICE_RATES", "")
+RL_BURST = float(os.getenv("GW_RL_BURST", 2))
+RL_IDLE = float(os.getenv("GW_RL_IDLE", 300))
+RL_SHARED = os.getenv("GW_RL_SHARED", "")
+RL_CONCURRENCY = os.getenv("GW_RL_CONCURRENCY", "login/logging_in=16,login/api/login=16")
+RL_CLIENT_CONCURRENCY = int(os.getenv("GW_RL_CLIENT_CONCURRENCY", 2))
+
+
+def parse_limits(spec) -> dict:
+    """ Parse a per service or per route setting such as "menu=500,login=50" into {name: number} """
+    limits = {}
+    for pair in filter(None, (p.strip() for p in (spec or "").split(","))):
+        name, _, number = pair.partition("=")
+        limits[name.strip().strip("/")] = float(number)
+    return limits
+
+
+class MemoryBuckets:
+    """ Token buckets of this process, as {key: [tokens, updated]} """
+
+    def __init__(self, idle=RL_IDLE):
+        self.idle = idle
+        self._buckets = {}
+        self._takes = 0
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def take(self, key, rate, burst) -> float:
+        """ Take a token; 0 if there was one, otherwise the seconds until there will be """
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        self._takes += 1
+        if self._takes % 1000 == 0:
+            self._prune(now)
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / rate
+
+    def _prune(self, now) -> None:
+        """ Forget buckets that haven't been used in a while; they would have filled up again anyway """
+        idle = [key for key, (_, updated) in self._buckets.items() if now - updated > self.idle]
+        for key in idle:
+            del self._buckets[key]
+
+
+class SQLiteBuckets:
+    """ Token buckets in a SQLite table, shared by every gateway that opens the same file """
+
+    def __init__(self, path, idle=RL_IDLE):
+        self.path = path
+        self.idle = idle
+        self.db = None
+        self._lock = None
+        self._takes = 0
+
+    async def open(self) -> None:
+        # One transaction at a time on the connection
+        self._lock = asyncio.Lock()
+        self.db = await aiosqlite.connect(self.path, isolation_level=None)
+        await self.db.execute("PRAGMA journal_mode=WAL;")
+        await self.db.execute("PRAGMA synchronous=OFF;")
+        await self.db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL);")
+
+    async def close(self) -> None:
+        if self.db is not None:
+            await self.db.close()
+
+    async def take(self, key, rate, burst) -> float:
+        # Wall clock time, since the replicas sharing the table don't share a monotonic clock
+        async with self._lock:
+            return await self._take(key, rate, burst, time.time())
+
+    async def _take(self, key, rate, burst, now) -> float:
+        await self.db.execute("BEGIN IMMEDIATE;")
+        try:
+            async with self.db.execute("SELECT tokens, updated FROM buckets WHERE key = ?;", (key,)) as cursor:
+                row = await cursor.fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            await self.db.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?);",
+                                  (key, tokens - 1 if not wait else tokens, now))
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                await self.db.execute("DELETE FROM buckets WHERE updated < ?;", (now - self.idle,))
+            await self.db.execute("COMMIT;")
+        except BaseException:
+            await self.db.execute("ROLLBACK;")
+            raise
+        return wait
+
+
+def open_buckets(shared=RL_SHARED):
+    return SQLiteBuckets(shared) if shared else MemoryBuckets()
+
+
+class RateLimiter:
+    def __init__(self, target, buckets=None, client_rate=RL_CLIENT_RATE, session_rate=RL_SESSION_RATE,
+                 service_rates=None, burst=RL_BURST, concurrency=None, client_concurrency=RL_CLIENT_CONCURRENCY):
+        """
+        :param target: function of a request returning (service, route) it is for; service may be None
+        :param buckets: where the token buckets are kept; see open_buckets()
+        :param client_rate: requests a second per client IP
+        :param session_rate: requests a second per session
+        :param service_rates: {service: requests a second} for all clients together
+        :param burst: seconds worth of tokens each bucket holds
+        :param concurrency: {route: requests at once} for expensive routes
+        :param client_concurrency: requests at once per client on those routes
+        """
+        self.target = target
+        self.buckets = buckets or open_buckets()
+        self.client_rate = client_rate
+        self.session_rate = session_rate
+        self.service_rates = parse_limits(RL_SERVICE_RATES) if service_rates is None else service_rates
+        self.burst = burst
+        self.concurrency = parse_limits(RL_CONCURRENCY) if concurrency is None else concurrency
+        self.client_concurrency = client_concurrency
+        self.in_flight = {}
+        self.limited = 0
+
+    async def _take(self, key, rate) -> float:
+        if not rate:
+            return 0.0
+        return await self.buckets.take(key, rate, max(1.0, rate * self.burst))
+
+    async def wait_needed(self, request, client, service) -> float:
+        """ Take a token from each bucket the request draws on; the seconds to wait if one was empty """
+        wait = await self._take(f"client:{client}", self.client_rate)
+        if not wait:
+            session = current_session(request)
+            if session is not None:
+                wait = await self._take(f"session:{session.id}", self.session_rate)
+        if not wait and service is not None:
+            wait = await self._take(f"service:{service}", self.service_rates.get(service, 0))
+        return wait
+
+    def _refuse(self, status, wait, text) -> web.Response:
+        self.limited += 1
+        return web.Response(status=status, text=text, headers={hdrs.RETRY_AFTER: str(max(1, math.ceil(wait)))})
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """ Refuse requests over their rate or concurrency limits before they reach a handler """
+        service, route = self.target(request)
+        client = request.remote or ""
+        wait = await self.wait_needed(request, client, service)
+        if wait:
+            return self._refuse(429, wait, "Too many requests, please slow down")
+        cap = self.concurrency.get(route)
+        if not cap:
+            return await handler(request)
+        keys = (("route", route), ("client", route, client))
+        if self.in_flight.get(keys[0], 0) >= cap:
+            return self._refuse(503, 1, f"{route} is busy, please try again shortly")
+        if self.in_flight.get(keys[1], 0) >= self.client_concurrency:
+            return self._refuse(429, 1, f"Too many {route} requests at once")
+        for key in keys:
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        try:
+            return await handler(request)
+        finally:
+            for key in keys:
+                self.in_flight[key] -= 1
+                if not self.in_flight[key]:
+                    del self.in_flight[key]
+
+
+def setup_rate_limits(app: web.Application, target, key="rate_limiter", **kwargs) -> None:
+    """
+    Limit every request to the app by client, session, service and route.
+    Must be called before the app starts; the earlier it is called, the less work a refused request costs.
+    :param target: function of a request returning (service, route), see RateLimiter
+    """
+    app[key] = RateLimiter(target, **kwargs)
+    app.middlewares.append(app[key].middleware)
+
+    async def buckets_ctx(app):
+        await app[key].buckets.open()
+        yield
+        await app[key].buckets.close()
+
+    app.cleanup_ctx.append(buckets_ctx)
@@ -0,0 +1,235 @@
+"""
+Dragon Cafe Gateway Response Cache | Org: Alta3 Research Inc.
+
+Pages such as /menu and the /fortune_cookie landing page are the same for every
+visitor, so the gateway keeps the upstream response in memory instead of
+proxying every hit:
+
+    - only routes given a TTL are cached, e.g. GW_CACHE_TTLS="menu=5,fortune_cookie=60"
+    - Cache-Control from upstream wins: no-store, no-cache and private responses
+      are never stored, and s-maxage / max-age replace the route's TTL
+    - an expired entry is still served for up to GW_CACHE_STALE seconds (or the
+      upstream's stale-while-revalidate) while it is refreshed in the background
+    - concurrent misses for the same key share one upstream fetch
+    - refreshes revalidate with If-None-Match, so an unchanged page costs a 304
+    - clients sending a matching If-None-Match get a 304 from the gateway
+    - entries are evicted least recently used once GW_CACHE_MAX_BYTES is reached
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiohttp import hdrs, web
+from multidict import CIMultiDict
+
+from dragon_common.static import etag_matches
+
+log = logging.getLogger(__name__)
+
+CACHE_STALE = float(os.getenv("GW_CACHE_STALE", 30))
+CACHE_MAX_BYTES = int(os.getenv("GW_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+CACHE_MAX_ENTRY = int(os.getenv("GW_CACHE_MAX_ENTRY", 1024 * 1024))
+
+CACHEABLE_STATUS = frozenset([200, 203, 301, 404, 410])
+# Headers that are only sent along with a 304
+VALIDATOR_HEADERS = frozenset(["etag", "cache-control", "vary", "expires", "last-modified"])
+# Headers the cache sets itself
+SKIPPED_HEADERS = frozenset(["content-length", "transfer-encoding", "connection", "keep-alive", "age"])
+
+
+def parse_ttls(spec) -> dict:
+    """ Parse a per route setting such as "menu=5,fortune_cookie=60" into {route: seconds} """
+    ttls = {}
+    for pair in filter(None, (p.strip() for p in (spec or "").split(","))):
+        route, _, seconds = pair.partition("=")
+        ttls[route.strip().strip("/")] = float(seconds)
+    return ttls
+
+
+def parse_cache_control(value) -> dict:
+    """ Split a Cache-Control header into {directive: value}, with True for bare directives """
+    directives = {}
+    for part in filter(None, (p.strip() for p in (value or "").split(","))):
+        name, sep, arg = part.partition("=")
+        directives[name.strip().lower()] = arg.strip().strip('"') if sep else True
+    return directives
+
+
+def _seconds(directives, *names):
+    for name in names:
+        try:
+            return float(directives[name])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+def freshness(headers, ttl, stale=CACHE_STALE):
+    """
+    Work out how long a response may be cached, honouring its Cache-Control.
+    :return: (ttl, stale) in seconds, or None if the response must not be stored
+    """
+    directives = parse_cache_control(headers.get(hdrs.CACHE_CONTROL))
+    if directives.keys() & {"no-store", "no-cache", "private"}:
+        return None
+    if hdrs.SET_COOKIE in headers:
+        return None
+    vary = {v.strip().lower() for v in headers.get(hdrs.VARY, "").split(",") if v.strip()}
+    # Entries are keyed on the negotiated content-coding, and API entries on the negotiated media type
+    if vary - {"accept-encoding", "accept"}:
+        return None
+    upstream_ttl = _seconds(directives, "s-maxage", "max-age")
+    upstream_stale = _seconds(directives, "stale-while-revalidate")
+    ttl = ttl if upstream_ttl is None else upstream_ttl
+    stale = stale if upstream_stale is None else upstream_stale
+    if ttl <= 0:
+        return None
+    return ttl, stale
+
+
+class CachedResponse:
+    """ A fully read upstream response and how long it may be served """
+    __slots__ = ("status", "headers", "body", "etag", "stored", "ttl", "stale")
+
+    def __init__(self, status, headers, body, ttl=0.0, stale=0.0):
+        """
+        :param headers: upstream headers, hop-by-hop headers already removed
+        :param ttl: seconds the response is fresh; 0 means it is handed out once and not stored
+        :param stale: seconds past its ttl it may still be served while it is refreshed
+        """
+        self.status = status
+        self.headers = CIMultiDict((k, v) for k, v in headers.items() if k.lower() not in SKIPPED_HEADERS)
+        self.body = body
+        self.etag = self.headers.get(hdrs.ETAG)
+        if self.etag is None and status == 200:
+            self.etag = self.headers[hdrs.ETAG] = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        self.stored = time.monotonic()
+        self.ttl = ttl
+        self.stale = stale
+
+    @classmethod
+    def from_upstream(cls, status, headers, body, ttl, stale=CACHE_STALE) -> "CachedResponse":
+        """ Build an entry, with its lifetime taken from the route's ttl and the upstream's Cache-Control """
+        policy = freshness(headers, ttl, stale) if status in CACHEABLE_STATUS else None
+        ttl, stale = policy or (0.0, 0.0)
+        return cls(status, headers, body, ttl, stale)
+
+    def revalidated(self, headers, ttl, stale=CACHE_STALE) -> "CachedResponse":
+        """ The entry to keep after upstream answered 304 Not Modified with these headers """
+        merged = CIMultiDict(self.headers)
+        for name, value in headers.items():
+            if name.lower() in VALIDATOR_HEADERS:
+                merged[name] = value
+        return CachedResponse.from_upstream(self.status, merged, self.body, ttl, stale)
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers.items())
+
+    def age(self, now=None) -> float:
+        return (now or time.monotonic()) - self.stored
+
+    def fresh(self, now=None) -> bool:
+        return self.age(now) < self.ttl
+
+    def usable(self, now=None) -> bool:
+        """ Fresh, or stale but still within its stale-while-revalidate window """
+        return self.age(now) < self.ttl + self.stale
+
+    def respond(self, request, state="HIT") -> web.Response:
+        """
+        Build the response for one client, a 304 if it already holds this version
+        :param state: reported in the X-Cache header, e.g. HIT, MISS or STALE
+        """
+        if self.status == 200 and etag_matches(request.headers.get(hdrs.IF_NONE_MATCH), self.etag):
+            headers = CIMultiDict((k, v) for k, v in self.headers.items() if k.lower() in VALIDATOR_HEADERS)
+            response = web.Response(status=304, headers=headers)
+        else:
+            response = web.Response(status=self.status, body=self.body, headers=CIMultiDict(self.headers))
+        response.headers[hdrs.AGE] = str(int(self.age()))
+        response.headers["X-Cache"] = state
+        return response
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, max_entry=CACHE_MAX_ENTRY):
+        """
+        :param max_bytes: total size of the cached bodies and headers before the least recently used are evicted
+        :param max_entry: responses larger than this are never stored
+        """
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self.size = 0
+        self._entries = OrderedDict()
+        self._fetching = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key, fetch):
+        """
+        Return (entry, state) for a key, fetching it if needed.
+        :param fetch: coroutine function fetch(previous) -> CachedResponse; previous is the
+                      entry being replaced, if any, so the fetch can revalidate it
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            now = time.monotonic()
+            if entry.fresh(now):
+                self._entries.move_to_end(key)
+                return entry, "HIT"
+            if entry.usable(now):
+                self._entries.move_to_end(key)
+                self._start(key, fetch)
+                return entry, "STALE"
+        try:
+            return await asyncio.shield(self._start(key, fetch)), "MISS"
+        except Exception:
+            # Better an expired page than an error page
+            if entry is not None:
+                return entry, "STALE"
+            raise
+
+    def invalidate(self, key=None) -> None:
+        """ Drop one key, or everything """
+        if key is None:
+            self._entries.clear()
+            self.size = 0
+        elif key in self._entries:
+            self.size -= self._entries.pop(key).size
+
+    def _start(self, key, fetch) -> asyncio.Future:
+        """ Start fetching a key, or join the fetch that is already in flight """
+        task = self._fetching.get(key)
+        if task is None:
+            task = self._fetching[key] = asyncio.ensure_future(self._fetch(key, fetch))
+            task.add_done_callback(self._fetched)
+        return task
+
+    @staticmethod
+    def _fetched(task) -> None:
+        # Background refreshes have nobody awaiting them, so report their failures here
+        if not task.cancelled() and task.exception() is not None:
+            log.warning("Refreshing a cached response failed: %r", task.exception())
+
+    async def _fetch(self, key, fetch) -> CachedResponse:
+        try:
+            entry = await fetch(self._entries.get(key))
+        finally:
+            self._fetching.pop(key, None)
+        self._store(key, entry)
+        return entry
+
+    def _store(self, key, entry) -> None:
+        self.invalidate(key)
+        if entry.ttl <= 0 or entry.size > self.max_entry:
+            return
+        self._entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
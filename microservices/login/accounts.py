@@ -0,0 +1,233 @@
+"""
+Dragon Cafe Login Accounts | Org: Alta3 Research Inc.
+
+Names and password verifiers live in SQLite (LOGIN_DB). Passwords are hashed
+with scrypt, which is deliberately slow. Accounts are added from the command
+line, which asks for the password:
+
+    python3 accounts.py add <name>
+
+LOGIN_AUTO_REGISTER=true lets the first login under a new name create the
+account instead; it is off by default, since then any name and password log in.
+
+Hashing runs in a pool of LOGIN_WORKERS processes, so neither the event loop
+nor the GIL is held while a login is checked. At most LOGIN_QUEUE_DEPTH logins
+wait for a free worker; past that, logins are refused at once with Saturated,
+which the service answers with a 503 and Retry-After, instead of letting the
+queue and everyone's latency grow without bound during a rush.
+"""
+
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+import functools
+import getpass
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+import aiosqlite
+from aiohttp import web
+
+LOGIN_DB = os.getenv("LOGIN_DB", "login.db")
+LOGIN_AUTO_REGISTER = os.getenv("LOGIN_AUTO_REGISTER", "false").lower() == "true"
+SCRYPT_N = int(os.getenv("LOGIN_SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.getenv("LOGIN_SCRYPT_R", 8))
+SCRYPT_P = int(os.getenv("LOGIN_SCRYPT_P", 1))
+LOGIN_WORKERS = int(os.getenv("LOGIN_WORKERS", os.cpu_count() or 1))
+LOGIN_QUEUE_DEPTH = int(os.getenv("LOGIN_QUEUE_DEPTH", 4 * LOGIN_WORKERS))
+LOGIN_RETRY_AFTER = int(os.getenv("LOGIN_RETRY_AFTER", 1))
+
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, salt=None) -> str:
+    """ A verifier for the password, in the form scrypt$n$r$p$salt$hash """
+    salt = salt or secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024)
+    return "$".join(["scrypt", str(n), str(r), str(p),
+                     base64.b64encode(salt).decode("ascii"), base64.b64encode(digest).decode("ascii")])
+
+
+def verify_password(password, verifier) -> bool:
+    """ Check a password against a verifier made by hash_password(), in constant time """
+    try:
+        scheme, n, r, p, salt, digest = verifier.split("$")
+        if scheme != "scrypt":
+            return False
+        expected = hash_password(password, int(n), int(r), int(p), base64.b64decode(salt))
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected.rsplit("$", 1)[1], digest)
+
+
+# Checked against when the name is unknown, so a miss takes as long as a wrong password
+DUMMY_VERIFIER = hash_password(secrets.token_hex(8))
+
+
+def _timed(func, *args):
+    """ Run in the worker: func's result and the seconds the worker spent on it """
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+class Saturated(Exception):
+    """ Every hashing worker is busy and the queue is full; try again in retry_after seconds """
+
+    def __init__(self, retry_after=LOGIN_RETRY_AFTER):
+        super().__init__(f"Login is saturated, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class HashPool:
+    def __init__(self, workers=LOGIN_WORKERS, queue_depth=LOGIN_QUEUE_DEPTH):
+        """
+        :param workers: processes hashing passwords
+        :param queue_depth: jobs allowed to wait for a worker before new ones are refused
+        """
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.in_flight = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.started = time.monotonic()
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    async def run(self, func, *args):
+        """ Run func in a worker process, or raise Saturated if the queue is full """
+        if self.in_flight >= self.workers + self.queue_depth:
+            self.rejected += 1
+            raise Saturated()
+        loop = asyncio.get_event_loop()
+        started = time.monotonic()
+        job = self.executor.submit(_timed, func, *args)
+        self.in_flight += 1
+        self.submitted += 1
+        # The slot is freed when the job ends, not when the caller stops waiting: a request that
+        # is cancelled doesn't stop a hash that is already running, which still occupies a worker
+        job.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        result, busy = await asyncio.wrap_future(job)
+        self.busy_seconds += busy
+        self.wait_seconds += max(0.0, time.monotonic() - started - busy)
+        return result
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+
+    def metrics(self) -> dict:
+        """ Counters and gauges for the /metrics endpoint """
+        uptime = max(time.monotonic() - self.started, 1e-9)
+        return {
+            "login_hash_workers": self.workers,
+            "login_hash_queue_limit": self.queue_depth,
+            "login_hash_in_flight": self.in_flight,
+            "login_hash_busy_workers": min(self.in_flight, self.workers),
+            "login_hash_queued": self.queued,
+            "login_hash_submitted_total": self.submitted,
+            "login_hash_rejected_total": self.rejected,
+            "login_hash_seconds_total": round(self.busy_seconds, 6),
+            "login_hash_wait_seconds_total": round(self.wait_seconds, 6),
+            "login_hash_utilization": round(min(1.0, self.busy_seconds / (uptime * self.workers)), 6),
+        }
+
+    async def close(self) -> None:
+        """ Wait for the jobs in flight to finish, off the event loop """
+        await asyncio.get_event_loop().run_in_executor(None, functools.partial(self.executor.shutdown, wait=True))
+
+
+class Accounts:
+    def __init__(self, path=LOGIN_DB, auto_register=LOGIN_AUTO_REGISTER, pool=None):
+        """
+        :param path: the SQLite database file, created if it doesn't exist
+        :param auto_register: create the account when an unknown name logs in
+        :param pool: the HashPool passwords are hashed in; one of LOGIN_WORKERS processes if None
+        """
+        self.path = path
+        self.auto_register = auto_register
+        self.pool = pool or HashPool()
+        self.db = None
+
+    async def open(self) -> None:
+        self.db = await aiosqlite.connect(self.path)
+        await self.db.execute("PRAGMA journal_mode=WAL;")
+        await self.db.execute("CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, verifier TEXT NOT NULL);")
+        await self.db.commit()
+
+    async def close(self) -> None:
+        if self.db is not None:
+            await self.db.close()
+        await self.pool.close()
+
+    async def _run(self, func, *args):
+        return await self.pool.run(func, *args)
+
+    async def authenticate(self, name, password) -> bool:
+        """
+        True if the password is the name's, or the name is new and was just registered with it.
+        Raises Saturated if the hashing pool can't take the job.
+        """
+        async with self.db.execute("SELECT verifier FROM users WHERE name = ?;", (name,)) as cursor:
+            row = await cursor.fetchone()
+        if row is not None:
+            return await self._run(verify_password, password, row[0])
+        if not self.auto_register:
+            await self._run(verify_password, password, DUMMY_VERIFIER)
+            return False
+        verifier = await self._run(hash_password, password)
+        # A concurrent first login under the same name loses, and has to match the winner's password
+        await self.db.execute("INSERT OR IGNORE INTO users (name, verifier) VALUES (?, ?);", (name, verifier))
+        await self.db.commit()
+        async with self.db.execute("SELECT verifier FROM users WHERE name = ?;", (name,)) as cursor:
+            (stored,) = await cursor.fetchone()
+        return stored == verifier or await self._run(verify_password, password, stored)
+
+    async def add(self, name, password) -> None:
+        """ Create the account, or set a new password if it exists """
+        verifier = await self._run(hash_password, password)
+        await self.db.execute("INSERT OR REPLACE INTO users (name, verifier) VALUES (?, ?);", (name, verifier))
+        await self.db.commit()
+
+
+def setup_accounts(app: web.Application, key="accounts", **kwargs) -> None:
+    """ Open the account database when the app starts and close it on cleanup """
+    async def accounts_ctx(app):
+        app[key] = Accounts(**kwargs)
+        await app[key].open()
+        yield
+        await app[key].close()
+
+    app.cleanup_ctx.append(accounts_ctx)
+
+
+async def add_account(path, name, password) -> None:
+    accounts = Accounts(path, pool=HashPool(workers=1))
+    await accounts.open()
+    try:
+        await accounts.add(name, password)
+    finally:
+        await accounts.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage Dragon Cafe login accounts")
+    parser.add_argument("command", choices=["add"], help="add an account, or set a new password")
+    parser.add_argument("name")
+    parser.add_argument("--db", default=LOGIN_DB, help="the account database, LOGIN_DB by default")
+    args = parser.parse_args()
+    password = getpass.getpass(f"Password for {args.name}: ")
+    if not password or password != getpass.getpass("Again: "):
+        parser.exit(1, "The passwords are empty or don't match\n")
+    asyncio.run(add_account(args.db, args.name, password))
+    print(f"Saved the account {args.name}")
+
+
+if __name__ == "__main__":
+    main()
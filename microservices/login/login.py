@@ -6,13 +6,22 @@ Dragon Cafe Login Microservice | Author: Sam Griffith | Org: Alta3 Research Inc.
 This Login Microservice is the second part of the monolithic application of a Chinese Restaurant website that has been broken out into it's own service.
 """
 
-from aiohttp import web
-import jinja2
-from pathlib import Path
-import random
-import requests
+from aiohttp import hdrs, web
+from markupsafe import escape
 import socket
 import os
+import logging
+
+from dragon_common.api import api_error, api_response, decode
+from dragon_common.compression import setup_compression
+from dragon_common.logs import SampledAccessLogger, redact, setup_logging
+from dragon_common.registry_client import setup_registration
+from dragon_common.sessions import SESSION_COOKIE, Session, current_session, set_session_cookie, setup_sessions
+from dragon_common.static import prerender, static_page
+from dragon_common.templating import Page, precompile_templates
+from accounts import Saturated, setup_accounts
+
+log = logging.getLogger("login")
 
 HOST = os.getenv("LOGIN_HOST", "0.0.0.0")
 LOCAL_IP = socket.gethostbyname(socket.gethostname())
@@ -20,28 +29,9 @@ PORT = os.getenv("LOGIN_PORT", 2228)
 REG_ADDR = os.getenv("SR_ADDRESS", "127.0.0.1")
 REG_PORT = os.getenv("SR_PORT", 55555)
 SERVICE = os.path.basename(__file__).rstrip(".py")
-
-
-class Page:
-    def __init__(self, filename, templates_dir=Path("templates"), args={}, cookies={}):
-        """
-        Create a new instance of an html page to be returned
-        :param filename: name of file found in the templates_dir
-        """
-        self.path = templates_dir
-        self.file = templates_dir / filename
-        self.args = args
-        self.cookies = cookies
-
-    def render(self):
-        with open(self.file) as f:
-            txt = f.read()
-            print(f"Templating in {self.args}")
-            j2 = jinja2.Template(txt).render(self.args)
-            resp = web.Response(text=j2, content_type='text/html')
-            for c, j in self.cookies:
-                resp.set_cookie(c, j)
-            return resp
+# /metrics has its own listener, on the loopback interface unless set otherwise, so the gateway never exposes it
+METRICS_HOST = os.getenv("LOGIN_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("LOGIN_METRICS_PORT", 9228))
 
 
 def routes(app: web.Application) -> None:
@@ -51,6 +41,9 @@ def routes(app: web.Application) -> None:
             web.get("/login", login),
             web.post("/logging_in", logging_in),
             web.post("/login/logging_in", logging_in),
+            web.post("/logout", logout),
+            web.post("/login/logout", logout),
+            web.post("/api/login", api_login),
         ]
     )
 
@@ -59,51 +52,127 @@ async def logging_in(request):
     """
     This is the page that gets POSTED to to allow a user to login
     """
-    print(request)
     if request.method == 'POST':
         data = await request.post()
-        name = data['name']
-        print("POSTED")
-        print(name)
-        # TODO - Add authentication logic
-        get_login = await login(request, name=name)
-        return get_login
+        name, password = data.get("name", ""), data.get("password", "")
+        log.debug("Login attempt by %s", redact(name))
+        if not name or not password:
+            return login_failed("Please enter your name and password", 400)
+        try:
+            authenticated = await request.app["accounts"].authenticate(name, password)
+        except Saturated as err:
+            raise web.HTTPServiceUnavailable(text="Too many logins right now, please try again shortly",
+                                             headers={hdrs.RETRY_AFTER: str(err.retry_after)})
+        if not authenticated:
+            return login_failed("That name and password don't match", 401)
+        session = await start_session(request, name)
+        response = hello(name)
+        set_session_cookie(response, request.app["session_signer"], session)
+        return response
 
 
 async def login(request, name=None):
     """
-    This is the login page for the website
+    This is the login page for the website, or the welcome page if the visitor is logged in
     """
-    print(request)
+    if name is None:
+        session = await live_session(request)
+        name = session.name if session is not None else None
     if name is not None:
-        page = Page(filename="hello.html", args={"name": name})
-        print("Cookies Set?")
-        return page.render()
+        return hello(name)
     else:
-        print("No name has been sent yet!")
-        args = {"name": name}
-        page = Page(filename="login.html", args=args)
-        return page.render()
+        log.debug("No name has been sent yet")
+        return static_page("login.html").response(request)
+
+
+async def logout(request) -> web.Response:
+    """
+    End the visitor's session and show the login page again.
+    POST only: the session cookie is SameSite=Lax, so another site can't make a browser send it with one.
+    """
+    session = current_session(request)
+    if session is not None:
+        await request.app["sessions"].delete(session.id)
+    response = static_page("login.html").response(request)
+    response.del_cookie(SESSION_COOKIE)
+    return response
+
+
+def hello(name) -> web.Response:
+    """ The welcome page; it is personal, so no shared cache may keep it """
+    response = Page(filename="hello.html", args={"name": escape(name)}).render()
+    response.headers[hdrs.CACHE_CONTROL] = "private, no-cache"
+    return response
 
-async def register(add_to_registry=True):
-    print(f"""
-    Service Registry {REG_ADDR}:{REG_PORT}
 
-    Adding to the Service Registry:
+def login_failed(message, status) -> web.Response:
+    response = Page(filename="login.html", args={"error": message}).render()
+    response.set_status(status)
+    return response
+
+
+async def start_session(request, name) -> Session:
+    session = Session.new(name)
+    await request.app["sessions"].put(session)
+    return session
+
+
+async def live_session(request):
+    """ The visitor's session if its cookie checks out and it hasn't been logged out """
+    session = current_session(request)
+    if session is None:
+        return None
+    return await request.app["sessions"].get(session.id)
+
+
+async def api_login(request) -> web.Response:
+    """
+    The login for API clients: takes the name and password as JSON, msgpack or a form and answers in kind
+    """
+    try:
+        data = await decode(request)
+    except ValueError:
+        return api_error(request, 400, "The body could not be decoded")
+    if not isinstance(data, dict):
+        return api_error(request, 400, "The body must be an object")
+    name, password = data.get("name"), data.get("password")
+    if not isinstance(name, str) or not name or not isinstance(password, str) or not password:
+        return api_error(request, 400, "name and password are required")
+    try:
+        authenticated = await request.app["accounts"].authenticate(name, password)
+    except Saturated as err:
+        return api_response(request, {"error": "Too many logins right now"}, status=503,
+                            headers={hdrs.RETRY_AFTER: str(err.retry_after)})
+    if not authenticated:
+        return api_error(request, 401, "That name and password don't match")
+    session = await start_session(request, name)
+    response = api_response(request, {"name": name, "expires": session.expires},
+                            headers={hdrs.CACHE_CONTROL: "private, no-cache"})
+    set_session_cookie(response, request.app["session_signer"], session)
+    return response
+
+
+async def metrics(request) -> web.Response:
+    """
+    The hashing pool's utilization, in the Prometheus text format
+    """
+    lines = [f"{name} {value}" for name, value in request.app["accounts"].pool.metrics().items()]
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
 
-    service name     {SERVICE}
-    service IP       {LOCAL_IP}
-    service port     {PORT}
-    """)
-    if add_to_registry:
-        r = requests.get(f"http://{REG_ADDR}:{REG_PORT}/add/{SERVICE}/{LOCAL_IP}/{PORT}")
-        print(r.status_code, r.text)
 
+def setup_metrics(app: web.Application, host=METRICS_HOST, port=METRICS_PORT) -> None:
+    """ Serve /metrics on host:port, apart from the public routes; must be set up after setup_accounts() """
+    async def metrics_ctx(app):
+        metrics_app = web.Application()
+        metrics_app["accounts"] = app["accounts"]
+        metrics_app.router.add_get("/metrics", metrics)
+        runner = web.AppRunner(metrics_app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        yield
+        await runner.cleanup()
 
-async def unregister(remove_from_registry=True):
-    if remove_from_registry:
-        r = requests.get(f"http://{REG_ADDR}:{REG_PORT}/remove/{SERVICE}/{LOCAL_IP}/{PORT}")
-        print(r.status_code)
+    app.cleanup_ctx.append(metrics_ctx)
 
 
 def main():
@@ -116,12 +185,18 @@ def main():
     event loop with web.run_app().
     """
 
-    print("This aiohttp web server is starting up!")
+    setup_logging()
+    log.info("This aiohttp web server is starting up!")
     app = web.Application()
     routes(app)
-    app.on_startup.append(register)
-    app.on_shutdown.append(unregister)
-    web.run_app(app, host=HOST, port=PORT)
+    setup_compression(app)
+    setup_sessions(app, store=True)
+    setup_accounts(app)
+    setup_metrics(app)
+    app.on_startup.append(precompile_templates)
+    app.on_startup.append(prerender("login.html"))
+    setup_registration(app, SERVICE, LOCAL_IP, PORT, f"http://{REG_ADDR}:{REG_PORT}")
+    web.run_app(app, host=HOST, port=PORT, access_log_class=SampledAccessLogger)
 
 
 if __name__ == "__main__":
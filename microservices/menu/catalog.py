@@ -0,0 +1,373 @@
+"""
+Dragon Cafe Menu Catalog | Org: Alta3 Research Inc.
+
+The menu lives in SQLite (MENU_DB): categories, and items with a price and an
+availability flag. Requests never query it:
+
+    - triggers bump a version counter on every change to the catalog, from this
+      process or any other connection, e.g. the sqlite3 shell
+    - every MENU_POLL_INTERVAL seconds the counter is read, and only when it has
+      moved is the in-memory snapshot of the catalog rebuilt
+    - the rendered menu page is cached per version, so serving /menu costs no
+      query and no templating however many items the catalog has
+
+/menu also takes a listing query: category, min_price and max_price filter the
+menu, page and per_page split it into pages, and stream=true sends the page out
+in chunks as the template renders instead of building it in memory first.
+Filtered and paged listings are answered by indexed queries. /api/menu takes
+the same query and returns the listing as JSON or msgpack.
+"""
+
+import asyncio
+import decimal
+import hashlib
+import logging
+import os
+
+import aiosqlite
+from aiohttp import hdrs, web
+
+from dragon_common.api import api_error, encode, negotiate
+from dragon_common.static import etag_matches
+from dragon_common.templating import TEMPLATES_DIR, get_engine
+
+log = logging.getLogger(__name__)
+
+MENU_DB = os.getenv("MENU_DB", "menu.db")
+MENU_POLL_INTERVAL = float(os.getenv("MENU_POLL_INTERVAL", 0.5))
+MENU_PAGE_SIZE = int(os.getenv("MENU_PAGE_SIZE", 50))
+MENU_MAX_PAGE_SIZE = int(os.getenv("MENU_MAX_PAGE_SIZE", 500))
+MENU_STREAM_CHUNK = int(os.getenv("MENU_STREAM_CHUNK", 16 * 1024))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    position INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    category_id INTEGER NOT NULL REFERENCES categories (id),
+    item TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    price_cents INTEGER NOT NULL CHECK (price_cents >= 0),
+    available INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS items_category ON items (category_id, available, price_cents);
+CREATE INDEX IF NOT EXISTS items_price ON items (available, price_cents);
+CREATE TABLE IF NOT EXISTS catalog_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0);
+"""
+VERSIONED_TABLES = ("categories", "items")
+TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS {table}_{event}_version AFTER {event} ON {table}
+BEGIN
+    UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+END;
+"""
+# What the menu used to hard-code, so a fresh database isn't empty
+SEED = [
+    ("Entrees", "General Tzo's Chicken", "Yummy chicken on rice", 1299),
+    ("Entrees", "Kung Pao Beef", "Spicy Beef on rice", 1399),
+]
+ITEM_COLUMNS = """
+SELECT items.id, categories.name, items.item, items.description, items.price_cents, items.available
+FROM items JOIN categories ON categories.id = items.category_id
+"""
+ITEM_ORDER = "ORDER BY categories.position, categories.name, items.item, items.id"
+SNAPSHOT_QUERY = f"{ITEM_COLUMNS} {ITEM_ORDER};"
+
+
+class MenuItem:
+    __slots__ = ("id", "category", "item", "description", "price_cents", "available")
+
+    def __init__(self, id, category, item, description, price_cents, available):
+        self.id = id
+        self.category = category
+        self.item = item
+        self.description = description
+        self.price_cents = price_cents
+        self.available = bool(available)
+
+    @property
+    def price(self) -> str:
+        return f"{self.price_cents / 100:.2f}"
+
+    def as_dict(self) -> dict:
+        return {"id": self.id, "category": self.category, "item": self.item, "description": self.description,
+                "price_cents": self.price_cents}
+
+
+class Snapshot:
+    """ The whole catalog at one version; never modified once built """
+
+    def __init__(self, version, items):
+        self.version = version
+        self.items = tuple(items)
+        self.available = tuple(item for item in self.items if item.available)
+        self.categories = tuple(dict.fromkeys(item.category for item in self.items))
+
+
+def to_cents(value, name) -> int:
+    try:
+        cents = decimal.Decimal(value) * 100
+    except decimal.InvalidOperation:
+        raise ValueError(f"{name} must be a price such as 12.99") from None
+    if not cents.is_finite() or cents < 0:
+        raise ValueError(f"{name} must be a price such as 12.99")
+    return int(cents.to_integral_value(decimal.ROUND_HALF_UP))
+
+
+def to_count(value, name, minimum=1, maximum=None) -> int:
+    try:
+        count = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a whole number") from None
+    if count < minimum or (maximum is not None and count > maximum):
+        raise ValueError(f"{name} must be between {minimum} and {maximum}" if maximum else
+                         f"{name} must be at least {minimum}")
+    return count
+
+
+class Listing:
+    """ Which part of the menu a request asked for, parsed from its query string """
+    __slots__ = ("category", "min_cents", "max_cents", "page", "per_page", "stream")
+
+    def __init__(self, category=None, min_cents=None, max_cents=None, page=None, per_page=MENU_PAGE_SIZE,
+                 stream=False):
+        self.category = category
+        self.min_cents = min_cents
+        self.max_cents = max_cents
+        self.page = page
+        self.per_page = per_page
+        self.stream = stream
+
+    @classmethod
+    def from_query(cls, query) -> "Listing":
+        """ Raises ValueError if a parameter doesn't parse """
+        listing = cls(category=query.get("category") or None, stream=query.get("stream", "").lower() == "true")
+        if query.get("min_price"):
+            listing.min_cents = to_cents(query["min_price"], "min_price")
+        if query.get("max_price"):
+            listing.max_cents = to_cents(query["max_price"], "max_price")
+        if query.get("per_page"):
+            listing.per_page = to_count(query["per_page"], "per_page", maximum=MENU_MAX_PAGE_SIZE)
+        if query.get("page") or query.get("per_page"):
+            listing.page = to_count(query.get("page") or 1, "page")
+        return listing
+
+    @property
+    def whole_menu(self) -> bool:
+        """ True if nothing narrows the listing down, so the cached full page answers it """
+        return self.category is None and self.min_cents is None and self.max_cents is None and self.page is None
+
+    def query(self):
+        """ The SQL and parameters that select this listing; one extra row tells if there is a next page """
+        where, params = ["items.available = 1"], []
+        if self.category is not None:
+            where.append("categories.name = ?")
+            params.append(self.category)
+        if self.min_cents is not None:
+            where.append("items.price_cents >= ?")
+            params.append(self.min_cents)
+        if self.max_cents is not None:
+            where.append("items.price_cents <= ?")
+            params.append(self.max_cents)
+        sql = f"{ITEM_COLUMNS} WHERE {' AND '.join(where)} {ITEM_ORDER}"
+        if self.page is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [self.per_page + 1, (self.page - 1) * self.per_page]
+        return sql + ";", params
+
+
+class Catalog:
+    def __init__(self, path=MENU_DB, poll_interval=MENU_POLL_INTERVAL, filename="menu.html",
+                 templates_dir=TEMPLATES_DIR):
+        """
+        :param path: the SQLite database file, created and seeded if it doesn't exist
+        :param poll_interval: seconds between checks of the version counter
+        :param filename: template the menu page is rendered with
+        """
+        self.path = path
+        self.poll_interval = poll_interval
+        self.filename = filename
+        self.templates_dir = templates_dir
+        self.db = None
+        self.snapshot = Snapshot(-1, ())
+        self._page = None
+        self._payloads = {}
+        self._task = None
+
+    async def open(self) -> None:
+        self.db = await aiosqlite.connect(self.path)
+        await self.db.execute("PRAGMA journal_mode=WAL;")
+        await self.db.executescript(SCHEMA + "".join(
+            TRIGGER.format(table=table, event=event)
+            for table in VERSIONED_TABLES for event in ("INSERT", "UPDATE", "DELETE")))
+        await self.db.commit()
+        await self.seed()
+        await self.reload()
+        self._task = asyncio.ensure_future(self._poll())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self.db is not None:
+            await self.db.close()
+
+    async def seed(self) -> None:
+        async with self.db.execute("SELECT COUNT(*) FROM items;") as cursor:
+            (count,) = await cursor.fetchone()
+        if count:
+            return
+        for category, item, description, price_cents in SEED:
+            await self.db.execute("INSERT OR IGNORE INTO categories (name) VALUES (?);", (category,))
+            await self.db.execute(
+                "INSERT INTO items (category_id, item, description, price_cents) "
+                "SELECT id, ?, ?, ? FROM categories WHERE name = ?;",
+                (item, description, price_cents, category))
+        await self.db.commit()
+
+    async def version(self) -> int:
+        async with self.db.execute("SELECT version FROM catalog_version WHERE id = 1;") as cursor:
+            (version,) = await cursor.fetchone()
+        return version
+
+    async def reload(self) -> bool:
+        """ Rebuild the snapshot if the catalog changed since it was taken; True if it did """
+        version = await self.version()
+        if version == self.snapshot.version:
+            return False
+        async with self.db.execute(SNAPSHOT_QUERY) as cursor:
+            items = [MenuItem(*row) async for row in cursor]
+        # A change that landed during the read bumps the version again, so the next poll catches it
+        self.snapshot = Snapshot(version, items)
+        log.info("Loaded menu version %s: %d items", version, len(items))
+        return True
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.reload()
+            except aiosqlite.Error as err:
+                log.warning("Reloading the menu failed: %r", err)
+
+    def page(self):
+        """ The rendered menu of the current snapshot, as (body, etag); rendered once per version and template """
+        snapshot = self.snapshot
+        template = get_engine(self.templates_dir).get(self.filename)
+        if self._page is None or self._page[0] is not snapshot or self._page[1] is not template:
+            body = template.render({"foods": snapshot.available}).encode("utf-8")
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            self._page = (snapshot, template, body, etag)
+        return self._page[2], self._page[3]
+
+    async def items(self, listing):
+        """ The available items of a listing, and whether there is a page after it """
+        sql, params = listing.query()
+        async with self.db.execute(sql, params) as cursor:
+            items = [MenuItem(*row) async for row in cursor]
+        if listing.page is not None and len(items) > listing.per_page:
+            return items[:listing.per_page], True
+        return items, False
+
+    async def listing(self, request) -> web.StreamResponse:
+        """ Answer /menu: the cached full page unless the query narrows it down or asks for a stream """
+        try:
+            listing = Listing.from_query(request.query)
+        except ValueError as err:
+            raise web.HTTPBadRequest(text=str(err))
+        if listing.whole_menu and not listing.stream:
+            return self.response(request)
+        if listing.whole_menu:
+            items, more = self.snapshot.available, False
+        else:
+            items, more = await self.items(listing)
+        args = {"foods": items}
+        args.update(self.page_urls(request, listing, more))
+        if listing.stream:
+            return await self.stream(request, args)
+        return web.Response(text=get_engine(self.templates_dir).render(self.filename, args), content_type="text/html")
+
+    @staticmethod
+    def page_urls(request, listing, more) -> dict:
+        """
+        Links to the pages either side of this one, when it is paged.
+        They carry only the query string, so they resolve against whatever path the client used,
+        e.g. /menu/menu through the gateway rather than this service's own /menu.
+        """
+        urls = {}
+        if listing.page is not None:
+            if listing.page > 1:
+                urls["prev_url"] = "?" + request.rel_url.update_query(page=listing.page - 1).query_string
+            if more:
+                urls["next_url"] = "?" + request.rel_url.update_query(page=listing.page + 1).query_string
+        return urls
+
+    async def api(self, request) -> web.Response:
+        """ Answer /api/menu: the same listings as /menu, as JSON or msgpack """
+        try:
+            listing = Listing.from_query(request.query)
+        except ValueError as err:
+            return api_error(request, 400, str(err))
+        media_type = negotiate(request.headers.get(hdrs.ACCEPT))
+        headers = {hdrs.CONTENT_TYPE: media_type, hdrs.VARY: hdrs.ACCEPT}
+        if not listing.whole_menu:
+            items, more = await self.items(listing)
+            payload = {"version": self.snapshot.version, "items": [item.as_dict() for item in items]}
+            payload.update(self.page_urls(request, listing, more))
+            return web.Response(body=encode(payload, media_type), headers=headers)
+        snapshot = self.snapshot
+        cached = self._payloads.get(media_type)
+        if cached is None or cached[0] is not snapshot:
+            body = encode({"version": snapshot.version, "items": [item.as_dict() for item in snapshot.available]},
+                          media_type)
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            cached = self._payloads[media_type] = (snapshot, body, etag)
+        headers[hdrs.ETAG] = cached[2]
+        if etag_matches(request.headers.get(hdrs.IF_NONE_MATCH), cached[2]):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=cached[1], headers=headers)
+
+    async def stream(self, request, args) -> web.StreamResponse:
+        """ Send the page as it renders, MENU_STREAM_CHUNK characters at a time """
+        # no-store, so a cache in front of the service passes the stream through instead of buffering it
+        response = web.StreamResponse(headers={hdrs.CONTENT_TYPE: "text/html; charset=utf-8",
+                                               hdrs.CACHE_CONTROL: "no-store"})
+        # Streams pass the compression middleware by, so they are gzipped chunk by chunk as they go out
+        response.enable_compression()
+        await response.prepare(request)
+        chunk, size = [], 0
+        for text in get_engine(self.templates_dir).get(self.filename).generate(args):
+            chunk.append(text)
+            size += len(text)
+            if size >= MENU_STREAM_CHUNK:
+                await response.write("".join(chunk).encode("utf-8"))
+                chunk, size = [], 0
+        if chunk:
+            await response.write("".join(chunk).encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    def response(self, request) -> web.Response:
+        """ The menu page, or a 304 if the client already has this version """
+        body, etag = self.page()
+        if etag_matches(request.headers.get(hdrs.IF_NONE_MATCH), etag):
+            return web.Response(status=304, headers={hdrs.ETAG: etag})
+        return web.Response(body=body, headers={hdrs.CONTENT_TYPE: "text/html; charset=utf-8", hdrs.ETAG: etag})
+
+
+def setup_catalog(app: web.Application, key="catalog", **kwargs) -> None:
+    """ Open the catalog when the app starts and close it on cleanup """
+    async def catalog_ctx(app):
+        app[key] = Catalog(**kwargs)
+        await app[key].open()
+        yield
+        await app[key].close()
+
+    app.cleanup_ctx.append(catalog_ctx)
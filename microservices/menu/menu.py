@@ -7,12 +7,17 @@ This Menu Microservice is the first part of the monolithic application of a Chin
 """
 
 from aiohttp import web
-import jinja2
-from pathlib import Path
-import random
-import requests
 import socket
 import os
+import logging
+
+from dragon_common.compression import setup_compression
+from dragon_common.logs import SampledAccessLogger, setup_logging
+from dragon_common.registry_client import setup_registration
+from dragon_common.templating import precompile_templates
+from catalog import setup_catalog
+
+log = logging.getLogger("menu")
 
 HOST = os.getenv("MENU_HOST", "0.0.0.0")
 LOCAL_IP = socket.gethostbyname(socket.gethostname())
@@ -22,70 +27,29 @@ REG_PORT = os.getenv("SR_PORT", 55555)
 SERVICE = os.path.basename(__file__).rstrip(".py")
 
 
-class Page:
-    def __init__(self, filename, templates_dir=Path("templates"), args={}, cookies={}):
-        """
-        Create a new instance of an html page to be returned
-        :param filename: name of file found in the templates_dir
-        """
-        self.path = templates_dir
-        self.file = templates_dir / filename
-        self.args = args
-        self.cookies = cookies
-
-    def render(self):
-        with open(self.file) as f:
-            txt = f.read()
-            print(f"Templating in {self.args}")
-            j2 = jinja2.Template(txt).render(self.args)
-            resp = web.Response(text=j2, content_type='text/html')
-            for c, j in self.cookies:
-                resp.set_cookie(c, j)
-            return resp
-
-
 def routes(app: web.Application) -> None:
     app.add_routes(
         [
             web.get("/", menu),
-            web.get("/menu", menu)
+            web.get("/menu", menu),
+            web.get("/api/menu", api_menu),
         ]
     )
 
 
 async def menu(request) -> web.Response:
     """
-    This will return the jinja2 templated menu.html file.
+    This will return the menu.html file rendered from the current catalog,
+    narrowed down, paged or streamed as the query string asks.
     """
-    print(request)
-    food_items = [
-        {"item": "General Tzo's Chicken", "description": "Yummy chicken on rice", "price": 12.99},
-        {"item": "Kung Pao Beef", "description": "Spicy Beef on rice", "price": 13.99}
-    ]  # TODO - Update to a sqlite3 database call
-    args = {"foods": food_items}
-    page = Page(filename="menu.html", args=args)
-    return page.render()
-
+    return await request.app["catalog"].listing(request)
 
-async def register(add_to_registry=True):
-    print(f"""
-    Service Registry {REG_ADDR}:{REG_PORT}
 
-    Adding to the Service Registry:
-
-    service name     {SERVICE}
-    service IP       {LOCAL_IP}
-    service port     {PORT}
-    """)
-    if add_to_registry:
-        r = requests.get(f"http://{REG_ADDR}:{REG_PORT}/add/{SERVICE}/{LOCAL_IP}/{PORT}")
-        print(r.status_code, r.text)
-
-
-async def unregister(remove_from_registry=True):
-    if remove_from_registry:
-        r = requests.get(f"http://{REG_ADDR}:{REG_PORT}/remove/{SERVICE}/{LOCAL_IP}/{PORT}")
-        print(r.status_code)
+async def api_menu(request) -> web.Response:
+    """
+    This will return the same menu listing as JSON, or msgpack if asked for.
+    """
+    return await request.app["catalog"].api(request)
 
 
 def main():
@@ -98,12 +62,15 @@ def main():
     event loop with web.run_app().
     """
 
-    print("This aiohttp web server is starting up!")
+    setup_logging()
+    log.info("This aiohttp web server is starting up!")
     app = web.Application()
     routes(app)
-    app.on_startup.append(register)
-    app.on_shutdown.append(unregister)
-    web.run_app(app, host=HOST, port=PORT)
+    setup_compression(app)
+    app.on_startup.append(precompile_templates)
+    setup_catalog(app)
+    setup_registration(app, SERVICE, LOCAL_IP, PORT, f"http://{REG_ADDR}:{REG_PORT}")
+    web.run_app(app, host=HOST, port=PORT, access_log_class=SampledAccessLogger)
 
 
 if __name__ == "__main__":
@@ -7,10 +7,19 @@ the /v2/menu path and route it to the menu
 microservice.
 """
 
-import json
-
 from aiohttp import web
-import requests
+import aiohttp
+import asyncio
+import os
+import logging
+
+from dragon_common.http_client import setup_client_session
+from dragon_common.logs import SampledAccessLogger, setup_logging
+
+log = logging.getLogger("passthrough")
+
+REG_ADDR = os.getenv("SR_ADDRESS", "127.0.0.1")
+REG_PORT = os.getenv("SR_PORT", 55555)
 
 
 def routes(app):
@@ -22,21 +31,29 @@ def routes(app):
 
 
 async def menu_v2(request) -> web.Response:
-    print(request)
-    menu_svc = requests.get("http://127.0.0.1:55555/get_one/menu").text
-    print(menu_svc)
-    menu_host = json.loads(menu_svc)
-    menu_ip = menu_host['endpoints'][0]
-    menu_port = menu_host['endpoints'][1]
-    r = requests.get(f"http://{menu_ip}:{menu_port}/menu")
-    return web.Response(text=r.text, content_type='text/html')
+    session = request.app["client_session"]
+    try:
+        async with session.get(f"http://{REG_ADDR}:{REG_PORT}/get_one/menu") as r:
+            menu_host = await r.json()
+        log.debug("The registry picked %s", menu_host)
+        if not menu_host.get('endpoints'):
+            raise web.HTTPServiceUnavailable(text="No menu service is available")
+        menu_ip, menu_port = menu_host['endpoints']
+        async with session.get(f"http://{menu_ip}:{menu_port}/menu") as r:
+            text = await r.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        log.warning("Upstream menu failed: %r", err)
+        raise web.HTTPBadGateway()
+    return web.Response(text=text, content_type='text/html')
 
 
 def main():
+    setup_logging()
     app = web.Application()
     routes(app)
-    web.run_app(app, host="0.0.0.0", port=3030)
+    setup_client_session(app)
+    web.run_app(app, host="0.0.0.0", port=3030, access_log_class=SampledAccessLogger)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,18 +1,444 @@
 #!/usr/bin/env python3
 
 from aiohttp import web
+import aiohttp
+import asyncio
+import collections
 import os
+import logging
 import aiosqlite
 import datetime
-import random
 import subprocess
 import jinja2
 import pwd
 import grp
+import time
+import uuid
+
+from dragon_common.balancing import Balancer, ewma, parse_strategies
+from dragon_common.compression import setup_compression
+from dragon_common.http_client import setup_client_session
+from dragon_common.logs import SampledAccessLogger, setup_logging
+
+log = logging.getLogger("service_registry")
 
 PORT = os.getenv("SR_PORT", 55555)
 HOST = os.getenv("SR_HOST", "0.0.0.0")
 DB_NAME = os.getenv("SR_DB_NAME", "service_registry.db")
+WATCH_TIMEOUT = float(os.getenv("SR_WATCH_TIMEOUT", 30))
+STATEMENT_CACHE = int(os.getenv("SR_STATEMENT_CACHE", 256))
+BUSY_TIMEOUT_MS = int(os.getenv("SR_BUSY_TIMEOUT_MS", 5000))
+FLUSH_INTERVAL = float(os.getenv("SR_FLUSH_INTERVAL", 1))
+FLUSH_BATCH = int(os.getenv("SR_FLUSH_BATCH", 500))
+STRATEGY = os.getenv("SR_STRATEGY", "random")
+STRATEGIES = os.getenv("SR_STRATEGIES", "")
+HEARTBEAT_TIMEOUT = float(os.getenv("SR_HEARTBEAT_TIMEOUT", 30))
+REAP_INTERVAL = float(os.getenv("SR_REAP_INTERVAL", 5))
+HEALTH_CHECK = os.getenv("SR_HEALTH_CHECK", "false").lower() == "true"
+HEALTH_CHECK_PATH = os.getenv("SR_HEALTH_CHECK_PATH", "/")
+HEALTH_CHECK_INTERVAL = float(os.getenv("SR_HEALTH_CHECK_INTERVAL", 15))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("SR_HEALTH_CHECK_TIMEOUT", 2))
+HEALTH_CHECK_CONCURRENCY = int(os.getenv("SR_HEALTH_CHECK_CONCURRENCY", 10))
+MAX_EJECTION = float(os.getenv("SR_MAX_EJECTION", 24 * 60 * 60))
+MAX_EJECTION_PERCENT = float(os.getenv("SR_MAX_EJECTION_PERCENT", 50))
+
+# Every add/remove bumps the service's version and wakes anyone long-polling /watch.
+# The boot id keeps versions from a previous run of the registry from ever matching.
+BOOT_ID = uuid.uuid4().hex[:8]
+VERSIONS = collections.defaultdict(int)
+CHANGED = {}
+
+
+class Instance:
+    __slots__ = ("service", "ip", "port", "heartbeat", "alive", "load", "latency", "ejected_until", "quarantined")
+
+    def __init__(self, service, ip, port, heartbeat, alive):
+        self.service = service
+        self.ip = ip
+        self.port = port
+        self.heartbeat = heartbeat
+        self.alive = alive
+        # Outstanding requests as of the last heartbeat, plus picks handed out since
+        self.load = 0
+        # EWMA of the response time the instance reports, in seconds
+        self.latency = 0.0
+        # Epoch time an instance ejected by a client's circuit breaker returns to rotation, 0 if it isn't ejected
+        self.ejected_until = 0.0
+        # Failed the registry's health check; out of rotation until a probe passes
+        self.quarantined = False
+
+    @property
+    def endpoint(self) -> tuple:
+        return self.ip, self.port
+
+
+class ServiceTable:
+    """
+    The registry's source of truth, held in memory.
+
+    Lookups never touch the disk: each service keeps a list of its live instances
+    next to a position index, so adding and removing are O(1), and so is picking
+    an endpoint with every strategy except least_outstanding. Every mutation marks
+    the instance dirty, and dirty instances are written behind to SQLite in batches
+    by flush().
+    """
+
+    def __init__(self, balancer: Balancer):
+        self.balancer = balancer
+        self.instances = {}
+        self.live = collections.defaultdict(list)
+        self._positions = collections.defaultdict(dict)
+        self.ejected = {}
+        self.quarantined = {}
+        self.dirty = {}
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+
+    def get(self, service, ip, port):
+        return self.instances.get(service, {}).get((ip, port))
+
+    def add(self, service, ip, port, now=None) -> Instance:
+        now = now or time.time()
+        instance = self.get(service, ip, port)
+        if instance is None:
+            instance = Instance(service, ip, port, now, False)
+            self.instances.setdefault(service, {})[(ip, port)] = instance
+        instance.heartbeat = now
+        # A (re)started instance gets a fresh start, even if it had been ejected,
+        # but one the registry can't reach stays out until a health check probe passes
+        self._restore(instance)
+        self._set_alive(instance, not instance.quarantined)
+        self._mark(instance)
+        return instance
+
+    def heartbeat(self, service, ip, port, now=None, load=None, latency=None):
+        """
+        Record a heartbeat, and the load it reports, for a live, ejected or quarantined instance.
+        Returns None if the instance is none of these.
+        """
+        instance = self.get(service, ip, port)
+        if instance is None or not (instance.alive or instance.ejected_until or instance.quarantined):
+            return None
+        instance.heartbeat = now or time.time()
+        if load is not None:
+            instance.load = load
+        if latency is not None:
+            instance.latency = ewma(instance.latency, latency)
+        self._mark(instance)
+        return instance
+
+    def remove(self, service, ip, port, now=None):
+        instance = self.get(service, ip, port)
+        if instance is None:
+            return None
+        instance.heartbeat = now or time.time()
+        self._restore(instance)
+        self._release(instance)
+        self._set_alive(instance, False)
+        self._mark(instance)
+        return instance
+
+    def eject(self, service, ip, port, seconds, now=None):
+        """
+        Take a live instance out of rotation for a while, e.g. because a client's circuit breaker
+        saw it fail. It keeps heartbeating, and returns once the ejection is over.
+        Returns None if the instance isn't live or ejected, and False if ejecting it would leave
+        more than MAX_EJECTION_PERCENT of the service's instances ejected.
+        """
+        instance = self.get(service, ip, port)
+        if instance is None or not (instance.alive or instance.ejected_until or instance.quarantined):
+            return None
+        if instance.quarantined:
+            # Already out of rotation until the health check passes
+            return instance
+        until = (now or time.time()) + min(seconds, MAX_EJECTION)
+        if instance.ejected_until:
+            instance.ejected_until = max(instance.ejected_until, until)
+            return instance
+        live = len(self.live.get(service, ()))
+        ejected = sum(1 for i in self.ejected.values() if i.service == service)
+        if live <= 1 or (ejected + 1) * 100 > MAX_EJECTION_PERCENT * (live + ejected):
+            return False
+        instance.ejected_until = until
+        self.ejected[(service, ip, port)] = instance
+        self._set_alive(instance, False)
+        self._mark(instance)
+        return instance
+
+    def return_ejected(self, now=None) -> list:
+        """ Put back every ejected instance whose ejection is over and that still heartbeats """
+        now = now or time.time()
+        returned = []
+        for instance in [i for i in self.ejected.values() if i.ejected_until <= now]:
+            self._restore(instance)
+            if instance.heartbeat >= now - HEARTBEAT_TIMEOUT and not instance.quarantined:
+                self._set_alive(instance, True)
+                self._mark(instance)
+                returned.append(instance)
+        return returned
+
+    def expire(self, instance: Instance) -> None:
+        """ Mark an instance dead without touching its last heartbeat """
+        self._release(instance)
+        self._set_alive(instance, False)
+        self._mark(instance)
+
+    def quarantine(self, instance: Instance) -> None:
+        """
+        Take an instance that failed a health check out of rotation. Unlike an expired
+        instance its heartbeats are still accepted, so it doesn't register again and
+        come straight back; it returns only once release() is called for a passing probe.
+        """
+        if not instance.quarantined:
+            instance.quarantined = True
+            self.quarantined[(instance.service, instance.ip, instance.port)] = instance
+        self._set_alive(instance, False)
+        self._mark(instance)
+
+    def release(self, instance: Instance, now=None) -> bool:
+        """ Return a quarantined instance to rotation; False if it is still ejected or stopped heartbeating """
+        self._release(instance)
+        if instance.ejected_until or instance.heartbeat < (now or time.time()) - HEARTBEAT_TIMEOUT:
+            return False
+        self._set_alive(instance, True)
+        self._mark(instance)
+        return True
+
+    def live_instances(self) -> list:
+        return [instance for live in self.live.values() for instance in live]
+
+    def endpoints(self, service) -> list:
+        return [instance.endpoint for instance in self.live.get(service, ())]
+
+    def choose(self, service, strategy=None):
+        """ Pick a live instance of a service with its balancing strategy, or None if there is none """
+        instance = self.balancer.choose(service, self.live.get(service), strategy)
+        if instance is not None:
+            # Count the pick until the next heartbeat reports the real load
+            instance.load += 1
+        return instance
+
+    def load(self, instance: Instance) -> None:
+        """ Put an instance read back from disk into the table, without marking it dirty """
+        self.instances.setdefault(instance.service, {})[instance.endpoint] = instance
+        if instance.alive:
+            instance.alive = False
+            self._set_alive(instance, True)
+
+    def _restore(self, instance: Instance) -> None:
+        if instance.ejected_until:
+            instance.ejected_until = 0.0
+            self.ejected.pop((instance.service, instance.ip, instance.port), None)
+
+    def _release(self, instance: Instance) -> None:
+        if instance.quarantined:
+            instance.quarantined = False
+            self.quarantined.pop((instance.service, instance.ip, instance.port), None)
+
+    def _mark(self, instance: Instance) -> None:
+        self.dirty[(instance.service, instance.ip, instance.port)] = instance
+        if len(self.dirty) >= FLUSH_BATCH:
+            self.wakeup.set()
+
+    def _set_alive(self, instance: Instance, alive) -> None:
+        if instance.alive == alive:
+            return
+        instance.alive = alive
+        live = self.live[instance.service]
+        positions = self._positions[instance.service]
+        if alive:
+            positions[instance.endpoint] = len(live)
+            live.append(instance)
+        else:
+            # Swap the last instance into the removed one's slot so removal stays O(1)
+            index = positions.pop(instance.endpoint)
+            last = live.pop()
+            if index < len(live):
+                live[index] = last
+                positions[last.endpoint] = index
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    service   TEXT    NOT NULL,
+    ip        TEXT    NOT NULL,
+    port      INTEGER NOT NULL,
+    heartbeat REAL    NOT NULL,
+    alive     INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (service, ip, port)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS instances_service_alive ON instances (service, alive);
+"""
+SCHEMA_VERSION = 1
+# The columns of the old table-per-service layout; other tables in the file are left alone
+LEGACY_COLUMNS = ["ip", "port", "heartbeat", "alive"]
+UPSERT = "INSERT OR REPLACE INTO instances (service, ip, port, heartbeat, alive) VALUES (?, ?, ?, ?, ?);"
+
+
+async def migrate(db) -> None:
+    """
+    Create the instances table, and fold the old table-per-service layout into it.
+
+    The old layout stored heartbeats as datetime strings and alive as the text 'TRUE',
+    and added a new row on every /add. Rows are copied in insertion order, so the
+    newest row of each (service, ip, port) is the one that survives. Only tables with
+    exactly the old columns are folded in and dropped.
+    """
+    async with db.execute("PRAGMA user_version;") as cursor:
+        (current,) = await cursor.fetchone()
+    if current >= SCHEMA_VERSION:
+        return
+    await db.executescript(SCHEMA)
+    async with db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND name != 'instances';"
+    ) as cursor:
+        tables = [row[0] for row in await cursor.fetchall()]
+    for service in tables:
+        async with db.execute(f'PRAGMA table_info("{service}");') as cursor:
+            columns = [row[1].lower() for row in await cursor.fetchall()]
+        if columns != LEGACY_COLUMNS:
+            log.info("Leaving the %s table alone, it isn't a service table", service)
+            continue
+        rows = []
+        async with db.execute(f'SELECT ip, port, heartbeat, alive FROM "{service}" ORDER BY rowid;') as cursor:
+            for ip, port, beat, alive in await cursor.fetchall():
+                try:
+                    port = int(port)
+                except (TypeError, ValueError):
+                    continue
+                try:
+                    beat = datetime.datetime.fromisoformat(beat).timestamp()
+                except (TypeError, ValueError):
+                    beat = 0.0
+                rows.append((service, ip, port, beat, int(alive == 'TRUE')))
+        await db.executemany(UPSERT, rows)
+        await db.execute(f'DROP TABLE "{service}";')
+        log.info("Migrated %d rows of the %s table into instances", len(rows), service)
+    await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+    await db.commit()
+
+
+async def load_table(db, table: ServiceTable) -> None:
+    """ Rebuild the in-memory table from the database """
+    async with db.execute("SELECT service, ip, port, heartbeat, alive FROM instances;") as cursor:
+        for service, ip, port, beat, alive in await cursor.fetchall():
+            table.load(Instance(service, ip, port, beat, bool(alive)))
+
+
+async def flush(db, table: ServiceTable) -> int:
+    """ Write every dirty instance to the database in a single transaction """
+    async with table.flush_lock:
+        if not table.dirty:
+            return 0
+        batch, table.dirty = table.dirty, {}
+        rows = [(i.service, i.ip, i.port, i.heartbeat, int(i.alive)) for i in batch.values()]
+        try:
+            await db.executemany(UPSERT, rows)
+            await db.commit()
+        except Exception:
+            # Put the batch back so nothing is lost; newer changes to the same instance win
+            await db.rollback()
+            batch.update(table.dirty)
+            table.dirty = batch
+            raise
+        return len(batch)
+
+
+async def flusher(app: web.Application) -> None:
+    """ Write behind every FLUSH_INTERVAL seconds, or sooner once FLUSH_BATCH changes pile up """
+    table = app["table"]
+    while True:
+        try:
+            await asyncio.wait_for(table.wakeup.wait(), FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        table.wakeup.clear()
+        try:
+            await flush(app["db"], table)
+        except aiosqlite.Error as err:
+            log.warning("Flushing the registry to %s failed: %r", DB_NAME, err)
+
+
+async def table_ctx(app: web.Application):
+    """ Load the table from disk on startup; write everything left over on shutdown """
+    app["table"] = ServiceTable(Balancer(STRATEGY, parse_strategies(STRATEGIES)))
+    await load_table(app["db"], app["table"])
+    log.info("Loaded %d instances from %s", sum(len(i) for i in app["table"].instances.values()), DB_NAME)
+    task = asyncio.ensure_future(flusher(app))
+    yield
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await flush(app["db"], app["table"])
+
+
+def reap(table: ServiceTable, now=None) -> list:
+    """ Expire every live instance whose last heartbeat is older than HEARTBEAT_TIMEOUT """
+    cutoff = (now or time.time()) - HEARTBEAT_TIMEOUT
+    expired = [instance for instance in table.live_instances() if instance.heartbeat < cutoff]
+    for instance in expired:
+        table.expire(instance)
+        changed(instance.service)
+    # A quarantined instance that stopped heartbeating too is just dead; stop probing it
+    for instance in [i for i in table.quarantined.values() if i.heartbeat < cutoff]:
+        table.expire(instance)
+    for instance in table.return_ejected(now):
+        log.info("Returned %s:%s to the %s service, ejection over", instance.ip, instance.port, instance.service)
+        changed(instance.service)
+    return expired
+
+
+async def health_check(session: aiohttp.ClientSession, table: ServiceTable) -> list:
+    """
+    Actively probe every live and quarantined instance, at most HEALTH_CHECK_CONCURRENCY
+    at a time. Live ones that can't be reached or answer with a server error are quarantined,
+    and quarantined ones that answer again are put back. Returns the newly quarantined.
+    """
+    semaphore = asyncio.Semaphore(HEALTH_CHECK_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=HEALTH_CHECK_TIMEOUT)
+
+    async def probe(instance):
+        async with semaphore:
+            try:
+                async with session.get(f"http://{instance.ip}:{instance.port}{HEALTH_CHECK_PATH}",
+                                       timeout=timeout) as r:
+                    return r.status < 500
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return False
+
+    instances = table.live_instances() + list(table.quarantined.values())
+    results = await asyncio.gather(*(probe(instance) for instance in instances))
+    failed = []
+    for instance, healthy in zip(instances, results):
+        if not healthy and instance.alive:
+            table.quarantine(instance)
+            changed(instance.service)
+            failed.append(instance)
+        elif healthy and instance.quarantined:
+            if table.release(instance):
+                log.info("Returned %s:%s to the %s service, health check passed", instance.ip, instance.port, instance.service)
+                changed(instance.service)
+    return failed
+
+
+async def reaper(app: web.Application) -> None:
+    """ Expire silent instances every REAP_INTERVAL seconds, and health check them if enabled """
+    table = app["table"]
+    last_check = time.monotonic()
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+        for instance in reap(table):
+            log.warning("Expired %s:%s from the %s service, no heartbeat", instance.ip, instance.port, instance.service)
+        if HEALTH_CHECK and time.monotonic() - last_check >= HEALTH_CHECK_INTERVAL:
+            last_check = time.monotonic()
+            for instance in await health_check(app["client_session"], table):
+                log.warning("Quarantined %s:%s from the %s service, failed health check", instance.ip, instance.port, instance.service)
+
+
+async def reaper_ctx(app: web.Application):
+    task = asyncio.ensure_future(reaper(app))
+    yield
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
 
 
 def routes(app: web.Application) -> None:
@@ -21,83 +447,239 @@ def routes(app: web.Application) -> None:
             web.get("/add/{service}/{ip}/{port}", add_service),
             web.get("/remove/{service}/{ip}/{port}", remove_service),
             web.get("/heartbeat/{service}/{ip}/{port}", heartbeat),
+            web.get("/eject/{service}/{ip}/{port}", eject_service),
             web.get("/get/{service}", get_service),
-            web.get("/get_one/{service}", get_one_service)
+            web.get("/get_one/{service}", get_one_service),
+            web.get("/watch/{service}", watch_service),
+            web.post("/bulk/add", bulk_add),
+            web.post("/bulk/heartbeat", bulk_heartbeat),
+            web.post("/bulk/remove", bulk_remove),
+            web.post("/bulk/get", bulk_get)
         ]
     )
     return None
 
 
-async def add_service(request):
+async def db_ctx(app: web.Application):
+    """
+    Hold one connection to the registry database for the life of the app.
+
+    WAL mode lets lookups read while a heartbeat is being written, and
+    synchronous=NORMAL skips the fsync on every commit. Values are bound as
+    parameters, so each statement text is prepared once and then reused from
+    the connection's statement cache.
+    """
+    db = await aiosqlite.connect(DB_NAME, cached_statements=STATEMENT_CACHE)
+    await db.execute("PRAGMA journal_mode=WAL;")
+    await db.execute("PRAGMA synchronous=NORMAL;")
+    await db.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS};")
+    await migrate(db)
+    app["db"] = db
+    yield
+    await db.close()
+
+
+def instance_key(request) -> tuple:
     service = request.match_info.get('service')
     ip = request.match_info.get('ip')
-    port = request.match_info.get('port')
-    print(f"Adding the {service} service")
-    async with aiosqlite.connect(DB_NAME) as db:
-        sql = f"CREATE TABLE IF NOT EXISTS {service} (ip CHAR(16), port INT, heartbeat CHAR(50), alive  BOOL);"
-        await db.execute(sql)
-        await db.commit()
-        now = datetime.datetime.now()
-        sql2 = f"INSERT INTO {service} (ip, port, heartbeat, alive) VALUES ('{ip}', '{port}', '{now}', 'TRUE');"
-        try:
-            await db.execute(sql2)
-            await db.commit()
-            txt = ""
-        except aiosqlite.IntegrityError as err:
-            txt = f"{service} service already exists"
-    return web.Response(text=txt)
+    try:
+        port = int(request.match_info.get('port'))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{request.match_info.get('port')} is not a valid port")
+    return service, ip, port
+
+
+async def add_service(request):
+    service, ip, port = instance_key(request)
+    log.info("Adding the %s service", service)
+    request.app["table"].add(service, ip, port)
+    changed(service)
+    return web.Response(text="")
 
 
 async def heartbeat(request):
-    service = request.match_info.get('service')
-    ip = request.match_info.get('ip')
-    port = request.match_info.get('port')
-    print(f"Adding heartbeat")
-    async with aiosqlite.connect(DB_NAME) as db:
-        now = datetime.datetime.now()
-        sql = f"UPDATE {service} set heartbeat = '{now}' where ip like '{ip}' AND port like '{port}';"
-        await db.execute(sql)
-        await db.commit()
+    """
+    Keep an instance alive. Instances may report their load with the heartbeat:
+    ?load= outstanding requests, ?latency= recent average response time in seconds
+    """
+    service, ip, port = instance_key(request)
+    log.debug("Adding heartbeat for %s", service)
+    try:
+        load = int(request.query['load']) if 'load' in request.query else None
+        latency = float(request.query['latency']) if 'latency' in request.query else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="load must be an integer and latency a number of seconds")
+    if request.app["table"].heartbeat(service, ip, port, load=load, latency=latency) is None:
+        raise web.HTTPNotFound(text=f"{ip}:{port} is not a live {service} instance")
     return web.Response()
 
 
 async def remove_service(request):
-    service = request.match_info.get('service')
-    ip = request.match_info.get('ip')
-    port = request.match_info.get('port')
-    print(f"Removing {ip} from the {service} service")
-    async with aiosqlite.connect(DB_NAME) as db:
-        now = datetime.datetime.now()
-        sql = f"UPDATE {service} set heartbeat = '{now}', alive = 'FALSE' where ip like '{ip}' AND port like '{port}';"
-        print(sql)
-        await db.execute(sql)
-        await db.commit()
+    service, ip, port = instance_key(request)
+    log.info("Removing %s from the %s service", ip, service)
+    if request.app["table"].remove(service, ip, port) is None:
+        raise web.HTTPNotFound(text=f"{ip}:{port} is not a {service} instance")
+    changed(service)
     return web.Response()
 
 
+async def eject_service(request):
+    """
+    Take an instance out of rotation for ?seconds= (default 30), e.g. when a gateway's
+    circuit breaker ejects it. 409 if too many of the service's instances are ejected already.
+    """
+    service, ip, port = instance_key(request)
+    try:
+        seconds = float(request.query.get('seconds', 30))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds must be a number")
+    ejected = request.app["table"].eject(service, ip, port, seconds)
+    if ejected is None:
+        raise web.HTTPNotFound(text=f"{ip}:{port} is not a live {service} instance")
+    if ejected is False:
+        raise web.HTTPConflict(text=f"Too many {service} instances are ejected already")
+    log.warning("Ejected %s:%s from the %s service for %.0fs", ip, port, service, seconds)
+    changed(service)
+    return web.Response()
+
+
+def version(service) -> str:
+    # get(), so asking about a service that was never registered allocates nothing
+    return f"{BOOT_ID}.{VERSIONS.get(service, 0)}"
+
+
+def changed(service) -> None:
+    """ Bump the version of a service and wake up its watchers """
+    VERSIONS[service] += 1
+    event = CHANGED.pop(service, None)
+    if event is not None:
+        event.set()
+
+
 async def get_service(request):
     service = request.match_info.get('service')
-    async with aiosqlite.connect(DB_NAME) as db:
-        sql = f"SELECT DISTINCT ip,port from {service} where alive = 'TRUE';"
-        resp = await db.execute(sql)
-        await db.commit()
-        fetched = await resp.fetchall()
-        services = {'endpoints': fetched}
+    services = {'endpoints': request.app["table"].endpoints(service), 'version': version(service)}
     return web.json_response(services)
 
 
 async def get_one_service(request):
+    """
+    Pick one live instance of a service. The service's balancing strategy
+    can be overridden per request with ?strategy=
+    """
+    service = request.match_info.get('service')
+    try:
+        chosen = request.app["table"].choose(service, request.query.get('strategy'))
+    except ValueError as err:
+        raise web.HTTPBadRequest(text=str(err))
+    if chosen is None:
+        return web.json_response({'endpoints': [], 'error': f"No live {service} instances"}, status=404)
+    services = {'endpoints': chosen.endpoint}
+    return web.json_response(services)
+
+
+async def watch_service(request):
+    """
+    Long-poll for changes to a service. Returns as soon as the service's version
+    differs from the ?version= the caller already has, or after ?timeout= seconds.
+    """
     service = request.match_info.get('service')
-    async with aiosqlite.connect(DB_NAME) as db:
-        sql = f"SELECT ip,port from {service} where alive = 'TRUE';"
-        resp = await db.execute(sql)
-        await db.commit()
-        fetched = await resp.fetchall()
-    chosen = random.choice(fetched)
-    services = {'endpoints': chosen}
+    known = request.query.get('version')
+    try:
+        timeout = min(float(request.query.get('timeout', WATCH_TIMEOUT)), WATCH_TIMEOUT)
+        if not timeout >= 0:
+            raise ValueError(timeout)
+    except ValueError:
+        raise web.HTTPBadRequest(text="timeout must be a number of seconds")
+    # Only registered services are waited on; a made-up name gets its empty answer at once
+    if known == version(service) and service in request.app["table"].instances:
+        event = CHANGED.setdefault(service, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    services = {'endpoints': request.app["table"].endpoints(service), 'version': version(service)}
     return web.json_response(services)
 
 
+async def bulk_instances(request) -> list:
+    """
+    Read the body of a bulk request: {"instances": [{"service": ..., "ip": ..., "port": ...}, ...]}
+    Heartbeats may also carry "load" and "latency" per instance.
+    """
+    try:
+        body = await request.json()
+        instances = body["instances"]
+        for instance in instances:
+            instance["port"] = int(instance["port"])
+            if not (isinstance(instance["service"], str) and isinstance(instance["ip"], str)):
+                raise TypeError("service and ip must be strings")
+    except (ValueError, KeyError, TypeError) as err:
+        raise web.HTTPBadRequest(text=f"Expected {{\"instances\": [{{\"service\", \"ip\", \"port\"}}, ...]}}: {err!r}")
+    return instances
+
+
+async def bulk_add(request):
+    """ Register many instances at once; the whole batch is written in one transaction """
+    table = request.app["table"]
+    instances = await bulk_instances(request)
+    log.info("Adding %d instances", len(instances))
+    for instance in instances:
+        table.add(instance["service"], instance["ip"], instance["port"])
+    for service in {instance["service"] for instance in instances}:
+        changed(service)
+    await flush(request.app["db"], table)
+    return web.json_response({'added': len(instances)})
+
+
+async def bulk_heartbeat(request):
+    """
+    Heartbeat many instances at once; the whole batch is written in one transaction.
+    Instances the registry doesn't know as live are returned as missing, so they can register again.
+    The batch is checked before any of it is applied, so a bad entry leaves every instance as it was.
+    """
+    table = request.app["table"]
+    instances = await bulk_instances(request)
+    reports = []
+    for instance in instances:
+        try:
+            load = int(instance["load"]) if "load" in instance else None
+            latency = float(instance["latency"]) if "latency" in instance else None
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text="load must be an integer and latency a number of seconds")
+        reports.append((instance, load, latency))
+    missing = []
+    for instance, load, latency in reports:
+        if table.heartbeat(instance["service"], instance["ip"], instance["port"], load=load, latency=latency) is None:
+            missing.append(instance)
+    await flush(request.app["db"], table)
+    return web.json_response({'missing': missing})
+
+
+async def bulk_remove(request):
+    """ Remove many instances at once; the whole batch is written in one transaction """
+    table = request.app["table"]
+    instances = await bulk_instances(request)
+    log.info("Removing %d instances", len(instances))
+    removed = [i for i in instances if table.remove(i["service"], i["ip"], i["port"]) is not None]
+    for service in {instance["service"] for instance in removed}:
+        changed(service)
+    await flush(request.app["db"], table)
+    return web.json_response({'removed': len(removed)})
+
+
+async def bulk_get(request):
+    """ Resolve many services in one call: {"services": ["menu", "login"]} """
+    try:
+        body = await request.json()
+        services = [str(service) for service in body["services"]]
+    except (ValueError, KeyError, TypeError) as err:
+        raise web.HTTPBadRequest(text=f"Expected {{\"services\": [...]}}: {err!r}")
+    table = request.app["table"]
+    resolved = {service: {'endpoints': table.endpoints(service), 'version': version(service)} for service in services}
+    return web.json_response({'services': resolved})
+
+
 def main():
     """
     This is the main process for the aiohttp server.
@@ -107,10 +689,16 @@ def main():
     event loop with web.run_app().
     """
 
-    print("This aiohttp web server is starting up!")
+    setup_logging()
+    log.info("This aiohttp web server is starting up!")
     app = web.Application()
     routes(app)
-    web.run_app(app, host=HOST, port=PORT)
+    setup_compression(app)
+    setup_client_session(app)
+    app.cleanup_ctx.append(db_ctx)
+    app.cleanup_ctx.append(table_ctx)
+    app.cleanup_ctx.append(reaper_ctx)
+    web.run_app(app, host=HOST, port=PORT, access_log_class=SampledAccessLogger)
 
 
 if __name__ == "__main__":
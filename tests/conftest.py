@@ -0,0 +1,16 @@
+"""
+The services import their own modules top level (from catalog import ..., from rate_limit import ...),
+as they do in their containers, so their directories go on the path along with the repository root.
+"""
+
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+for path in (ROOT, *(ROOT / "microservices" / name for name in ("api_gateway", "login", "menu"))):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+# A scraper run by hand against a live site (python tests/link_test.py -s http://...), not a unit test
+collect_ignore = ["link_test.py"]
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import login
+from accounts import HashPool, Saturated, setup_accounts
+from dragon_common.sessions import MemorySessionStore, SessionSigner
+
+
+def test_a_cancelled_login_holds_its_slot_until_the_hash_finishes():
+    async def run():
+        pool = HashPool(workers=1, queue_depth=0)
+        try:
+            # Warm the worker up, so the sleep below starts at once
+            await pool.run(time.sleep, 0)
+            login = asyncio.ensure_future(pool.run(time.sleep, 0.5))
+            await asyncio.sleep(0.1)
+            login.cancel()
+            await asyncio.gather(login, return_exceptions=True)
+            # The worker is still hashing for the client that went away
+            assert pool.in_flight == 1
+            with pytest.raises(Saturated):
+                await pool.run(time.sleep, 0)
+            await asyncio.sleep(0.6)
+            assert pool.in_flight == 0
+            await pool.run(time.sleep, 0)
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+
+def test_logins_get_503_with_retry_after_while_the_pool_is_saturated(tmp_path):
+    async def run():
+        app = web.Application()
+        login.routes(app)
+        app["session_signer"] = SessionSigner("s" * 32)
+        app["sessions"] = MemorySessionStore()
+        setup_accounts(app, path=str(tmp_path / "login.db"), pool=HashPool(workers=1, queue_depth=0))
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        try:
+            await app["accounts"].add("alice", "wonderland")
+            r = await client.post("/api/login", json={"name": "alice", "password": "wonderland"})
+            assert r.status == 200
+
+            busy = asyncio.ensure_future(app["accounts"].pool.run(time.sleep, 0.5))
+            await asyncio.sleep(0.05)
+            r = await client.post("/api/login", json={"name": "alice", "password": "wonderland"})
+            assert r.status == 503
+            assert r.headers["Retry-After"] == str(Saturated().retry_after)
+            r = await client.post("/logging_in", data={"name": "alice", "password": "wonderland"})
+            assert r.status == 503 and "Retry-After" in r.headers
+            assert app["accounts"].pool.rejected == 2
+            await busy
+        finally:
+            await client.close()
+
+    asyncio.run(run())
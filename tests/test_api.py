@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from dragon_common import api
+from dragon_common.api import JSON, MSGPACK, api_response, decode, negotiate
+
+
+def echo_app() -> web.Application:
+    async def echo(request):
+        return api_response(request, {"echo": await decode(request)})
+
+    app = web.Application()
+    app.router.add_route("*", "/echo", echo)
+    return app
+
+
+def with_client(check):
+    async def run():
+        client = TestClient(TestServer(echo_app()))
+        await client.start_server()
+        try:
+            await check(client)
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+
+def test_msgpack_is_sent_and_read_when_installed():
+    msgpack = pytest.importorskip("msgpack")
+
+    async def check(client):
+        r = await client.post("/echo", data=msgpack.packb({"name": "alice"}),
+                              headers={"Accept": "application/x-msgpack", "Content-Type": MSGPACK})
+        assert r.content_type == MSGPACK
+        assert r.headers["Vary"] == "Accept"
+        assert msgpack.unpackb(await r.read(), raw=False) == {"echo": {"name": "alice"}}
+
+    with_client(check)
+
+
+def test_without_msgpack_every_client_gets_json(monkeypatch):
+    monkeypatch.setattr(api, "msgpack", None)
+    monkeypatch.setattr(api, "MEDIA_TYPES", [JSON])
+
+    async def check(client):
+        r = await client.post("/echo", data={"name": "alice"}, headers={"Accept": f"{MSGPACK}, {JSON};q=0.5"})
+        assert r.content_type == JSON
+        assert json.loads(await r.read()) == {"echo": {"name": "alice"}}
+
+    with_client(check)
+
+
+@pytest.mark.parametrize("accept, media_type", [
+    (None, JSON),
+    ("", JSON),
+    ("*/*", JSON),
+    ("text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8", JSON),
+    ("application/msgpack", MSGPACK),
+    ("application/vnd.msgpack, application/json", MSGPACK),
+    ("application/json, application/msgpack;q=0.5", JSON),
+    ("application/msgpack;q=0.5, application/*", JSON),
+    ("application/msgpack;q=0, application/json", JSON),
+])
+def test_negotiation(accept, media_type):
+    assert negotiate(accept, [MSGPACK, JSON]) == media_type
+
+
+@pytest.mark.parametrize("accept", ["text/html", "application/json;q=0", "application/msgpack;q=0, */*;q=0"])
+def test_unacceptable_types_are_refused(accept):
+    with pytest.raises(web.HTTPNotAcceptable):
+        negotiate(accept, [MSGPACK, JSON])
+
+
+def test_msgpack_only_client_gets_406_without_msgpack():
+    with pytest.raises(web.HTTPNotAcceptable):
+        negotiate("application/msgpack", [JSON])
+
+
+def test_api_answers_406_to_a_client_that_accepts_neither_type():
+    async def check(client):
+        r = await client.get("/echo", headers={"Accept": "text/html"})
+        assert r.status == 406
+
+    with_client(check)
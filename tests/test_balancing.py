@@ -0,0 +1,75 @@
+import collections
+
+import pytest
+
+from dragon_common.balancing import STRATEGIES, Balancer, ewma, get_strategy, parse_strategies
+
+
+class Candidate:
+    def __init__(self, name, load=0, latency=0.0):
+        self.name = name
+        self.load = load
+        self.latency = latency
+
+    def __repr__(self):
+        return self.name
+
+
+def picks(strategy, candidates, n=1000) -> collections.Counter:
+    return collections.Counter(strategy.choose(candidates).name for _ in range(n))
+
+
+def test_round_robin_takes_each_candidate_in_turn():
+    candidates = [Candidate("a"), Candidate("b"), Candidate("c")]
+    strategy = get_strategy("round_robin")
+    assert [strategy.choose(candidates).name for _ in range(6)] == ["a", "b", "c", "a", "b", "c"]
+
+
+def test_random_spreads_over_every_candidate():
+    assert set(picks(get_strategy("random"), [Candidate("a"), Candidate("b"), Candidate("c")])) == {"a", "b", "c"}
+
+
+def test_least_outstanding_picks_the_least_loaded_and_shares_ties():
+    strategy = get_strategy("least_outstanding")
+    assert set(picks(strategy, [Candidate("a", 3), Candidate("b", 1), Candidate("c", 1)])) == {"b", "c"}
+
+
+def test_p2c_never_picks_the_most_loaded():
+    counts = picks(get_strategy("p2c"), [Candidate("a", 0), Candidate("b", 5), Candidate("c", 9)])
+    assert "c" not in counts and counts["a"] > counts["b"]
+
+
+def test_ewma_weighs_latency_by_load():
+    # b is faster, but a has the lower latency * (load + 1)
+    counts = picks(get_strategy("ewma"), [Candidate("a", 0, 0.2), Candidate("b", 4, 0.1)])
+    assert counts == {"a": 1000}
+
+
+def test_a_single_candidate_is_always_picked():
+    for name in STRATEGIES:
+        assert get_strategy(name).choose([Candidate("only")]).name == "only"
+
+
+def test_unknown_strategies_are_refused():
+    with pytest.raises(ValueError, match="fastest"):
+        get_strategy("fastest")
+    with pytest.raises(ValueError):
+        parse_strategies("menu=p2c,login=fastest")
+    with pytest.raises(ValueError):
+        Balancer("fastest")
+    with pytest.raises(ValueError):
+        Balancer().choose("menu", [Candidate("a")], "fastest")
+
+
+def test_balancer_keeps_a_strategy_per_service():
+    balancer = Balancer("random", parse_strategies(" menu = round_robin ,login=p2c"))
+    assert balancer.per_service == {"menu": "round_robin", "login": "p2c"}
+    assert balancer.strategy("menu").name == "round_robin"
+    assert balancer.strategy("menu") is balancer.strategy("menu")
+    assert balancer.strategy("fortune_cookie").name == "random"
+    assert balancer.choose("menu", []) is None
+
+
+def test_ewma_starts_at_the_first_sample():
+    assert ewma(0.0, 2.0) == 2.0
+    assert ewma(1.0, 2.0, alpha=0.5) == 1.5
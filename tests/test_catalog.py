@@ -0,0 +1,78 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from catalog import Catalog, Listing
+from conftest import ROOT
+
+TEMPLATES = ROOT / "microservices" / "menu" / "templates"
+
+
+def with_catalog(tmp_path, check, **kwargs):
+    async def run():
+        catalog = Catalog(path=str(tmp_path / "menu.db"), templates_dir=TEMPLATES, **kwargs)
+        await catalog.open()
+        try:
+            await check(catalog)
+        finally:
+            await catalog.close()
+
+    asyncio.run(run())
+
+
+def add_items(path, *items):
+    """ Change the catalog from another connection, as the sqlite3 shell would """
+    db = sqlite3.connect(str(path))
+    db.execute("INSERT OR IGNORE INTO categories (name, position) VALUES ('Soups', 1);")
+    db.executemany("INSERT INTO items (category_id, item, price_cents) "
+                   "SELECT id, ?, ? FROM categories WHERE name = 'Soups';", items)
+    db.commit()
+    db.close()
+
+
+def test_a_change_from_another_connection_reloads_the_menu(tmp_path):
+    async def check(catalog):
+        body, etag = catalog.page()
+        assert b"Kung Pao Beef" in body
+        assert catalog.page()[0] is body
+        assert not await catalog.reload()
+        version = catalog.snapshot.version
+
+        add_items(tmp_path / "menu.db", ("Hot and Sour Soup", 499))
+        for _ in range(100):
+            if catalog.snapshot.version != version:
+                break
+            await asyncio.sleep(0.01)
+        assert catalog.snapshot.version > version
+        body, new_etag = catalog.page()
+        assert b"Hot and Sour Soup" in body and new_etag != etag
+
+    with_catalog(tmp_path, check, poll_interval=0.01)
+
+
+def test_listings_are_paged_and_filtered(tmp_path):
+    async def check(catalog):
+        add_items(tmp_path / "menu.db", ("Egg Drop Soup", 399), ("Wonton Soup", 599))
+        items, more = await catalog.items(Listing(page=1, per_page=3))
+        assert [i.item for i in items] == ["General Tzo's Chicken", "Kung Pao Beef", "Egg Drop Soup"]
+        assert more
+        items, more = await catalog.items(Listing(page=2, per_page=3))
+        assert [i.item for i in items] == ["Wonton Soup"] and not more
+        items, _ = await catalog.items(Listing(category="Soups", max_cents=500))
+        assert [i.item for i in items] == ["Egg Drop Soup"]
+        items, _ = await catalog.items(Listing(min_cents=1300))
+        assert [i.item for i in items] == ["Kung Pao Beef"]
+
+    with_catalog(tmp_path, check)
+
+
+def test_listing_query_parsing():
+    listing = Listing.from_query({"category": "Soups", "min_price": "3.995", "per_page": "10"})
+    assert (listing.category, listing.min_cents, listing.page, listing.per_page) == ("Soups", 400, 1, 10)
+    assert Listing.from_query({}).whole_menu
+    assert Listing.from_query({"stream": "TRUE"}).stream
+    for query in ({"min_price": "cheap"}, {"max_price": "-1"}, {"page": "0"}, {"per_page": "100000"},
+                  {"page": "two"}):
+        with pytest.raises(ValueError):
+            Listing.from_query(query)
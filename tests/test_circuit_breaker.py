@@ -0,0 +1,98 @@
+import time
+
+from circuit_breaker import CircuitBreakers
+from dragon_common.discovery import Endpoint
+
+MENU = Endpoint("10.0.0.1", 2227)
+
+
+def breakers(**kwargs) -> CircuitBreakers:
+    # No registry url, so ejections aren't reported anywhere
+    kwargs.setdefault("consecutive", 3)
+    kwargs.setdefault("slow_call", 1.0)
+    return CircuitBreakers(**kwargs)
+
+
+def cool_down(breaker) -> None:
+    """ Skip to the end of the breaker's ejection """
+    breaker.ejected_until = time.monotonic() - 0.001
+
+
+def test_consecutive_failures_open_the_breaker():
+    cb = breakers()
+    cb.record("menu", MENU, False, 0.1)
+    cb.record("menu", MENU, False, 0.1)
+    assert cb.breaker(MENU).state() == "closed" and cb.available(MENU)
+    cb.record("menu", MENU, False, 0.1)
+    assert cb.breaker(MENU).state() == "open"
+    assert not cb.available(MENU)
+
+
+def test_a_success_resets_the_run_of_failures():
+    cb = breakers(min_requests=100)
+    for ok in (False, False, True, False, False):
+        cb.record("menu", MENU, ok, 0.1)
+    assert cb.breaker(MENU).state() == "closed"
+
+
+def test_error_rate_opens_the_breaker_once_the_window_is_full_enough():
+    cb = breakers(consecutive=100, min_requests=4, error_rate=0.5)
+    for ok in (True, False, True):
+        cb.record("menu", MENU, ok, 0.1)
+    assert cb.breaker(MENU).state() == "closed"
+    cb.record("menu", MENU, False, 0.1)
+    assert cb.breaker(MENU).state() == "open"
+
+
+def test_slow_calls_count_as_failures():
+    cb = breakers()
+    for _ in range(3):
+        cb.record("menu", MENU, True, 1.5)
+    assert cb.breaker(MENU).state() == "open"
+
+
+def test_half_open_lets_one_probe_through_and_closes_on_success():
+    cb = breakers()
+    for _ in range(3):
+        cb.record("menu", MENU, False, 0.1)
+    breaker = cb.breaker(MENU)
+    cool_down(breaker)
+    assert breaker.state() == "half_open" and cb.available(MENU)
+    cb.started(MENU)
+    assert not cb.available(MENU)
+    cb.record("menu", MENU, True, 0.1)
+    assert breaker.state() == "closed" and cb.available(MENU)
+    assert breaker.ejections == 0
+
+
+def test_a_failed_probe_reopens_with_a_longer_cooldown():
+    cb = breakers()
+    for _ in range(3):
+        cb.record("menu", MENU, False, 0.1)
+    breaker = cb.breaker(MENU)
+    first = breaker.ejected_until - time.monotonic()
+    cool_down(breaker)
+    cb.started(MENU)
+    cb.record("menu", MENU, False, 0.1)
+    assert breaker.state() == "open"
+    assert breaker.ejected_until - time.monotonic() > 1.5 * first
+
+
+def test_a_cancelled_probe_frees_the_probe_slot():
+    cb = breakers()
+    for _ in range(3):
+        cb.record("menu", MENU, False, 0.1)
+    cool_down(cb.breaker(MENU))
+    cb.started(MENU)
+    cb.cancelled(MENU)
+    assert cb.available(MENU)
+
+
+def test_stragglers_do_not_count_while_open():
+    cb = breakers()
+    for _ in range(3):
+        cb.record("menu", MENU, False, 0.1)
+    breaker = cb.breaker(MENU)
+    until = breaker.ejected_until
+    cb.record("menu", MENU, True, 0.1)
+    assert breaker.state() == "open" and breaker.ejected_until == until
@@ -0,0 +1,80 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from dragon_common.composition import UNAVAILABLE, Composer, fragment_of, handler_fragment, parse_timeouts
+
+
+def page(body):
+    async def fetch():
+        return f"<html><body>{body}</body></html>"
+
+    return fetch
+
+
+async def broken():
+    raise ConnectionError("down")
+
+
+async def slow():
+    await asyncio.sleep(1)
+    return "<body>too late</body>"
+
+
+def test_fragments_are_composed_from_the_page_bodies():
+    async def run():
+        return await Composer(timeout=0.5).compose({"menu": page("<p>menu</p>"), "login": page("<p>login</p>")})
+
+    assert asyncio.run(run()) == {"menu": "<p>menu</p>", "login": "<p>login</p>"}
+
+
+def test_a_failed_or_slow_fragment_falls_back_without_failing_the_page():
+    async def run():
+        composer = Composer(timeout=0.05)
+        first = await composer.compose({"menu": page("menu v1"), "login": broken})
+        assert first == {"menu": "menu v1", "login": UNAVAILABLE.format(name="login")}
+        # The last good copy stands in for a fragment that fails later, or is too slow
+        assert await composer.compose({"menu": broken}) == {"menu": "menu v1"}
+        assert await composer.compose({"menu": slow}) == {"menu": "menu v1"}
+
+    asyncio.run(run())
+
+
+def test_personal_fragments_are_not_kept_as_fallbacks():
+    async def run():
+        composer = Composer(timeout=0.05)
+        await composer.compose({"login": page("Hello alice")}, remember=False)
+        return await composer.compose({"login": broken})
+
+    assert asyncio.run(run()) == {"login": UNAVAILABLE.format(name="login")}
+
+
+def test_a_fragment_can_have_its_own_timeout():
+    async def run():
+        composer = Composer(timeout=0.01, timeouts=parse_timeouts("menu=2, login=0.01"))
+        return await composer.compose({"menu": slow, "login": slow})
+
+    assert asyncio.run(run()) == {"menu": "too late", "login": UNAVAILABLE.format(name="login")}
+
+
+def test_handler_fragments_fail_on_an_error_status():
+    async def ok(request):
+        assert request.headers["Accept-Encoding"] == "identity"
+        assert "If-None-Match" not in request.headers
+        return web.Response(text="<body>fine</body>")
+
+    async def error(request):
+        return web.Response(status=500, text="oops")
+
+    async def run():
+        request = make_mocked_request("GET", "/", headers={"Accept-Encoding": "br", "If-None-Match": '"x"'})
+        return await Composer(timeout=0.5).compose({"ok": handler_fragment(ok, request),
+                                                    "error": handler_fragment(error, request)})
+
+    assert asyncio.run(run()) == {"ok": "fine", "error": UNAVAILABLE.format(name="error")}
+
+
+def test_fragment_of_falls_back_to_the_whole_text():
+    assert fragment_of("<BODY class='x'>\n<p>hi</p>\n</BODY>") == "<p>hi</p>"
+    assert fragment_of("<p>no body</p>") == "<p>no body</p>"
@@ -0,0 +1,93 @@
+import asyncio
+import gzip
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from dragon_common import compression
+from dragon_common.compression import Compressor, compress, negotiate
+
+BODY = b"<p>Kung Pao Beef</p>" * 100
+
+
+def test_brotli_and_zstd_are_offered_first_when_installed():
+    brotli = pytest.importorskip("brotli")
+    zstandard = pytest.importorskip("zstandard")
+    assert compression.CODINGS == ["br", "zstd", "gzip"]
+    assert negotiate("gzip, deflate, br, zstd") == "br"
+    assert negotiate("gzip, zstd") == "zstd"
+    assert brotli.decompress(compress(BODY, "br")) == BODY
+    assert zstandard.ZstdDecompressor().decompress(compress(BODY, "zstd")) == BODY
+
+
+def test_without_brotli_and_zstandard_only_gzip_is_used(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+    monkeypatch.setattr(compression, "zstandard", None)
+    assert negotiate("br, zstd, gzip", ["gzip"]) == "gzip"
+    assert negotiate("br, zstd", ["gzip"]) == "identity"
+    assert gzip.decompress(compress(BODY, "gzip")) == BODY
+    for coding in ("br", "zstd"):
+        with pytest.raises(ValueError):
+            compress(BODY, coding)
+
+
+def respond(compressor, accept_encoding=None, body=BODY, etag=None, content_type="text/html"):
+    """ Run one request through the compressor's middleware """
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding is not None else {}
+
+    async def handler(request):
+        response = web.Response(body=body, content_type=content_type)
+        if etag:
+            response.headers["ETag"] = etag
+        return response
+
+    return asyncio.run(compressor.middleware(make_mocked_request("GET", "/", headers=headers), handler))
+
+
+def test_the_middleware_uses_the_best_coding_the_client_accepts():
+    compressor = Compressor(codings=["zstd", "gzip"])
+    assert respond(compressor, "gzip, zstd").headers["Content-Encoding"] == "zstd"
+    response = respond(compressor, "gzip, zstd;q=0")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.body) == BODY
+    assert response.headers["Vary"] == "Accept-Encoding"
+    for accept_encoding in (None, "identity", "gzip;q=0, zstd;q=0", "*;q=0"):
+        response = respond(compressor, accept_encoding)
+        assert "Content-Encoding" not in response.headers
+        assert response.body == BODY
+        assert response.headers["Vary"] == "Accept-Encoding"
+
+
+def test_small_and_binary_bodies_are_sent_as_they_are():
+    compressor = Compressor(codings=["gzip"], min_size=len(BODY) + 1)
+    assert respond(compressor, "gzip").body == BODY
+    compressor = Compressor(codings=["gzip"])
+    assert "Content-Encoding" not in respond(compressor, "gzip", content_type="image/png").headers
+    assert not compressor._variants
+
+
+def test_a_response_with_an_etag_reuses_its_variant_and_gets_a_weak_etag():
+    compressor = Compressor(codings=["gzip"])
+    first = respond(compressor, "gzip", etag='"v1"')
+    assert first.headers["ETag"] == 'W/"v1"'
+    assert list(compressor._variants) == [('"v1"', "gzip", len(BODY))]
+    # A new body under the same ETag is served the cached variant
+    second = respond(compressor, "gzip", body=BODY.replace(b"Beef", b"Pork"), etag='"v1"')
+    assert second.body == first.body
+    assert respond(compressor, "gzip", etag='W/"v1"').headers["ETag"] == 'W/"v1"'
+
+
+def test_the_variant_cache_evicts_the_least_recently_used_past_cache_bytes():
+    size = len(compress(BODY, "gzip"))
+    compressor = Compressor(codings=["gzip"], cache_bytes=2 * size)
+    respond(compressor, "gzip", etag='"a"')
+    respond(compressor, "gzip", etag='"b"')
+    respond(compressor, "gzip", etag='"a"')
+    respond(compressor, "gzip", etag='"c"')
+    assert [key[0] for key in compressor._variants] == ['"a"', '"c"']
+    assert compressor.size == 2 * size
+    # A variant bigger than the whole cache is never kept
+    compressor = Compressor(codings=["gzip"], cache_bytes=size - 1)
+    respond(compressor, "gzip", etag='"a"')
+    assert not compressor._variants and compressor.size == 0
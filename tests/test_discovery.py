@@ -0,0 +1,67 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from dragon_common import discovery
+from dragon_common.discovery import DiscoveryCache
+from dragon_common.http_client import client_session
+
+
+def test_watch_survives_a_malformed_reply(monkeypatch):
+    monkeypatch.setattr(discovery, "WATCH_RETRY", 0.01)
+    replies = [{"no endpoints": []}, {"endpoints": [["10.0.0.2", 2227]], "version": 2}]
+
+    async def watch(request):
+        if not replies:
+            # Both replies are handled, so hold this long poll open like the registry would
+            await asyncio.sleep(10)
+        return web.json_response(replies.pop(0))
+
+    async def run():
+        registry = web.Application()
+        registry.router.add_get("/watch/{service}", watch)
+        server = TestServer(registry)
+        await server.start_server()
+        session = client_session()
+        cache = DiscoveryCache(session, str(server.make_url("")).rstrip("/"))
+        try:
+            cache._store("menu", {"endpoints": [["10.0.0.1", 2227]], "version": 1})
+            await asyncio.sleep(0.2)
+            assert [tuple(e) for e in await cache.endpoints("menu")] == [("10.0.0.2", 2227)]
+        finally:
+            await cache.close()
+            await session.close()
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_services_without_instances_get_no_entry_or_watcher(monkeypatch):
+    monkeypatch.setattr(discovery, "MISSING_MAX", 2)
+    lookups = []
+
+    async def get(request):
+        lookups.append(request.match_info["service"])
+        return web.json_response({"endpoints": [], "version": "boot.0"})
+
+    async def run():
+        registry = web.Application()
+        registry.router.add_get("/get/{service}", get)
+        server = TestServer(registry)
+        await server.start_server()
+        session = client_session()
+        cache = DiscoveryCache(session, str(server.make_url("")).rstrip("/"))
+        try:
+            for name in ("a", "b", "c", "c"):
+                assert await cache.endpoints(name) == []
+            # The second "c" is answered from the note of the miss
+            assert lookups == ["a", "b", "c"]
+            assert cache._entries == {} and cache._known == {} and cache._watchers == {}
+            assert list(cache._missing) == ["b", "c"]
+        finally:
+            await cache.close()
+            await session.close()
+            await server.close()
+
+    asyncio.run(run())
@@ -0,0 +1,12 @@
+import pytest
+
+from dragon_common.fortunes import FortunePool
+
+
+@pytest.mark.parametrize("seed", ["42", "007", "alice", "²", "٣", ""])
+def test_seeded_index_is_stable_for_any_seed(seed):
+    pool = FortunePool()
+    pool.corpus = [f"fortune {i}" for i in range(10)]
+    index = pool.seeded_index(seed)
+    assert 0 <= index < 10
+    assert pool.seeded_index(seed) == index
@@ -0,0 +1,153 @@
+"""
+The gateway in front of a real menu service, both in process. Discovery is handed the menu's
+address directly instead of asking a Service Registry.
+"""
+
+import asyncio
+import html
+import re
+
+import pytest
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+from yarl import URL
+
+import api_gateway
+import menu
+from catalog import setup_catalog
+from circuit_breaker import setup_circuit_breakers
+from dragon_common.discovery import DiscoveryCache
+from dragon_common.http_client import setup_client_session
+from response_cache import ResponseCache
+from conftest import ROOT
+
+
+def menu_app(db_path) -> web.Application:
+    app = web.Application()
+    menu.routes(app)
+    setup_catalog(app, path=str(db_path), templates_dir=ROOT / "microservices" / "menu" / "templates")
+    return app
+
+
+def gateway_app(ports) -> web.Application:
+    """ :param ports: {service: port} of the upstreams, all on 127.0.0.1 """
+    app = web.Application()
+    api_gateway.routes(app)
+    setup_client_session(app)
+    setup_client_session(app, key="proxy_session", auto_decompress=False)
+    setup_circuit_breakers(app)
+
+    async def discovery_ctx(app):
+        app["discovery"] = DiscoveryCache(app["client_session"], "http://127.0.0.1:9", watch=False)
+        for service, port in ports.items():
+            app["discovery"]._store(service, {"endpoints": [["127.0.0.1", port]]})
+        yield
+        await app["discovery"].close()
+
+    app.cleanup_ctx.append(discovery_ctx)
+    app["response_cache"] = ResponseCache()
+    app["hedger"] = None
+    return app
+
+
+def through_gateway(tmp_path, check, upstreams=None):
+    """
+    Run check(client) against a gateway whose menu service is up
+    :param upstreams: {service: app} of more services behind the gateway
+    """
+    async def run():
+        apps = dict(upstreams or {}, menu=menu_app(tmp_path / "menu.db"))
+        servers = {service: TestServer(app) for service, app in apps.items()}
+        for server in servers.values():
+            await server.start_server()
+        client = TestClient(TestServer(gateway_app({service: s.port for service, s in servers.items()})))
+        await client.start_server()
+        try:
+            await check(client)
+        finally:
+            await client.close()
+            for server in servers.values():
+                await server.close()
+
+    asyncio.run(run())
+
+
+def link(page, name):
+    match = re.search(rf'<a href="([^"]*)">{name}</a>', page)
+    return html.unescape(match.group(1)) if match else None
+
+
+def test_paging_links_stay_on_the_gateway_route(tmp_path):
+    async def check(client):
+        url = URL("/menu?per_page=1")
+        r = await client.get(url)
+        assert r.status == 200
+        first = await r.text()
+        assert link(first, "Previous") is None
+        url = url.join(URL(link(first, "Next")))
+        assert url.path == "/menu" and url.query == {"per_page": "1", "page": "2"}
+
+        r = await client.get(url)
+        assert r.status == 200
+        second = await r.text()
+        assert second != first
+        assert link(second, "Next") is None
+        assert url.join(URL(link(second, "Previous"))).query == {"per_page": "1", "page": "1"}
+
+    through_gateway(tmp_path, check)
+
+
+def test_streamed_menu_bypasses_the_response_cache(tmp_path):
+    async def check(client):
+        for _ in range(2):
+            r = await client.get("/menu?stream=true")
+            assert r.status == 200
+            assert "X-Cache" not in r.headers
+            assert r.headers["Cache-Control"] == "no-store"
+            assert "Kung Pao Beef" in await r.text()
+        assert len(client.app["response_cache"]) == 0
+
+        r = await client.get("/menu")
+        assert r.headers["X-Cache"] == "MISS"
+
+    through_gateway(tmp_path, check)
+
+
+def test_slow_client_does_not_count_against_the_upstream(tmp_path):
+    body = b"x" * (16 * 1024 * 1024)
+
+    async def large(request):
+        return web.Response(body=body)
+
+    upstream = web.Application()
+    upstream.router.add_get("/large", large)
+
+    async def check(client):
+        breakers = client.app["breakers"]
+        breakers.slow_call = 0.2
+        r = await client.get("/large/large")
+        # Far more than the socket buffers hold, so the gateway waits on this client while it dawdles
+        await asyncio.sleep(0.5)
+        assert len(await r.read()) == len(body)
+        (breaker,) = breakers._breakers.values()
+        assert list(breaker.outcomes) == [True]
+        assert breaker.state() == "closed"
+
+    through_gateway(tmp_path, check, {"large": upstream})
+
+
+def test_a_failing_fragment_is_an_upstream_error(tmp_path):
+    async def broken(request):
+        raise web.HTTPInternalServerError()
+
+    upstream = web.Application()
+    upstream.router.add_get("/", broken)
+
+    async def check(client):
+        request = make_mocked_request("GET", "/", app=client.app)
+        with pytest.raises(api_gateway.UpstreamError):
+            await api_gateway.fetch_fragment(request, "broken")
+        assert "Kung Pao Beef" in await api_gateway.fetch_fragment(request, "menu")
+
+    through_gateway(tmp_path, check, {"broken": upstream})
@@ -0,0 +1,51 @@
+from hedging import Hedger
+
+
+def test_hedges_stop_when_the_budget_runs_dry():
+    hedger = Hedger(budget=0.1, burst=2)
+    hedger.delay("menu")
+    assert hedger.allow("menu") and hedger.allow("menu")
+    assert not hedger.allow("menu")
+    assert hedger.hedges == 2
+    # Nine more requests earn 0.9 of a token, the tenth makes it a whole one
+    for _ in range(9):
+        hedger.delay("menu")
+    assert not hedger.allow("menu")
+    hedger.delay("menu")
+    assert hedger.allow("menu")
+    assert hedger.hedges == 3
+
+
+def test_the_budget_never_exceeds_the_burst():
+    hedger = Hedger(budget=0.5, burst=2)
+    for _ in range(100):
+        hedger.delay("menu")
+    assert [hedger.allow("menu") for _ in range(3)] == [True, True, False]
+
+
+def test_each_service_has_its_own_budget():
+    hedger = Hedger(budget=0.1, burst=1)
+    assert hedger.allow("menu")
+    assert not hedger.allow("menu")
+    assert hedger.allow("login")
+
+
+def test_delay_follows_the_latency_percentile_within_bounds():
+    hedger = Hedger(percentile=90, min_delay=0.01, max_delay=0.5, min_samples=20)
+    assert hedger.delay("menu") == 0.5
+    for i in range(100):
+        hedger.observe("menu", (i + 1) / 1000)
+    assert hedger.delay("menu") == 0.091
+    for _ in range(200):
+        hedger.observe("menu", 0.001)
+    assert hedger.delay("menu") == 0.01
+    for _ in range(200):
+        hedger.observe("menu", 5)
+    assert hedger.delay("menu") == 0.5
+
+
+def test_hedge_wins_are_counted():
+    hedger = Hedger()
+    hedger.observe("menu", 0.1, hedge_won=True)
+    hedger.observe("menu", 0.1)
+    assert hedger.wins == 1
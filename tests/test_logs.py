@@ -0,0 +1,71 @@
+import logging
+import types
+
+from aiohttp.test_utils import make_mocked_request
+
+from dragon_common import logs
+from dragon_common.logs import SampledAccessLogger, parse_samples, redact
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def access_logger(monkeypatch, samples="", share=1.0):
+    logger = logging.getLogger("test_logs.access")
+    logger.setLevel(logging.INFO)
+    logger.handlers[:] = [Records()]
+    logger.propagate = False
+    monkeypatch.setattr(SampledAccessLogger, "samples", parse_samples(samples))
+    monkeypatch.setattr(logs, "LOG_ACCESS_SAMPLE", share)
+    return SampledAccessLogger(logger, ""), logger.handlers[0].records
+
+
+def served(access, path, status=200):
+    response = types.SimpleNamespace(status=status, body_length=42)
+    access.log(make_mocked_request("GET", path), response, 0.0125)
+
+
+def test_redact_is_stable_and_hides_the_value():
+    assert redact("alice") == redact("alice")
+    assert redact("alice") != redact("bob")
+    assert redact("alice").startswith("user#") and "alice" not in redact("alice")
+    assert redact("") == redact(None) == "-"
+
+
+def test_parse_samples_reads_a_share_per_route():
+    assert parse_samples(" menu=0.01, /login/=1,,") == {"menu": 0.01, "login": 1.0}
+    assert parse_samples("") == {}
+
+
+def test_access_lines_are_sampled_per_route(monkeypatch):
+    access, records = access_logger(monkeypatch, samples="menu=0.25,login=1", share=0.5)
+    monkeypatch.setattr(logs.random, "random", lambda: 0.3)
+    served(access, "/menu/specials")
+    served(access, "/login")
+    served(access, "/order")
+    assert [record.path for record in records] == ["/login", "/order"]
+    monkeypatch.setattr(logs.random, "random", lambda: 0.6)
+    served(access, "/order")
+    assert len(records) == 2
+
+
+def test_failed_requests_are_always_logged_without_the_query(monkeypatch):
+    access, records = access_logger(monkeypatch, samples="menu=0")
+    served(access, "/menu?name=alice", status=502)
+    served(access, "/menu")
+    [record] = records
+    assert record.status == 502 and record.path == "/menu" and record.bytes == 42 and record.ms == 12.5
+    assert "alice" not in record.getMessage()
+
+
+def test_access_logging_can_be_turned_off(monkeypatch):
+    access, records = access_logger(monkeypatch)
+    monkeypatch.setattr(logs, "LOG_ACCESS", False)
+    served(access, "/menu", status=500)
+    assert not records
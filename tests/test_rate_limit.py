@@ -0,0 +1,106 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import rate_limit
+from dragon_common.sessions import SessionSigner
+from rate_limit import MemoryBuckets, SQLiteBuckets, setup_rate_limits
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_memory_bucket_refills_at_its_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    buckets = MemoryBuckets()
+
+    async def run():
+        # A burst of 2 tokens at 4 a second
+        assert await buckets.take("k", 4, 2) == 0
+        assert await buckets.take("k", 4, 2) == 0
+        assert await buckets.take("k", 4, 2) == 0.25
+        clock.now += 0.125
+        # Half a token back, so half of the quarter second still to wait
+        assert await buckets.take("k", 4, 2) == 0.125
+        clock.now += 0.125
+        assert await buckets.take("k", 4, 2) == 0
+        clock.now += 60
+        # Never more than the burst, however long the bucket was idle
+        assert await buckets.take("k", 4, 2) == 0
+        assert await buckets.take("k", 4, 2) == 0
+        assert await buckets.take("k", 4, 2) > 0
+
+    asyncio.run(run())
+
+
+def test_sqlite_buckets_are_shared_between_limiters(tmp_path):
+    async def run():
+        first, second = SQLiteBuckets(str(tmp_path / "buckets.db")), SQLiteBuckets(str(tmp_path / "buckets.db"))
+        await first.open()
+        await second.open()
+        try:
+            assert await first.take("k", 1, 2) == 0
+            assert await second.take("k", 1, 2) == 0
+            assert 0 < await first.take("k", 1, 2) <= 1
+            assert await second.take("other", 1, 2) == 0
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(run())
+
+
+def limited_app(**kwargs) -> web.Application:
+    async def ok(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/{service}/{path:.*}", ok)
+    app["session_signer"] = SessionSigner("t" * 32)
+    setup_rate_limits(app, lambda request: (request.match_info.get("service"), request.path.strip("/")),
+                      buckets=MemoryBuckets(), **kwargs)
+    return app
+
+
+def with_client(app, check):
+    async def run():
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        try:
+            await check(client)
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+
+def test_client_over_its_rate_gets_429_with_retry_after():
+    async def check(client):
+        statuses = [(await client.get("/menu/menu")).status for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        r = await client.get("/menu/menu")
+        assert r.status == 429
+        # 1 token at 0.5 a second is 2 seconds away
+        assert r.headers["Retry-After"] == "2"
+        assert client.app["rate_limiter"].limited == 2
+
+    with_client(limited_app(client_rate=0.5, burst=4, service_rates={}), check)
+
+
+def test_service_rate_applies_to_every_client_together():
+    async def check(client):
+        assert (await client.get("/login/x")).status == 200
+        r = await client.get("/login/x")
+        assert r.status == 429
+        # 1 token at 0.1 a second is 10 seconds away
+        assert r.headers["Retry-After"] == "10"
+        assert (await client.get("/menu/x")).status == 200
+
+    with_client(limited_app(client_rate=0, service_rates={"login": 0.1}), check)
@@ -0,0 +1,124 @@
+import asyncio
+
+from response_cache import CachedResponse, ResponseCache, freshness
+
+
+def page(body, ttl=5.0, stale=30.0, **headers) -> CachedResponse:
+    return CachedResponse(200, headers, body, ttl, stale)
+
+
+def serve(entry):
+    """ A fetch that answers with entry """
+    async def fetch(previous):
+        return entry
+
+    return fetch
+
+
+def expire(entry, by) -> None:
+    """ Age an entry by some seconds """
+    entry.stored -= by
+
+
+def test_expired_entry_is_served_stale_while_it_is_refreshed():
+    async def run():
+        cache = ResponseCache()
+        old = page(b"old")
+        refreshed = asyncio.Event()
+
+        async def refresh(previous):
+            assert previous is old
+            refreshed.set()
+            return page(b"new")
+
+        assert await cache.get("menu", serve(old)) == (old, "MISS")
+        expire(old, 10)
+        entry, state = await cache.get("menu", refresh)
+        assert (entry.body, state) == (b"old", "STALE")
+        await asyncio.wait_for(refreshed.wait(), 1)
+        await asyncio.sleep(0)
+        entry, state = await cache.get("menu", refresh)
+        assert (entry.body, state) == (b"new", "HIT")
+
+    asyncio.run(run())
+
+
+def test_entry_past_its_stale_window_is_fetched_again():
+    async def run():
+        cache = ResponseCache()
+
+        async def fetch(previous):
+            return page(b"menu", ttl=5, stale=1)
+
+        entry, _ = await cache.get("menu", fetch)
+        expire(entry, 10)
+        assert (await cache.get("menu", fetch))[1] == "MISS"
+
+    asyncio.run(run())
+
+
+def test_a_failed_refresh_falls_back_to_the_expired_entry():
+    async def run():
+        cache = ResponseCache()
+        entry, _ = await cache.get("menu", serve(page(b"menu", stale=0)))
+        expire(entry, 10)
+
+        async def broken(previous):
+            raise ConnectionError("menu is down")
+
+        assert await cache.get("menu", broken) == (entry, "STALE")
+
+    asyncio.run(run())
+
+
+def test_concurrent_misses_share_one_fetch():
+    fetches = 0
+
+    async def run():
+        cache = ResponseCache()
+
+        async def fetch(previous):
+            nonlocal fetches
+            fetches += 1
+            await asyncio.sleep(0.05)
+            return page(b"menu")
+
+        results = await asyncio.gather(*(cache.get("menu", fetch) for _ in range(10)))
+        assert len({id(entry) for entry, _ in results}) == 1
+
+    asyncio.run(run())
+    assert fetches == 1
+
+
+def test_least_recently_used_entries_are_evicted_first():
+    async def run():
+        size = page(b"x" * 100).size
+        cache = ResponseCache(max_bytes=2 * size)
+        for key in ("a", "b"):
+            await cache.get(key, serve(page(b"x" * 100)))
+        # Reading a makes b the least recently used
+        await cache.get("a", None)
+        await cache.get("c", serve(page(b"x" * 100)))
+        assert sorted(cache._entries) == ["a", "c"]
+        assert cache.size == 2 * size
+
+    asyncio.run(run())
+
+
+def test_oversized_and_uncacheable_responses_are_not_stored():
+    async def run():
+        cache = ResponseCache(max_entry=50)
+        await cache.get("big", serve(page(b"x" * 100)))
+        await cache.get("once", serve(page(b"x", ttl=0)))
+        assert len(cache) == 0
+
+    asyncio.run(run())
+
+
+def test_upstream_cache_control_wins_over_the_route_ttl():
+    assert freshness({"Cache-Control": "no-store"}, 5) is None
+    assert freshness({"Cache-Control": "private, max-age=60"}, 5) is None
+    assert freshness({"Set-Cookie": "a=b"}, 5) is None
+    assert freshness({"Cache-Control": "max-age=60, stale-while-revalidate=10"}, 5) == (60, 10)
+    assert freshness({"Cache-Control": "s-maxage=20, max-age=60"}, 5, stale=30) == (20, 30)
+    assert freshness({}, 5, stale=30) == (5, 30)
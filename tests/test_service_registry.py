@@ -0,0 +1,251 @@
+import asyncio
+import sqlite3
+
+import aiosqlite
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import service_registry
+from dragon_common.balancing import Balancer
+from service_registry import ServiceTable, flush, health_check, load_table, migrate
+
+LEGACY = "CREATE TABLE {} (ip CHAR(16), port INT, heartbeat CHAR(50), alive  BOOL);"
+
+
+def legacy_db(path):
+    """ A database in the old table-per-service layout, as the registry used to write it """
+    db = sqlite3.connect(str(path))
+    db.execute(LEGACY.format("menu"))
+    db.executemany("INSERT INTO menu (ip, port, heartbeat, alive) VALUES (?, ?, ?, ?);", [
+        ("10.0.0.1", "2227", "2021-06-01 10:00:00.000000", "TRUE"),
+        ("10.0.0.2", "2227", "2021-06-01 10:00:00.000000", "TRUE"),
+        # Re-added later, after it had been removed: the newest row wins
+        ("10.0.0.1", "2227", "2021-06-01 11:00:00.000000", "FALSE"),
+        ("10.0.0.3", "not a port", "2021-06-01 10:00:00.000000", "TRUE"),
+    ])
+    db.execute(LEGACY.format("login"))
+    db.execute("INSERT INTO login (ip, port, heartbeat, alive) VALUES ('10.0.0.4', 2228, 'garbage', 'TRUE');")
+    db.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, body TEXT);")
+    db.execute("INSERT INTO notes (body) VALUES ('keep me');")
+    db.commit()
+    db.close()
+
+
+def query(path, sql):
+    db = sqlite3.connect(str(path))
+    try:
+        return db.execute(sql).fetchall()
+    finally:
+        db.close()
+
+
+def test_migrate_folds_legacy_tables_and_drops_them(tmp_path):
+    path = tmp_path / "registry.db"
+    legacy_db(path)
+
+    async def run():
+        async with aiosqlite.connect(str(path)) as db:
+            await migrate(db)
+
+    asyncio.run(run())
+    tables = {name for (name,) in query(path, "SELECT name FROM sqlite_master WHERE type = 'table';")}
+    assert tables == {"instances", "notes"}
+    assert query(path, "SELECT body FROM notes;") == [("keep me",)]
+    rows = query(path, "SELECT service, ip, port, heartbeat, alive FROM instances ORDER BY service, ip;")
+    assert [(s, ip, port, alive) for s, ip, port, _, alive in rows] == [
+        ("login", "10.0.0.4", 2228, 1),
+        ("menu", "10.0.0.1", 2227, 0),
+        ("menu", "10.0.0.2", 2227, 1),
+    ]
+    assert rows[0][3] == 0.0 and rows[1][3] > rows[2][3] > 0
+    assert query(path, "PRAGMA user_version;") == [(service_registry.SCHEMA_VERSION,)]
+
+
+def test_migrate_runs_once(tmp_path):
+    path = tmp_path / "registry.db"
+
+    async def run():
+        async with aiosqlite.connect(str(path)) as db:
+            await migrate(db)
+        # A table created after the migration is never mistaken for a legacy one
+        db = sqlite3.connect(str(path))
+        db.execute(LEGACY.format("menu"))
+        db.commit()
+        db.close()
+        async with aiosqlite.connect(str(path)) as db:
+            await migrate(db)
+
+    asyncio.run(run())
+    assert {name for (name,) in query(path, "SELECT name FROM sqlite_master WHERE type = 'table';")} == {
+        "instances", "menu"}
+
+
+def test_table_is_written_behind_and_reloads(tmp_path):
+    path = tmp_path / "registry.db"
+
+    async def run():
+        async with aiosqlite.connect(str(path)) as db:
+            await migrate(db)
+            table = ServiceTable(Balancer("random"))
+            table.add("menu", "10.0.0.1", 2227, now=100.0)
+            table.add("menu", "10.0.0.2", 2227, now=100.0)
+            table.heartbeat("menu", "10.0.0.1", 2227, now=105.0)
+            table.remove("menu", "10.0.0.2", 2227, now=106.0)
+            assert query(path, "SELECT COUNT(*) FROM instances;") == [(0,)]
+            assert await flush(db, table) == 2
+            assert table.dirty == {}
+            assert await flush(db, table) == 0
+
+            reloaded = ServiceTable(Balancer("random"))
+            await load_table(db, reloaded)
+            return reloaded
+
+    reloaded = asyncio.run(run())
+    assert reloaded.endpoints("menu") == [("10.0.0.1", 2227)]
+    assert reloaded.get("menu", "10.0.0.1", 2227).heartbeat == 105.0
+    assert not reloaded.get("menu", "10.0.0.2", 2227).alive
+    assert reloaded.dirty == {}
+
+
+def test_failed_health_check_keeps_the_instance_out_until_a_probe_passes():
+    healthy = False
+
+    async def probe(request):
+        return web.Response(status=200 if healthy else 500)
+
+    async def run():
+        nonlocal healthy
+        instance_app = web.Application()
+        instance_app.router.add_get("/", probe)
+        instance = TestServer(instance_app)
+        await instance.start_server()
+        registry_app = web.Application()
+        service_registry.routes(registry_app)
+        registry_app["table"] = table = ServiceTable(Balancer("random"))
+        registry = TestClient(TestServer(registry_app))
+        await registry.start_server()
+        try:
+            assert (await registry.get(f"/add/menu/127.0.0.1/{instance.port}")).status == 200
+            await health_check(registry.session, table)
+            # The instance keeps heartbeating fine, so it has no reason to register again...
+            assert (await registry.get(f"/heartbeat/menu/127.0.0.1/{instance.port}")).status == 200
+            # ...and even if it does, it stays out of rotation
+            assert (await registry.get(f"/add/menu/127.0.0.1/{instance.port}")).status == 200
+            assert (await registry.get("/get_one/menu")).status == 404
+            assert (await (await registry.get("/get/menu")).json())["endpoints"] == []
+
+            healthy = True
+            await health_check(registry.session, table)
+            r = await registry.get("/get_one/menu")
+            assert (await r.json())["endpoints"] == ["127.0.0.1", instance.port]
+            assert table.quarantined == {}
+        finally:
+            await registry.close()
+            await instance.close()
+
+    asyncio.run(run())
+
+
+def test_unknown_services_allocate_no_version_or_watch():
+    async def run():
+        registry_app = web.Application()
+        service_registry.routes(registry_app)
+        registry_app["table"] = ServiceTable(Balancer("random"))
+        registry = TestClient(TestServer(registry_app))
+        await registry.start_server()
+        try:
+            reply = await (await registry.get("/get/no-such-service")).json()
+            assert reply["endpoints"] == []
+            r = await registry.get("/watch/no-such-service", params={"version": reply["version"], "timeout": "5"})
+            assert (await r.json())["endpoints"] == []
+            await registry.post("/bulk/get", json={"services": ["also-unknown"]})
+        finally:
+            await registry.close()
+
+    asyncio.run(run())
+    assert "no-such-service" not in service_registry.VERSIONS
+    assert "also-unknown" not in service_registry.VERSIONS
+    assert "no-such-service" not in service_registry.CHANGED
+
+
+def with_registry(tmp_path, check):
+    """ Run check(client, table) against a registry app backed by a database in tmp_path """
+    async def run():
+        async with aiosqlite.connect(str(tmp_path / "registry.db")) as db:
+            await migrate(db)
+            app = web.Application()
+            service_registry.routes(app)
+            app["db"] = db
+            app["table"] = ServiceTable(Balancer("random"))
+            client = TestClient(TestServer(app))
+            await client.start_server()
+            try:
+                await check(client, app["table"])
+            finally:
+                await client.close()
+
+    asyncio.run(run())
+
+
+def instances(*ports, service="menu", **extra):
+    return {"instances": [dict(service=service, ip="10.0.0.1", port=port, **extra) for port in ports]}
+
+
+def test_bulk_add_registers_and_persists_every_instance(tmp_path):
+    async def check(client, table):
+        r = await client.post("/bulk/add", json=instances(2227, "2228"))
+        assert await r.json() == {"added": 2}
+        r = await client.post("/bulk/get", json={"services": ["menu", "login"]})
+        resolved = (await r.json())["services"]
+        assert sorted(map(tuple, resolved["menu"]["endpoints"])) == [("10.0.0.1", 2227), ("10.0.0.1", 2228)]
+        assert resolved["login"]["endpoints"] == []
+
+    with_registry(tmp_path, check)
+    assert query(tmp_path / "registry.db", "SELECT port FROM instances ORDER BY port;") == [(2227,), (2228,)]
+
+
+def test_bulk_heartbeat_reports_instances_to_register_again(tmp_path):
+    async def check(client, table):
+        await client.post("/bulk/add", json=instances(2227))
+        body = instances(2227, 2228, load=3, latency=0.25)
+        r = await client.post("/bulk/heartbeat", json=body)
+        assert r.status == 200
+        assert [i["port"] for i in (await r.json())["missing"]] == [2228]
+        instance = table.get("menu", "10.0.0.1", 2227)
+        assert (instance.load, instance.latency) == (3, 0.25)
+
+    with_registry(tmp_path, check)
+
+
+def test_a_bad_bulk_heartbeat_applies_nothing(tmp_path):
+    async def check(client, table):
+        await client.post("/bulk/add", json=instances(2227))
+        body = instances(2227)
+        body["instances"].append(dict(service="menu", ip="10.0.0.1", port=2227, load="lots"))
+        assert (await client.post("/bulk/heartbeat", json=body)).status == 400
+        assert table.get("menu", "10.0.0.1", 2227).load == 0
+
+    with_registry(tmp_path, check)
+
+
+@pytest.mark.parametrize("body", [{}, {"instances": [{"service": "menu", "ip": "10.0.0.1"}]},
+                                  {"instances": [{"service": "menu", "ip": "10.0.0.1", "port": "x"}]},
+                                  {"instances": [{"service": 1, "ip": "10.0.0.1", "port": 2227}]}])
+def test_malformed_bulk_requests_are_refused(tmp_path, body):
+    async def check(client, table):
+        for path in ("/bulk/add", "/bulk/heartbeat", "/bulk/remove"):
+            assert (await client.post(path, json=body)).status == 400
+        assert table.instances == {}
+
+    with_registry(tmp_path, check)
+
+
+def test_bulk_remove_takes_instances_out_of_rotation(tmp_path):
+    async def check(client, table):
+        await client.post("/bulk/add", json=instances(2227, 2228))
+        r = await client.post("/bulk/remove", json=instances(2228, 2229))
+        assert await r.json() == {"removed": 1}
+        assert table.endpoints("menu") == [("10.0.0.1", 2227)]
+
+    with_registry(tmp_path, check)
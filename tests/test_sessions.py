@@ -0,0 +1,72 @@
+import asyncio
+import base64
+import json
+import time
+
+import pytest
+
+from dragon_common.sessions import MemorySessionStore, Session, SessionSigner
+
+SECRET = "s" * 32
+
+
+def test_signed_session_verifies():
+    signer = SessionSigner(SECRET)
+    session = Session.new("alice")
+    verified = signer.verify(signer.sign(session))
+    assert (verified.id, verified.name, verified.expires) == (session.id, session.name, session.expires)
+
+
+def test_another_key_rejects_the_cookie():
+    cookie = SessionSigner(SECRET).sign(Session.new("alice"))
+    assert SessionSigner("o" * 32).verify(cookie) is None
+
+
+def test_tampered_payload_is_rejected():
+    signer = SessionSigner(SECRET)
+    payload, signature = signer.sign(Session.new("alice")).split(".")
+    session_id, _, expires = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    forged = base64.urlsafe_b64encode(json.dumps([session_id, "admin", expires]).encode()).rstrip(b"=").decode()
+    assert signer.verify(f"{forged}.{signature}") is None
+
+
+def test_tampered_signature_is_rejected():
+    signer = SessionSigner(SECRET)
+    payload, signature = signer.sign(Session.new("alice")).split(".")
+    flipped = ("A" if signature[0] != "A" else "B") + signature[1:]
+    assert signer.verify(f"{payload}.{flipped}") is None
+
+
+def test_expired_session_is_rejected():
+    signer = SessionSigner(SECRET)
+    assert signer.verify(signer.sign(Session("id", "alice", int(time.time()) - 1))) is None
+
+
+@pytest.mark.parametrize("cookie", ["", ".", "garbage", "a.b.c", "!!!.???", None])
+def test_malformed_cookies_are_rejected(cookie):
+    assert SessionSigner(SECRET).verify(cookie) is None
+
+
+@pytest.mark.parametrize("secret", ["", "short", "<SESSION_SECRET>", "<" + "x" * 40])
+def test_a_real_secret_is_required(secret):
+    with pytest.raises(ValueError):
+        SessionSigner(secret)
+
+
+def test_memory_store_forgets_deleted_expired_and_least_recent_sessions():
+    async def run():
+        store = MemorySessionStore(max_sessions=2)
+        first, second, third = Session.new("a"), Session.new("b"), Session.new("c")
+        for session in (first, second):
+            await store.put(session)
+        assert await store.get(first.id) is first
+        # first was used more recently, so second is the one dropped
+        await store.put(third)
+        assert await store.get(second.id) is None
+        assert await store.get(first.id) is first
+        await store.delete(first.id)
+        assert await store.get(first.id) is None
+        await store.put(Session("old", "d", int(time.time()) - 1))
+        assert await store.get("old") is None
+
+    asyncio.run(run())
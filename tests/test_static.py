@@ -0,0 +1,59 @@
+import gzip
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+from dragon_common import static
+from dragon_common.static import StaticPage, etag_matches
+
+PAGE = "<html><body>" + "<p>Kung Pao Beef</p>" * 100 + "</body></html>"
+
+
+def page(tmp_path) -> StaticPage:
+    (tmp_path / "page.html").write_text(PAGE)
+    return StaticPage("page.html", templates_dir=str(tmp_path))
+
+
+def get(page, accept_encoding, if_none_match=None):
+    headers = {"Accept-Encoding": accept_encoding}
+    if if_none_match:
+        headers["If-None-Match"] = if_none_match
+    return page.response(make_mocked_request("GET", "/", headers=headers))
+
+
+@pytest.mark.parametrize("if_none_match, etag, matches", [
+    ('"a"', '"a"', True),
+    ('W/"a"', '"a"', True),
+    ('"a"', 'W/"a"', True),
+    ('W/"a"', 'W/"a"', True),
+    ('"b", W/"a"', '"a"', True),
+    ("*", '"a"', True),
+    ('"b"', '"a"', False),
+    ("", '"a"', False),
+    (None, '"a"', False),
+    ('"a"', None, False),
+])
+def test_etags_compare_weakly(if_none_match, etag, matches):
+    assert etag_matches(if_none_match, etag) is matches
+
+
+def test_brotli_variant_is_served_when_installed(tmp_path):
+    brotli = pytest.importorskip("brotli")
+    static_page = page(tmp_path)
+    r = get(static_page, "gzip, br")
+    assert r.headers["Content-Encoding"] == "br"
+    assert brotli.decompress(r.body).decode() == PAGE
+    assert get(static_page, "br", if_none_match=r.headers["ETag"]).status == 304
+    # Every variant has its own ETag
+    assert get(static_page, "gzip", if_none_match=r.headers["ETag"]).status == 200
+
+
+def test_without_brotli_the_page_has_gzip_and_identity_variants(tmp_path, monkeypatch):
+    monkeypatch.setattr(static, "CODINGS", ["gzip"])
+    static_page = page(tmp_path)
+    r = get(static_page, "br, gzip")
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(r.body).decode() == PAGE
+    assert sorted(static_page.variants) == ["gzip", "identity"]
+    r = get(static_page, "br")
+    assert "Content-Encoding" not in r.headers and r.body.decode() == PAGE
@@ -0,0 +1,31 @@
+import os
+import pathlib
+
+from dragon_common.templating import get_engine
+
+
+def test_engine_and_templates_are_cached(tmp_path, monkeypatch):
+    (tmp_path / "page.html").write_text("<p>{{ dish }}</p>")
+    engine = get_engine(tmp_path)
+    template = engine.get("page.html")
+
+    def no_syscalls(self, *args, **kwargs):
+        raise AssertionError("get_engine touched the filesystem")
+
+    monkeypatch.setattr(pathlib.Path, "resolve", no_syscalls)
+    assert get_engine(tmp_path) is engine
+    assert get_engine(str(tmp_path)) is engine
+    assert engine.get("page.html") is template
+    assert engine.render("page.html", {"dish": "Kung Pao Beef"}) == "<p>Kung Pao Beef</p>"
+
+
+def test_a_changed_template_is_compiled_again(tmp_path):
+    path = tmp_path / "page.html"
+    path.write_text("<p>old</p>")
+    engine = get_engine(tmp_path)
+    template = engine.get("page.html")
+    path.write_text("<p>new</p>")
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    assert engine.get("page.html") is not template
+    assert engine.render("page.html") == "<p>new</p>"